@@ -0,0 +1,13 @@
+# Benchmarks for Sleipnir.
+#
+# corpus.py generates synthetic corpora of a given size and shape,
+# run.py times the database interface methods and the REST routes
+# on them, and compare.py compares two runs' JSON results:
+#
+#     python -m benchmarks run --igts 5000 -o new.json
+#     python -m benchmarks compare old.json new.json
+#
+# load.py loads a running server, and codecs.py compares the record
+# codecs of the filesystem backend on given corpora:
+#
+#     python -m benchmarks codecs corpus.xml
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import importlib
+from tempfile import mkdtemp
+
+from benchmarks import compare, load
+
+
+def _import(name):
+    # importing sleipnir opens (and makes) its configured database, by
+    # default db/ in the working directory, so do that in a temporary
+    # one; the benchmarks make their own databases
+    cwd = os.getcwd()
+    tmp = mkdtemp()
+    os.chdir(tmp)
+    try:
+        return importlib.import_module(name)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmark the database interfaces and the REST API.'
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    r = subparsers.add_parser('run', help='run the benchmarks')
+    r.add_argument('-b', '--backend', choices=['filesystem', 'sqlite'],
+        default='filesystem', help='database backend (default: filesystem)')
+    r.add_argument('--igts', type=int, default=1000,
+        help='number of IGTs in the corpus (default: 1000)')
+    r.add_argument('--tiers', type=int, default=3,
+        help='number of tiers per IGT (default: 3)')
+    r.add_argument('--items', type=int, default=5,
+        help='number of items per tier (default: 5)')
+    r.add_argument('--languages', type=int, default=10,
+        help='number of languages in the corpus (default: 10)')
+    r.add_argument('--seed', type=int, default=0,
+        help='random seed for the corpus (default: 0)')
+    r.add_argument('-r', '--repeat', type=int, default=5,
+        help='number of times to run each benchmark (default: 5)')
+    r.add_argument('-k', '--filter', metavar='REGEX',
+        help='only run benchmarks whose names match REGEX')
+    r.add_argument('-o', '--output', metavar='FILE',
+        help='write the results as JSON to FILE')
+
+    c = subparsers.add_parser('compare',
+        help='compare two result files by their median times')
+    c.add_argument('base', help='results of the earlier run')
+    c.add_argument('new', help='results of the later run')
+    c.add_argument('-t', '--threshold', type=float, default=0.1,
+        help='fractional change in a median that counts as slower or '
+             'faster (default: 0.1)')
+
+    lo = subparsers.add_parser('load',
+        help='measure the throughput and latency of a running server')
+    lo.add_argument('url', nargs='?', default='http://127.0.0.1:5000/v1',
+        help='URL of the API (default: http://127.0.0.1:5000/v1)')
+    lo.add_argument('-c', '--concurrency', type=int, nargs='+',
+        default=[1, 4, 16, 64], metavar='N',
+        help='numbers of concurrent clients (default: 1 4 16 64)')
+    lo.add_argument('-d', '--duration', type=float, default=10,
+        help='seconds to run each level (default: 10)')
+    lo.add_argument('-w', '--warmup', type=float, default=1,
+        help='unmeasured seconds before each level (default: 1)')
+    lo.add_argument('--route', dest='routes', action='append',
+        choices=sorted(load.ROUTES),
+        help='a route in the mix of requests; may be repeated (default: '
+             '{})'.format(' '.join(load.DEFAULT_ROUTES)))
+    lo.add_argument('--corpus', metavar='ID',
+        help='corpus to request (default: the largest)')
+    lo.add_argument('--seed', type=int, default=0,
+        help='random seed for the requests (default: 0)')
+    lo.add_argument('-o', '--output', metavar='FILE',
+        help='write the results as JSON to FILE')
+
+    co = subparsers.add_parser('codecs',
+        help='compare the record codecs of the filesystem backend')
+    co.add_argument('files', nargs='+',
+        help='XigtXML corpora to store with each codec')
+    co.add_argument('-c', '--codec', dest='codecs', action='append',
+        help='codec to compare (can be repeated; default: each method, '
+             'some at several levels)')
+    co.add_argument('-r', '--repeat', type=int, default=3,
+        help='number of times to time each read (default: 3)')
+    co.add_argument('-o', '--output', metavar='FILE',
+        help='write the results as JSON to FILE')
+
+    args = parser.parse_args()
+    if args.command == 'load':
+        results = load.run(
+            args.url, concurrency=args.concurrency, duration=args.duration,
+            warmup=args.warmup, routes=args.routes, corpus_id=args.corpus,
+            seed=args.seed, log=print
+        )
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    elif args.command == 'codecs':
+        codecs = _import('benchmarks.codecs')
+        results = codecs.run(
+            args.files, codecs=args.codecs, repeat=args.repeat, log=print
+        )
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    elif args.command == 'run':
+        run = _import('benchmarks.run')
+        results = run.run(
+            backend=args.backend, igts=args.igts, tiers=args.tiers,
+            items=args.items, languages=args.languages, repeat=args.repeat,
+            pattern=args.filter, seed=args.seed,
+            log=lambda line: print(line, file=sys.stderr)
+        )
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        else:
+            print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        rows = compare.compare(base, new, threshold=args.threshold)
+        slower = compare.report(
+            rows, base.get('parameters'), new.get('parameters')
+        )
+        sys.exit(1 if slower else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Compare the record codecs of the filesystem backend on given corpora.
+#
+# Each codec stores the corpora in a new database in a temporary
+# directory, and is measured by IGTs written, read (as raw JSON), and
+# read and decoded per second, and by the size of the data files. IGTs
+# are not cached, so every read decodes its records.
+
+import os
+import shutil
+from datetime import datetime, timezone
+from tempfile import mkdtemp
+from timeit import default_timer as timer
+
+from xigt.codecs import xigtxml
+
+from sleipnir.interfaces import FileSystemDbi
+
+DEFAULT_CODECS = ['none', 'gzip:1', 'gzip:6', 'gzip', 'zlib:1', 'zlib',
+                  'bz2', 'lzma']
+
+
+def run(files, codecs=None, repeat=3, log=None):
+    """
+    Store the XigtXML corpora in *files* with each of *codecs*
+    (default: DEFAULT_CODECS), time each read *repeat* times, and
+    return the results as a JSON-serializable dict.
+    """
+    codecs = list(codecs or DEFAULT_CODECS)
+    corpora = [xigtxml.load(f) for f in files]
+    igt_count = sum(len(xc) for xc in corpora)
+    results = []
+    if log is not None:
+        log(_header)
+    for codec in codecs:
+        # corpora are emptied when added, so use a fresh copy each time
+        result = _bench(
+            codec, [xigtxml.loads(xigtxml.dumps(xc)) for xc in corpora],
+            repeat
+        )
+        result['igts_per_second'] = {
+            'write': igt_count / result['write'],
+            'read_raw': igt_count / result['read_raw'],
+            'read_igts': igt_count / result['read_igts'],
+        }
+        results.append(result)
+        if log is not None:
+            log(_format_result(result))
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'parameters': {
+            'files': list(files), 'codecs': codecs, 'repeat': repeat,
+            'igts': igt_count
+        },
+        'results': results
+    }
+
+
+def _bench(codec, corpora, repeat):
+    tmp = mkdtemp()
+    try:
+        db = FileSystemDbi(os.path.join(tmp, 'db'), codec=codec,
+                           igt_cache_bytes=0)
+        start = timer()
+        ids = [c['id'] for c in db.add_corpora(corpora)]
+        write_time = timer() - start
+
+        def read_raw():
+            for corpus_id in ids:
+                db.fetch_raw_corpus(corpus_id, 'application/json')
+
+        def read_igts():
+            for corpus_id in ids:
+                db.get_igts(corpus_id)
+
+        return {
+            'codec': codec,
+            'write': write_time,
+            'read_raw': _best_time(read_raw, repeat),
+            'read_igts': _best_time(read_igts, repeat),
+            'size': _data_size(db)
+        }
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        func()
+        times.append(timer() - start)
+    return min(times)
+
+
+def _data_size(db):
+    size = 0
+    for root, _, files in os.walk(os.path.join(db.path, 'data')):
+        size += sum(os.path.getsize(os.path.join(root, fn))
+                    for fn in files if fn.endswith('.dat'))
+    return size
+
+
+_header = '{:<8} {:>10} {:>10} {:>10} {:>12}'.format(
+    'codec', 'write/s', 'raw/s', 'decode/s', 'size (KiB)'
+)
+
+
+def _format_result(result):
+    rates = result['igts_per_second']
+    return '{:<8} {:>10.0f} {:>10.0f} {:>10.0f} {:>12.1f}'.format(
+        result['codec'], rates['write'], rates['read_raw'],
+        rates['read_igts'], result['size'] / 1024
+    )
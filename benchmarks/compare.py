@@ -0,0 +1,55 @@
+# Compare two benchmark result files by their median times.
+
+def compare(base, new, threshold=0.1):
+    """
+    Return a list of (name, base median, new median, ratio, status)
+    for the benchmarks in *base* and *new* (result dicts as made by
+    benchmarks.run.run()). A benchmark is a regression when its new
+    median is more than *threshold* (a fraction) slower, and an
+    improvement when it is more than *threshold* faster.
+    """
+    rows = []
+    base_results = base['results']
+    new_results = new['results']
+    for name in sorted(set(base_results) | set(new_results)):
+        if name not in new_results:
+            rows.append((name, base_results[name]['median'], None, None,
+                         'removed'))
+        elif name not in base_results:
+            rows.append((name, None, new_results[name]['median'], None,
+                         'added'))
+        else:
+            b = base_results[name]['median']
+            n = new_results[name]['median']
+            ratio = n / b if b > 0 else float('inf')
+            if ratio > 1 + threshold:
+                status = 'slower'
+            elif ratio < 1 - threshold:
+                status = 'faster'
+            else:
+                status = ''
+            rows.append((name, b, n, ratio, status))
+    return rows
+
+
+def report(rows, base_params=None, new_params=None):
+    if base_params != new_params:
+        print('Warning: the runs used different parameters:')
+        print('  base: {}'.format(base_params))
+        print('  new:  {}'.format(new_params))
+    fmt = '{:<60} {:>12} {:>12} {:>7}  {}'
+    print(fmt.format('benchmark', 'base (ms)', 'new (ms)', 'ratio', ''))
+    for name, b, n, ratio, status in rows:
+        print(fmt.format(
+            name,
+            '-' if b is None else '{:.3f}'.format(b * 1000),
+            '-' if n is None else '{:.3f}'.format(n * 1000),
+            '-' if ratio is None else '{:.2f}'.format(ratio),
+            status
+        ))
+    slower = sum(1 for row in rows if row[4] == 'slower')
+    faster = sum(1 for row in rows if row[4] == 'faster')
+    print('{} slower, {} faster, {} compared'.format(
+        slower, faster, sum(1 for row in rows if row[3] is not None)
+    ))
+    return slower
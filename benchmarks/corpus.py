@@ -0,0 +1,106 @@
+# Synthetic Xigt corpora for benchmarks.
+#
+# Each IGT has a words tier followed by tiers aligned to the one before
+# it, a language (from a Zipfian spread over the given number of
+# languages) recorded as a dc:subject, and marker attributes on its
+# first item so that queries of known selectivity can be made: an IGT
+# has p1="1" with probability 0.01, p10="1" with 0.1, and p50="1" with
+# 0.5. See QUERIES.
+
+import random
+
+from xigt import XigtCorpus, Igt, Tier, Item, Metadata, Meta, MetaChild
+
+DC = 'http://purl.org/dc/elements/1.1/'
+OLAC = 'http://www.language-archives.org/OLAC/1.1/'
+
+_tier_types = ['words', 'morphemes', 'glosses', 'translations']
+
+_markers = [('p1', 0.01), ('p10', 0.1), ('p50', 0.5)]
+
+# (label, path, approximate fraction of IGTs matched with the default
+# number of items)
+QUERIES = [
+    ('none', 'tier[@type="none"]', 0.0),
+    ('1%', 'tier/item[@p1="1"]', 0.01),
+    ('10%', 'tier/item[@p10="1"]', 0.1),
+    ('50%', 'tier/item[@p50="1"]', 0.5),
+    ('all', 'tier[@type="words"]', 1.0),
+    # the predicate is not indexed, so every IGT is checked
+    ('unindexed', 'tier/item[value()="w0"]', 0.05),
+]
+
+
+def language_codes(count):
+    return ['l{:03d}'.format(i) for i in range(count)]
+
+
+def language_query(code):
+    # decoded records keep the olac: prefix on the code attribute, so
+    # @olac:code doesn't find it; match the subject's text instead
+    return 'metadata//dc:subject[text()="Language {}"]'.format(code)
+
+
+def language_fraction(languages):
+    """
+    Return the approximate fraction of IGTs with the first of
+    *languages* languages.
+    """
+    return 1.0 / sum(1.0 / (i + 1) for i in range(languages))
+
+
+def make_corpus(igt_count=1000, tiers=3, items=5, languages=10, seed=0,
+                start=0):
+    """
+    Return a corpus of *igt_count* IGTs (with IDs counting from
+    *start*), each with *tiers* tiers of *items* items. The same
+    arguments always give the same corpus.
+    """
+    rng = random.Random(seed)
+    codes = language_codes(languages)
+    weights = [1.0 / (i + 1) for i in range(languages)]
+    igts = [
+        make_igt('i{}'.format(start + i), rng, tiers, items,
+                 rng.choices(codes, weights)[0])
+        for i in range(igt_count)
+    ]
+    return XigtCorpus(igts=igts, nsmap={'dc': DC, 'olac': OLAC})
+
+
+def make_igt(igt_id, rng, tiers=3, items=5, language='l000'):
+    tier_list = []
+    prev = None
+    for t in range(tiers):
+        if t < len(_tier_types):
+            tier_type = _tier_types[t]
+        else:
+            tier_type = 'extra{}'.format(t)
+        tid = 't{}'.format(t)
+        item_list = []
+        for j in range(items):
+            attrs = {}
+            if prev is not None:
+                attrs['alignment'] = '{}{}'.format(prev, j)
+            if t == 2:
+                attrs['pos'] = rng.choice(['N', 'V', 'ADJ', 'ADV', 'DET'])
+            item_list.append(Item(
+                id='{}{}'.format(tid, j),
+                text='{}{}'.format(tier_type[0], rng.randrange(items * 20)),
+                attributes=attrs
+            ))
+        tier_list.append(Tier(id=tid, type=tier_type, items=item_list))
+        prev = tid
+    # the marker attributes go on the first item
+    first = tier_list[0][0] if tier_list and items else None
+    r = rng.random()
+    for name, p in _markers:
+        if first is not None and r < p:
+            first.attributes[name] = '1'
+    subject = MetaChild(
+        'subject', attributes={'{%s}code' % OLAC: language},
+        text='Language {}'.format(language), namespace=DC
+    )
+    metadata = Metadata(type='xigt-meta', metas=[
+        Meta(id='lang', type='language', children=[subject])
+    ])
+    return Igt(id=igt_id, metadata=[metadata], tiers=tier_list)
@@ -0,0 +1,273 @@
+# Generate load on a running Sleipnir server and report its throughput
+# and latencies at several levels of concurrency.
+#
+# Each level runs a number of client threads for a fixed time; each
+# thread sends one request after another, picking a route at random
+# from the mix (see ROUTES) and an IGT at random from a corpus on the
+# server. Only the server's REST API is used, so this can target any
+# deployment, but the client shares one Python process, so very fast
+# servers may be limited by the client instead.
+#
+# For a server on the same (Linux) machine, the length of its listen
+# queue (connections not yet accepted) is also sampled during each
+# level, from /proc/net/tcp. A server with a fixed pool of threads
+# (like sleipnir.server) only accepts as many connections as it has
+# threads, so with more clients than threads the rest wait there.
+
+import json
+import time
+import random
+import threading
+import http.client
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, quote
+from timeit import default_timer as timer
+
+# paths under the API URL, with the corpus ID and a random IGT ID
+ROUTES = {
+    'corpora': '/corpora',
+    'stats': '/stats',
+    'summary': '/corpora/{corpus}/summary?limit=100',
+    'igt': '/corpora/{corpus}/igts/{igt}',
+    'igts': '/corpora/{corpus}/igts?limit=20&cursor={igt}',
+    'corpus': '/corpora/{corpus}',
+}
+
+DEFAULT_ROUTES = ['corpora', 'summary', 'igt', 'igts']
+
+
+class _Client(object):
+    """A connection to the server that reconnects as needed."""
+
+    def __init__(self, url, timeout=60):
+        parts = urlsplit(url)
+        if parts.scheme == 'https':
+            self._make = lambda: http.client.HTTPSConnection(
+                parts.hostname, parts.port, timeout=timeout)
+        else:
+            self._make = lambda: http.client.HTTPConnection(
+                parts.hostname, parts.port or 80, timeout=timeout)
+        self.prefix = parts.path.rstrip('/')
+        self._conn = None
+
+    def get(self, path):
+        """Return the status and body of GET *path* under the API URL."""
+        if self._conn is None:
+            self._conn = self._make()
+        try:
+            self._conn.request('GET', self.prefix + path)
+            response = self._conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+        if response.will_close:
+            self.close()
+        return response.status, body
+
+    def get_json(self, path):
+        status, body = self.get(path)
+        if status != 200:
+            raise RuntimeError('GET {} failed with {}'.format(path, status))
+        return json.loads(body.decode('utf-8'))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def run(url, concurrency=(1, 4, 16, 64), duration=10, warmup=1,
+        routes=None, corpus_id=None, seed=0, log=None):
+    """
+    Load the API at *url* (e.g., "http://127.0.0.1:5000/v1") with each
+    number of threads in *concurrency* for *duration* seconds (after
+    *warmup* seconds that are not measured) and return the results as
+    a JSON-serializable dict. The requests use *routes* (names in
+    ROUTES) on the corpus *corpus_id* (default: the largest one).
+    """
+    routes = list(routes or DEFAULT_ROUTES)
+    client = _Client(url)
+    try:
+        corpus_id, ids = _pick_corpus(client, corpus_id)
+    finally:
+        client.close()
+    levels = []
+    if log is not None:
+        log(_header)
+    for n in concurrency:
+        if warmup:
+            _run_level(url, n, warmup, routes, corpus_id, ids, seed)
+        result = _run_level(url, n, duration, routes, corpus_id, ids, seed)
+        levels.append(result)
+        if log is not None:
+            log(_format_level(result))
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'url': url,
+        'parameters': {
+            'concurrency': list(concurrency), 'duration': duration,
+            'warmup': warmup, 'routes': routes, 'corpus_id': corpus_id,
+            'seed': seed
+        },
+        'results': levels
+    }
+
+
+def _pick_corpus(client, corpus_id):
+    # the corpus (by default the one with the most IGTs) and some of
+    # its IGT IDs
+    if corpus_id is None:
+        corpora = client.get_json('/corpora')['corpora']
+        if not corpora:
+            raise RuntimeError('The server has no corpora.')
+        corpus_id = max(corpora, key=lambda c: c['igt_count'])['id']
+    summary = client.get_json(
+        '/corpora/{}/summary?limit=1000'.format(corpus_id)
+    )
+    ids = [igt['id'] for igt in summary['igts']]
+    if not ids:
+        raise RuntimeError('Corpus {} has no IGTs.'.format(corpus_id))
+    return corpus_id, ids
+
+
+def _run_level(url, threads, duration, routes, corpus_id, ids, seed):
+    deadline = timer() + duration
+    port = _local_port(url)
+    queued = []  # listen queue lengths
+    # per thread: (latencies in seconds, errors, route counts)
+    outcomes = [([], [0], {}) for _ in range(threads)]
+
+    def work(i):
+        rng = random.Random('{}:{}:{}'.format(seed, threads, i))
+        latencies, errors, counts = outcomes[i]
+        client = _Client(url)
+        try:
+            while True:
+                route = rng.choice(routes)
+                path = ROUTES[route].format(
+                    corpus=corpus_id, igt=quote(rng.choice(ids))
+                )
+                start = timer()
+                if start >= deadline:
+                    break
+                try:
+                    status, _ = client.get(path)
+                except (OSError, http.client.HTTPException):
+                    status = None
+                latencies.append(timer() - start)
+                counts[route] = counts.get(route, 0) + 1
+                if status is None or status >= 400:
+                    errors[0] += 1
+        finally:
+            client.close()
+
+    def sample():
+        while timer() < deadline:
+            n = _listen_queue(port)
+            if n is None:
+                break
+            queued.append(n)
+            time.sleep(_SAMPLE_INTERVAL)
+
+    workers = [threading.Thread(target=work, args=(i,), daemon=True)
+               for i in range(threads)]
+    if port is not None:
+        workers.append(threading.Thread(target=sample, daemon=True))
+    start = timer()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = timer() - start
+
+    latencies = sorted(t for lats, _, _ in outcomes for t in lats)
+    routes_sent = {}
+    for _, _, counts in outcomes:
+        for route, n in counts.items():
+            routes_sent[route] = routes_sent.get(route, 0) + n
+    n = len(latencies)
+    return {
+        'concurrency': threads,
+        'seconds': elapsed,
+        'requests': n,
+        'errors': sum(errors[0] for _, errors, _ in outcomes),
+        'requests_per_second': n / elapsed if elapsed else 0.0,
+        'latency': {
+            'mean': sum(latencies) / n if n else None,
+            'p50': _percentile(latencies, 50),
+            'p90': _percentile(latencies, 90),
+            'p99': _percentile(latencies, 99),
+            'max': latencies[-1] if n else None
+        },
+        'routes': routes_sent,
+        'listen_queue': {
+            'mean': sum(queued) / len(queued),
+            'max': max(queued)
+        } if queued else None
+    }
+
+
+# seconds between samples of the listen queue
+_SAMPLE_INTERVAL = 0.01
+
+_local_hosts = ('localhost', '127.0.0.1', '::1')
+
+
+def _local_port(url):
+    # the port of a server on this machine, or None
+    parts = urlsplit(url)
+    if parts.hostname not in _local_hosts:
+        return None
+    return parts.port or (443 if parts.scheme == 'https' else 80)
+
+
+def _listen_queue(port):
+    # the number of connections waiting to be accepted by the sockets
+    # listening on *port*, or None if it can't be found (e.g., the
+    # system is not Linux)
+    queued = None
+    for name in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(name) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            # sl local_address rem_address st tx_queue:rx_queue ...; for
+            # a listening socket (st 0A), rx_queue is the accept queue
+            fields = line.split()
+            if (fields[3] == '0A'
+                    and int(fields[1].rpartition(':')[2], 16) == port):
+                queued = (queued or 0) + int(fields[4].partition(':')[2], 16)
+    return queued
+
+
+def _percentile(values, p):
+    # nearest-rank percentile of sorted *values*
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+_header = '{:>11} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+    'concurrency', 'requests', 'errors', 'req/s', 'p50 (ms)', 'p90 (ms)',
+    'p99 (ms)', 'max (ms)', 'queued'
+)
+
+
+def _format_level(result):
+    latency = result['latency']
+
+    def ms(seconds):
+        return '-' if seconds is None else '{:.2f}'.format(seconds * 1000)
+
+    queue = result['listen_queue']
+    return '{:>11} {:>9} {:>7} {:>9.1f} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+        result['concurrency'], result['requests'], result['errors'],
+        result['requests_per_second'], ms(latency['p50']),
+        ms(latency['p90']), ms(latency['p99']), ms(latency['max']),
+        '-' if queue is None else queue['max']
+    )
+
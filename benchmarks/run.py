@@ -0,0 +1,320 @@
+# Time the database interface methods and the REST routes on a
+# synthetic corpus and return the results as a JSON-serializable dict.
+#
+# Each benchmark runs a number of times and records the minimum,
+# median, mean, and maximum time in seconds. Benchmarks named "cold"
+# use a new database interface for each run, so nothing is cached in
+# memory, and those named "uncached" use one without a query cache.
+# Writes are timed on IGTs and corpora made for each run.
+
+import os
+import re
+import sys
+import math
+import random
+import shutil
+import platform
+import statistics
+from datetime import datetime, timezone
+from tempfile import mkdtemp
+from urllib.parse import urlencode
+from timeit import default_timer as timer
+
+from xigt.codecs import xigtjson
+
+import sleipnir
+from sleipnir.interfaces import FileSystemDbi, SqliteDbi
+
+from benchmarks.corpus import (
+    make_corpus, make_igt, language_codes, language_query,
+    language_fraction, QUERIES
+)
+
+backends = {
+    'filesystem': lambda path, **kw: FileSystemDbi(
+        os.path.join(path, 'db'), **kw),
+    'sqlite': lambda path, **kw: SqliteDbi(
+        os.path.join(path, 'db.sqlite'), **kw),
+}
+
+
+class Suite(object):
+    """
+    Runs benchmarks *repeat* times each and collects their timings;
+    benchmarks whose names don't match *pattern* (a regular
+    expression) are skipped.
+    """
+
+    def __init__(self, repeat=5, pattern=None, log=None):
+        self.repeat = repeat
+        self.pattern = re.compile(pattern) if pattern else None
+        self.log = log
+        self.results = {}
+
+    def time(self, name, func, setup=None, repeat=None):
+        """
+        Time `func(*setup(i))` (or `func()` without *setup*) for
+        each run i; *setup* is not timed.
+        """
+        if self.pattern is not None and not self.pattern.search(name):
+            return
+        times = []
+        for i in range(repeat or self.repeat):
+            args = setup(i) if setup is not None else ()
+            start = timer()
+            func(*args)
+            times.append(timer() - start)
+        self.results[name] = {
+            'runs': len(times),
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'max': max(times)
+        }
+        if self.log is not None:
+            self.log('{:<60} {:>10.6f}s'.format(name, min(times)))
+
+
+def run(backend='filesystem', igts=1000, tiers=3, items=5, languages=10,
+        repeat=5, pattern=None, seed=0, log=None):
+    params = {
+        'backend': backend, 'igts': igts, 'tiers': tiers, 'items': items,
+        'languages': languages, 'repeat': repeat, 'seed': seed
+    }
+    suite = Suite(repeat=repeat, pattern=pattern, log=log)
+    tmp = mkdtemp()
+    try:
+        make_dbi = lambda **kw: backends[backend](tmp, **kw)
+        dbi = make_dbi()
+        shape = dict(tiers=tiers, items=items, languages=languages)
+        start = timer()
+        corpus_id = dbi.add_corpus(
+            make_corpus(igts, seed=seed, **shape), name='bench'
+        )['id']
+        setup_time = timer() - start
+        _dbi_benchmarks(suite, dbi, make_dbi, corpus_id, params, shape)
+        _rest_benchmarks(suite, dbi, corpus_id, params, shape)
+    finally:
+        shutil.rmtree(tmp)
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'parameters': params,
+        'setup_seconds': setup_time,
+        'results': suite.results
+    }
+
+
+def _consume(iterable):
+    for _ in iterable:
+        pass
+
+
+def _check_queries(dbi, corpus_id, queries, igts):
+    # a query that matches nothing, or far from what it should, times
+    # the wrong thing; allow four standard deviations of the count
+    for label, path, fraction in queries:
+        count = len(dbi.get_igts(corpus_id, paths=[path]))
+        expected = fraction * igts
+        spread = 4 * math.sqrt(igts * fraction * (1 - fraction))
+        assert (count > 0 or fraction == 0) and \
+            abs(count - expected) <= spread, \
+            'query {} ({}) matched {} of {} IGTs; expected about {:.0f}' \
+            .format(label, path, count, igts, expected)
+
+
+def _dbi_benchmarks(suite, dbi, make_dbi, corpus_id, params, shape):
+    igts = params['igts']
+    rng = random.Random(params['seed'])
+    ids = ['i{}'.format(i) for i in range(igts)]
+    some_ids = rng.sample(ids, min(100, igts))
+    one_id = rng.choice(ids)
+    json_type = 'application/json'
+    lang = language_codes(params['languages'])[0]
+    lang_query = ('language', language_query(lang),
+                  language_fraction(params['languages']))
+    _check_queries(dbi, corpus_id, QUERIES + [lang_query], igts)
+
+    suite.time('dbi.list_corpora', dbi.list_corpora)
+    suite.time('dbi.corpus_summary', lambda: dbi.corpus_summary(corpus_id))
+    suite.time('dbi.corpus_summary[limit=100]',
+               lambda: dbi.corpus_summary(corpus_id, limit=100))
+    suite.time('dbi.get_stats', dbi.get_stats)
+    suite.time('dbi.get_version', lambda: dbi.get_version(corpus_id))
+    suite.time('dbi.get_version[igt]',
+               lambda: dbi.get_version(corpus_id, one_id))
+    suite.time('dbi.fetch_raw_corpus',
+               lambda: dbi.fetch_raw_corpus(corpus_id, json_type))
+    suite.time('dbi.iter_raw_corpus',
+               lambda: _consume(dbi.iter_raw_corpus(corpus_id, json_type)))
+    suite.time('dbi.get_corpus[full]',
+               lambda: dbi.get_corpus(corpus_id))
+    suite.time('dbi.get_corpus[transient]',
+               lambda: _consume(dbi.get_corpus(corpus_id, mode='transient')))
+    suite.time('dbi.get_igts', lambda: dbi.get_igts(corpus_id))
+    suite.time('dbi.get_igts[cold]', lambda db: db.get_igts(corpus_id),
+               setup=lambda i: (make_dbi(),))
+    suite.time('dbi.get_igts[ids=100]',
+               lambda: dbi.get_igts(corpus_id, ids=some_ids))
+    suite.time('dbi.get_igts[limit=100]',
+               lambda: dbi.get_igts(corpus_id, limit=100))
+    suite.time('dbi.get_igts[tiers=words]',
+               lambda: dbi.get_igts(corpus_id, tiers=['words']))
+    suite.time('dbi.get_igts[tiers=words,cold]',
+               lambda db: db.get_igts(corpus_id, tiers=['words']),
+               setup=lambda i: (make_dbi(),))
+    uncached = make_dbi(query_cache_size=0)
+    for label, path, _ in QUERIES:
+        suite.time('dbi.get_igts[path={}]'.format(label),
+                   lambda: dbi.get_igts(corpus_id, paths=[path]))
+        suite.time('dbi.get_igts[path={},uncached]'.format(label),
+                   lambda: uncached.get_igts(corpus_id, paths=[path]))
+        suite.time('dbi.get_igts[path={},cold]'.format(label),
+                   lambda db: db.get_igts(corpus_id, paths=[path]),
+                   setup=lambda i: (make_dbi(),))
+    suite.time('dbi.get_igts[path=language]',
+               lambda: dbi.get_igts(corpus_id, paths=[lang_query[1]]))
+    suite.time('dbi.iter_igts[path=50%,limit=10]',
+               lambda: _consume(dbi.iter_igts(
+                   corpus_id, paths=[QUERIES[3][1]], limit=10)))
+    suite.time('dbi.search[path=50%]',
+               lambda: _consume(dbi.search([QUERIES[3][1]])))
+    suite.time('dbi.search[path=50%,limit=10]',
+               lambda: _consume(dbi.search([QUERIES[3][1]], limit=10)))
+    suite.time('dbi.get_igt', lambda: dbi.get_igt(corpus_id, one_id))
+    suite.time('dbi.get_igt_batch[100]',
+               lambda: dbi.get_igt_batch([(corpus_id, i) for i in some_ids]))
+    suite.time('dbi.get_igt_batch[100,cold]',
+               lambda db: db.get_igt_batch([(corpus_id, i) for i in some_ids]),
+               setup=lambda i: (make_dbi(),))
+    suite.time('dbi.get_igt[cold]', lambda db: db.get_igt(corpus_id, one_id),
+               setup=lambda i: (make_dbi(),))
+
+    # writes; IDs for new IGTs start after the corpus's
+    counter = [igts]
+    def new_igts(n):
+        start = counter[0]
+        counter[0] += n
+        xc = make_corpus(n, seed=start, start=start, **shape)
+        return list(xc)
+    small = max(1, igts // 10)
+    suite.time('dbi.add_corpus[igts={}]'.format(small),
+               lambda xc: dbi.add_corpus(xc),
+               setup=lambda i: (make_corpus(small, seed=i, **shape),))
+    suite.time('dbi.add_corpora[3x{}]'.format(small),
+               lambda xcs: dbi.add_corpora(xcs),
+               setup=lambda i: ([make_corpus(small, seed=i, **shape)
+                                 for _ in range(3)],))
+    suite.time('dbi.add_igt', lambda igt: dbi.add_igt(corpus_id, igt),
+               setup=lambda i: (new_igts(1)[0],))
+    suite.time('dbi.add_igts[100]',
+               lambda batch: dbi.add_igts(corpus_id, batch),
+               setup=lambda i: (new_igts(100),))
+    rand = random.Random(params['seed'])
+    suite.time('dbi.set_igt',
+               lambda igt: dbi.set_igt(corpus_id, igt.id, igt),
+               setup=lambda i: (make_igt(rng.choice(ids), rand,
+                                         shape['tiers'], shape['items']),))
+    suite.time('dbi.patch_igt',
+               lambda igt_id: dbi.patch_igt(corpus_id, igt_id, [
+                   {'op': 'replace', 'path': '/tiers/t0/items/0/text',
+                    'value': 'patched'}
+               ]),
+               setup=lambda i: (rng.choice(ids),))
+    suite.time('dbi.del_igt', lambda igt_id: dbi.del_igt(corpus_id, igt_id),
+               setup=lambda i: (dbi.add_igt(corpus_id, new_igts(1)[0])['id'],))
+    suite.time('dbi.del_corpus', lambda cid: dbi.del_corpus(cid),
+               setup=lambda i: (dbi.add_corpus(
+                   make_corpus(small, seed=i, **shape))['id'],))
+    if hasattr(dbi, 'pack_corpus'):
+        suite.time('dbi.pack_corpus', lambda: dbi.pack_corpus(corpus_id),
+                   repeat=1)
+
+
+def _rest_benchmarks(suite, dbi, corpus_id, params, shape):
+    app = sleipnir.create_app(dbi=dbi)
+    _routes(suite, app.test_client(), corpus_id, params, shape)
+
+
+def _routes(suite, client, corpus_id, params, shape):
+    rng = random.Random(params['seed'])
+    ids = ['i{}'.format(i) for i in range(params['igts'])]
+    one_id = rng.choice(ids)
+    base = '/v1/corpora/' + corpus_id
+
+    def get(url, headers=None):
+        response = client.get(url, headers=headers)
+        response.get_data()  # streamed bodies are produced here
+        assert response.status_code in (200, 304), (url, response.status)
+
+    suite.time('GET /corpora', lambda: get('/v1/corpora'))
+    suite.time('GET /corpora/<id>', lambda: get(base))
+    suite.time('GET /corpora/<id>.xml', lambda: get(base + '.xml'))
+    etag = client.get(base).headers.get('ETag')
+    suite.time('GET /corpora/<id> [304]',
+               lambda: get(base, headers={'If-None-Match': etag}))
+    suite.time('GET /corpora/<id>/summary', lambda: get(base + '/summary'))
+    suite.time('GET /stats', lambda: get('/v1/stats'))
+    suite.time('GET /corpora/<id>/igts', lambda: get(base + '/igts'))
+    suite.time('GET /corpora/<id>/igts?limit=100',
+               lambda: get(base + '/igts?limit=100'))
+    suite.time('GET /corpora/<id>/igts?tiers=words',
+               lambda: get(base + '/igts?tiers=words'))
+    suite.time('GET /corpora/<id>/igts?id=...',
+               lambda: get(base + '/igts?id=' + ','.join(
+                   rng.sample(ids, min(100, len(ids))))))
+    for label, path, _ in QUERIES:
+        suite.time('GET /corpora/<id>/igts?path=[{}]'.format(label),
+                   lambda: client.get(base + '/igts',
+                                      query_string={'path': path}).get_data())
+    suite.time('GET /igts?id=...',
+               lambda: get('/v1/igts?id=' + ','.join(
+                   corpus_id + '/' + i
+                   for i in rng.sample(ids, min(100, len(ids))))))
+    suite.time('GET /search?path=[50%]',
+               lambda: get('/v1/search?' + urlencode({'path': QUERIES[3][1]})))
+    suite.time('GET /corpora/<id>/igts/<igt_id>',
+               lambda: get('{}/igts/{}'.format(base, one_id)))
+
+    small = max(1, params['igts'] // 10)
+    counter = [params['igts'] * 2]  # clear of the dbi benchmarks' IDs
+    def new_igts(n):
+        start = counter[0]
+        counter[0] += n
+        xc = make_corpus(n, seed=start, start=start, **shape)
+        return [xigtjson.encode_igt(igt) for igt in xc]
+    def post_corpus(body):
+        response = client.post('/v1/corpora', data=body,
+                               content_type='application/json')
+        assert response.status_code == 200, response.status
+        return response.get_json()['id']
+    suite.time('POST /corpora [igts={}]'.format(small), post_corpus,
+               setup=lambda i: (xigtjson.dumps(
+                   make_corpus(small, seed=i, **shape), indent=None),))
+    suite.time('POST /corpora/<id>/igts',
+               lambda obj: client.post(base + '/igts', json=obj),
+               setup=lambda i: (new_igts(1)[0],))
+    suite.time('POST /corpora/<id>/igts [100]',
+               lambda objs: client.post(base + '/igts', json=objs),
+               setup=lambda i: (new_igts(100),))
+    suite.time('PUT /corpora/<id>/igts/<igt_id>',
+               lambda obj: client.put(base + '/igts/' + obj['id'], json=obj),
+               setup=lambda i: (dict(new_igts(1)[0], id=rng.choice(ids)),))
+    suite.time('PATCH /corpora/<id>/igts/<igt_id>',
+               lambda igt_id: client.patch(base + '/igts/' + igt_id, json=[
+                   {'op': 'replace', 'path': '/tiers/t0/items/0/text',
+                    'value': 'patched'}
+               ]),
+               setup=lambda i: (rng.choice(ids),))
+    def add_igt(i):
+        obj = new_igts(1)[0]
+        client.post(base + '/igts', json=obj)
+        return (obj['id'],)
+    suite.time('DELETE /corpora/<id>/igts/<igt_id>',
+               lambda igt_id: client.delete(base + '/igts/' + igt_id),
+               setup=add_igt)
+    suite.time('DELETE /corpora/<id>',
+               lambda cid: client.delete('/v1/corpora/' + cid),
+               setup=lambda i: (post_corpus(xigtjson.dumps(
+                   make_corpus(small, seed=i, **shape), indent=None)),))
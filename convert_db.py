@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import sys
+import argparse
+import logging
+
+from sleipnir.interfaces import FileSystemDbi, SqliteDbi
+
+backends = {
+    'filesystem': FileSystemDbi,
+    'sqlite': SqliteDbi
+}
+
+def run(args):
+    source = backends[args.source_type](args.source)
+    target = backends[args.target_type](args.target)
+    return convert(source, target, args.corpora or None)
+
+def convert(source, target, corpus_ids=None):
+    """
+    Copy the corpora *corpus_ids* (default: all) from the *source*
+    database to *target*, keeping their IDs, names, and the languages
+    kept for their IGTs. Each corpus is added in one step, so an
+    interrupted copy leaves nothing of the corpus it was copying.
+    Corpora already in the target are skipped if they have as many
+    IGTs as in the source and reported otherwise. Return the number
+    of corpora that could not be copied.
+    """
+    corpora = dict((c['id'], c) for c in source.list_corpora())
+    copied = dict((c['id'], c) for c in target.list_corpora())
+    failed = 0
+    for corpus_id in corpus_ids or list(corpora):
+        if corpus_id not in corpora:
+            logging.error('Corpus %s not found in source.' % corpus_id)
+            failed += 1
+            continue
+        igt_count = corpora[corpus_id]['igt_count']
+        if corpus_id in copied:
+            if copied[corpus_id]['igt_count'] == igt_count:
+                logging.warning('Skipping corpus %s: already in target.'
+                                % corpus_id)
+            else:
+                logging.error(
+                    'Corpus %s has %d IGTs in the target but %d in the '
+                    'source; delete it from the target and run again.'
+                    % (corpus_id, copied[corpus_id]['igt_count'], igt_count)
+                )
+                failed += 1
+            continue
+        logging.info('Copying corpus %s.' % corpus_id)
+        # IGTs are decoded and written in batches as they are copied
+        xc = source.get_corpus(corpus_id, mode='transient')
+        result = target.add_corpora(
+            [xc], names=[corpora[corpus_id]['name']], ids=[corpus_id],
+            languages=[source.get_languages(corpus_id)]
+        )[0]
+        logging.info('Copied %d IGTs.' % result['igt_count'])
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Copy corpora from one Sleipnir database to another, '
+                    'e.g., from the filesystem backend to SQLite. Corpus '
+                    'IDs are kept; corpora already in the target are '
+                    'skipped if they are complete.'
+    )
+    parser.add_argument('-v', '--verbose',
+        action='count', dest='verbosity', default=2,
+        help='Increase the verbosity (can be repeated: -vvv).')
+    parser.add_argument('--from', dest='source_type',
+        choices=sorted(backends), default='filesystem',
+        help='type of the source database (default: filesystem)')
+    parser.add_argument('--to', dest='target_type',
+        choices=sorted(backends), default='sqlite',
+        help='type of the target database (default: sqlite)')
+    parser.add_argument('source', help='source database path')
+    parser.add_argument('target', help='target database path')
+    parser.add_argument('corpora', nargs='*',
+        help='IDs of corpora to copy (default: all corpora)')
+    args = parser.parse_args()
+    logging.basicConfig(level=50-(args.verbosity*10))
+    sys.exit(1 if run(args) else 0)
@@ -1,27 +1,175 @@
 #!/usr/bin/env python
 
 import os
+import json
 import argparse
 import logging
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from timeit import default_timer as timer
 
+from xigt import XigtCorpus
 from xigt.codecs import xigtxml
 from sleipnir import dbi
 
+def import_file(f, batch_size, progress=None, corpus_id=None):
+    """
+    Add the corpus in XigtXML file *f*, parsing its IGTs one at a time
+    and adding them *batch_size* at a time. If *corpus_id* is given,
+    resume an interrupted import into that corpus.
+    """
+    start = timer()
+    skip = 0
+    with open(f, 'rb') as fh:
+        # transient: IGTs are parsed as the corpus is iterated
+        xc = xigtxml.load(fh, mode='transient')
+        if corpus_id is None:
+            header = XigtCorpus(
+                attributes=xc.attributes, metadata=xc.metadata,
+                namespace=xc.namespace, nsmap=xc.nsmap
+            )
+            name = os.path.splitext(os.path.basename(f))[0]
+            corpus_id = dbi.add_corpus(header, name=name)['id']
+            log_progress(progress, {'file': f, 'id': corpus_id})
+        else:
+            # batches are added atomically, so the corpus has some
+            # number of the file's first IGTs
+            skip = igt_count(corpus_id)
+        igts = iter(xc)
+        for _ in islice(igts, skip):
+            pass
+        count = 0
+        while True:
+            batch = list(islice(igts, batch_size))
+            if not batch:
+                break
+            dbi.add_igts(corpus_id, batch)
+            count += len(batch)
+    log_progress(progress, {'file': f, 'id': corpus_id, 'done': True})
+    return {
+        'file': f,
+        'id': corpus_id,
+        'igt_count': count,
+        'skipped': skip,
+        'bytes': os.path.getsize(f),
+        'seconds': timer() - start
+    }
+
+def igt_count(corpus_id):
+    for corpus in dbi.list_corpora():
+        if corpus['id'] == corpus_id:
+            return corpus['igt_count']
+    return 0
+
+def log_progress(path, record):
+    # records are short single lines, so appends from several
+    # processes don't interleave
+    if path is not None:
+        record['file'] = os.path.abspath(record['file'])
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+def read_progress(path):
+    # return the corpus ID of each file that was started and the set
+    # of files that were finished
+    started, done = {}, set()
+    if path is None or not os.path.exists(path):
+        return started, done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # cut short by an interruption
+            if record.get('done'):
+                done.add(record['file'])
+            else:
+                started[record['file']] = record['id']
+    # a started corpus may since have been deleted
+    corpus_ids = set(c['id'] for c in dbi.list_corpora())
+    started = dict(
+        (f, cid) for f, cid in started.items() if cid in corpus_ids
+    )
+    return started, done
+
+def report(result):
+    seconds = max(result['seconds'], 1e-6)
+    print('{}: {} IGTs in {:.1f}s ({:.0f} IGTs/s, {:.1f} MB/s){}'.format(
+        result['file'],
+        result['igt_count'],
+        seconds,
+        result['igt_count'] / seconds,
+        result['bytes'] / seconds / 1e6,
+        ' (resumed after {})'.format(result['skipped'])
+        if result['skipped'] else ''
+    ))
+
 def run(args):
+    started, done = read_progress(args.resume)
+    files = []
     for f in args.files:
-        logging.info('Adding %s to database.' % f)
-        xc = xigtxml.load(f)
-        name = os.path.splitext(os.path.basename(f))[0]
-        dbi.add_corpus(xc, name=name)
+        if os.path.abspath(f) in done:
+            logging.info('Skipping %s: already imported.' % f)
+        else:
+            files.append(f)
+    jobs = [
+        (f, args.batch_size, args.resume, started.get(os.path.abspath(f)))
+        for f in files
+    ]
+    start = timer()
+    results = []
+    failed = 0
+    if args.jobs > 1:
+        with ProcessPoolExecutor(args.jobs) as pool:
+            futures = dict(
+                (pool.submit(import_file, *job), job[0]) for job in jobs
+            )
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as ex:
+                    logging.error('Could not import %s: %s'
+                                  % (futures[future], ex))
+                    failed += 1
+                else:
+                    report(results[-1])
+    else:
+        for job in jobs:
+            logging.info('Adding %s to database.' % job[0])
+            try:
+                results.append(import_file(*job))
+            except Exception as ex:
+                logging.error('Could not import %s: %s' % (job[0], ex))
+                failed += 1
+            else:
+                report(results[-1])
+    seconds = max(timer() - start, 1e-6)
+    count = sum(r['igt_count'] for r in results)
+    nbytes = sum(r['bytes'] for r in results)
+    print('Imported {} IGTs from {} files in {:.1f}s '
+          '({:.0f} IGTs/s, {:.1f} MB/s); {} failed, {} skipped'.format(
+              count, len(results), seconds, count / seconds,
+              nbytes / seconds / 1e6, failed, len(args.files) - len(files)
+          ))
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        description='Add XigtXML corpora to the database. Files are '
+                    'parsed incrementally, so a corpus need not fit in '
+                    'memory, and several files can be added at once.'
+    )
     parser.add_argument('-v', '--verbose',
         action='count', dest='verbosity', default=2,
         help='Increase the verbosity (can be repeated: -vvv).')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of files to import in parallel processes (default: 1)')
+    parser.add_argument('--batch-size', type=int, default=1000,
+        help='number of IGTs to write at a time (default: 1000)')
+    parser.add_argument('--resume', metavar='LOG',
+        help='record progress in LOG, and skip or continue the files '
+             'that an earlier run with the same LOG finished or started')
     # parser.add_argument('dbdir', help='Database directory')
     parser.add_argument('files', nargs='*', help='files to add to the db')
     args = parser.parse_args()
     logging.basicConfig(level=50-(args.verbosity*10))
     run(args)
-
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+
+from sleipnir import dbi
+
+def run(args):
+    corpus_ids = args.corpora or [c['id'] for c in dbi.list_corpora()]
+    for corpus_id in corpus_ids:
+        logging.info('Packing corpus %s.' % corpus_id)
+        result = dbi.pack_corpus(corpus_id, codec=args.codec)
+        logging.info(
+            'Packed %d IGTs into %s (%s).'
+            % (result['igt_count'], result['data_file'], result['codec'])
+        )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert corpora to the packed single-file layout. '
+                    'Corpora that are already packed are compacted.'
+    )
+    parser.add_argument('-v', '--verbose',
+        action='count', dest='verbosity', default=2,
+        help='Increase the verbosity (can be repeated: -vvv).')
+    parser.add_argument('--codec',
+        help='re-encode the IGT records with this codec, e.g., none, '
+             'gzip:1, or lzma (default: keep each corpus\'s codec)')
+    parser.add_argument('corpora', nargs='*',
+        help='IDs of corpora to convert (default: all corpora)')
+    args = parser.parse_args()
+    logging.basicConfig(level=50-(args.verbosity*10))
+    run(args)
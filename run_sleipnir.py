@@ -1,20 +1,41 @@
 #!/usr/bin/env python
 
-from flask import Flask
+import logging
+import argparse
+
 import sleipnir
+from sleipnir import config
+
+# for WSGI servers, e.g., gunicorn 'run_sleipnir:app'
+app = sleipnir.create_app()
 
-# maybe constrain this to known origins to avoid excessive requests
-cors_origin = '*'
 
-app = Flask(__name__)
-app.register_blueprint(sleipnir.v1, url_prefix='/v1')
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve the Sleipnir REST API.'
+    )
+    parser.add_argument('--host', default=config.SERVER_HOST,
+        help='address to listen on (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int, default=config.SERVER_PORT,
+        help='port to listen on (default: %(default)s)')
+    parser.add_argument('-t', '--threads', type=int,
+        default=config.SERVER_THREADS,
+        help='number of request threads (default: %(default)s)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help="don't log each request")
+    parser.add_argument('--debug', action='store_true',
+        help="use Flask's development server, which reloads changed code")
+    args = parser.parse_args()
 
-@app.after_request
-def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', cors_origin)
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Accept,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
-    return response
+    if args.quiet:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    if args.debug:
+        app.run(host=args.host, port=args.port, debug=True)
+    else:
+        from sleipnir.server import serve
+        serve(app, host=args.host, port=args.port, threads=args.threads,
+              backlog=config.SERVER_BACKLOG)
 
 
-app.run(debug=True)
+if __name__ == '__main__':
+    main()
@@ -10,10 +10,75 @@ from sleipnir import config
 dbi = None
 if config.DATABASE == 'filesystem':
     from sleipnir.interfaces import FileSystemDbi
-    dbi = FileSystemDbi(config.DATABASE_PATH)
+    dbi = FileSystemDbi(
+        config.DATABASE_PATH,
+        index_cache_size=config.INDEX_CACHE_SIZE,
+        igt_cache_bytes=config.IGT_CACHE_BYTES,
+        query_workers=config.QUERY_WORKERS,
+        query_chunk_size=config.QUERY_CHUNK_SIZE,
+        query_cache_size=config.QUERY_CACHE_SIZE,
+        query_cache_bytes=config.QUERY_CACHE_BYTES,
+        journal_limit=config.INDEX_JOURNAL_LIMIT,
+        codec=config.RECORD_CODEC
+    )
+elif config.DATABASE == 'sqlite':
+    from sleipnir.interfaces import SqliteDbi
+    dbi = SqliteDbi(
+        config.DATABASE_PATH,
+        igt_cache_bytes=config.IGT_CACHE_BYTES,
+        query_cache_size=config.QUERY_CACHE_SIZE,
+        query_cache_bytes=config.QUERY_CACHE_BYTES
+    )
 else:
     raise ValueError('Invalid database type: {}'.format(config.DATABASE))
 
+render_cache = None
+if config.RENDER_CACHE_PATH is not None:
+    from sleipnir.cache import RenderCache
+    render_cache = RenderCache(
+        config.RENDER_CACHE_PATH,
+        maxbytes=config.RENDER_CACHE_BYTES
+    )
+
+request_metrics = None
+if config.METRICS:
+    from sleipnir.metrics import Metrics
+    request_metrics = Metrics()
+
+
+def create_app(cors_origin=None, dbi=None, render_cache=None):
+    """
+    Return a Flask application serving the v1 API under /v1, for any
+    WSGI server (e.g., `gunicorn 'sleipnir:create_app()'`).
+    Cross-origin requests are allowed from *cors_origin* (default:
+    config.CORS_ORIGIN). The app serves the database interface *dbi*
+    (default: the configured one) and caches rendered corpora in
+    *render_cache*, which defaults to the configured cache only for
+    the configured database, as cached corpora belong to it.
+    """
+    from flask import Flask
+    import sleipnir
+    if cors_origin is None:
+        cors_origin = config.CORS_ORIGIN
+    if dbi is None:
+        dbi = sleipnir.dbi
+        if render_cache is None:
+            render_cache = sleipnir.render_cache
+    app = Flask(__name__)
+    app.extensions['sleipnir'] = {'dbi': dbi, 'render_cache': render_cache}
+    app.register_blueprint(v1, url_prefix='/v1')
+
+    if cors_origin is not None:
+        @app.after_request
+        def add_cors_headers(response):
+            response.headers.add('Access-Control-Allow-Origin', cors_origin)
+            response.headers.add('Access-Control-Allow-Headers',
+                                 'Content-Type,Accept,Authorization')
+            response.headers.add('Access-Control-Allow-Methods',
+                                 'GET,POST,PUT,PATCH,DELETE,OPTIONS')
+            return response
+
+    return app
 
 # the following imports are circular; do them at the end!
 
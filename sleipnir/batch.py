@@ -0,0 +1,88 @@
+# Getting IGTs from several corpora at once (get_igt_batch() and
+# GET /v1/igts).
+#
+# The requested (corpus ID, IGT ID) pairs are grouped by corpus, so
+# each corpus's index is looked up once, and the groups (in chunks of
+# up to _CHUNK_SIZE IGTs) are read by a few threads at once. A missing
+# corpus or IGT only fails its own items: each item of the result has
+# either the IGT or an error.
+
+from concurrent.futures import ThreadPoolExecutor
+
+from sleipnir.errors import SleipnirError
+
+# IGTs of one corpus read by a thread at a time
+_CHUNK_SIZE = 100
+
+
+def get_igt_batch(dbi, pairs, fetch, projection=None, workers=4):
+    """
+    Return a dict for each (corpus ID, IGT ID) pair in *pairs*, in
+    order, with the "corpus_id" and "id" and either the "igt" or an
+    "error" (a dict with the "message" and "status_code"). *fetch* is
+    called as `fetch(corpus_id, ids, projection)` in up to *workers*
+    threads and returns a dict of the IGTs found among *ids*.
+    """
+    pairs = [_check_pair(pair) for pair in pairs]
+    known = set(entry['id'] for entry in dbi.list_corpora())
+    groups = {}
+    for corpus_id, igt_id in pairs:
+        if corpus_id in known:
+            groups.setdefault(corpus_id, {})[igt_id] = None
+    tasks = []
+    for corpus_id, ids in groups.items():
+        ids = list(ids)  # unique, in order
+        for i in range(0, len(ids), _CHUNK_SIZE):
+            tasks.append((corpus_id, ids[i:i+_CHUNK_SIZE]))
+
+    found = {}  # corpus ID: {IGT ID: IGT}
+    errors = {}  # corpus ID: error for the whole corpus
+    def run(task):
+        corpus_id, ids = task
+        try:
+            return corpus_id, fetch(corpus_id, ids, projection), None
+        except SleipnirError as ex:
+            # e.g., the corpus was deleted in the meantime
+            return corpus_id, {}, ex
+    if tasks:
+        with ThreadPoolExecutor(
+                max_workers=max(1, min(workers, len(tasks))),
+                thread_name_prefix='sleipnir-batch') as pool:
+            for corpus_id, igts, error in pool.map(run, tasks):
+                found.setdefault(corpus_id, {}).update(igts)
+                if error is not None:
+                    errors[corpus_id] = error
+
+    results = []
+    for corpus_id, igt_id in pairs:
+        result = {'corpus_id': corpus_id, 'id': igt_id}
+        igt = found.get(corpus_id, {}).get(igt_id)
+        if igt is not None:
+            result['igt'] = igt
+        elif corpus_id not in known:
+            result['error'] = _error(
+                'Corpus not found: {}'.format(corpus_id), 404
+            )
+        elif corpus_id in errors:
+            error = errors[corpus_id]
+            result['error'] = _error(error.message, error.status_code)
+        else:
+            result['error'] = _error(
+                'IGT not found: {}'.format(igt_id), 404
+            )
+        results.append(result)
+    return results
+
+
+def _check_pair(pair):
+    if (not isinstance(pair, (list, tuple)) or len(pair) != 2
+            or not all(isinstance(x, str) for x in pair)):
+        raise SleipnirError(
+            'Invalid (corpus ID, IGT ID) pair: {!r}'.format(pair),
+            status_code=400
+        )
+    return tuple(pair)
+
+
+def _error(message, status_code):
+    return {'message': message, 'status_code': status_code}
@@ -0,0 +1,243 @@
+# Caches used by the database backends (in-process) and by the views
+# (rendered corpora on disk).
+
+import os
+from collections import OrderedDict
+from threading import RLock
+from tempfile import mkstemp
+
+
+class LRUCache(object):
+    """
+    A mapping that holds at most *maxsize* entries whose sizes (as
+    given to put()) total at most *maxbytes*, evicting the least
+    recently used entries when either limit is exceeded; a limit of
+    `None` is unbounded. Lookups are counted as hits or misses so the
+    cache's effectiveness can be inspected with info().
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None, check=None):
+        """
+        Return the value for *key*, or *default* if it is not cached.
+        If *check* is given, it is called with the cached value and a
+        false return value drops the entry as stale.
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if check is not None and not check(value):
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0):
+        with self._lock:
+            self._remove(key)
+            if self.maxbytes is not None and size > self.maxbytes:
+                return  # would evict everything else and itself
+            self._data[key] = value
+            self._sizes[key] = size
+            self.nbytes += size
+            while ((self.maxsize is not None
+                    and len(self._data) > self.maxsize)
+                   or (self.maxbytes is not None
+                       and self.nbytes > self.maxbytes)):
+                self._remove(next(iter(self._data)))
+
+    def discard(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def discard_if(self, predicate):
+        """Remove every entry whose key satisfies *predicate*."""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def _remove(self, key):
+        if key in self._data:
+            del self._data[key]
+            self.nbytes -= self._sizes.pop(key)
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'bytes': self.nbytes,
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / lookups) if lookups else 0.0
+        }
+
+
+class RenderCache(object):
+    """
+    Rendered corpus bodies stored as files under *path*, keyed by
+    corpus ID, corpus version, and mimetype. An entry is written while
+    the corpus is first streamed to a client and only kept if the whole
+    corpus was rendered. Since a mutation gives the corpus a new
+    version, outdated entries are never served; they are removed when
+    the new version is stored or the corpus is deleted. When the
+    entries total more than *maxbytes*, the least recently used are
+    removed. Several processes may share the directory.
+    """
+
+    extensions = {'application/json': 'json', 'application/xml': 'xml'}
+
+    def __init__(self, path, maxbytes=None, chunk_size=64 * 1024):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.chunk_size = chunk_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, corpus_id, version, mimetype):
+        version, modified = version
+        # the modification time distinguishes a corpus that was
+        # deleted and added again with the same ID
+        return '{}.{}-{}.{}'.format(
+            corpus_id, version, int((modified or 0) * 1e6),
+            self.extensions[mimetype]
+        )
+
+    def get(self, corpus_id, version, mimetype):
+        """
+        Return an iterator over the cached body (as bytes) of the given
+        version of a corpus, or `None` if it is not cached.
+        """
+        if mimetype not in self.extensions:
+            return None
+        path = os.path.join(
+            self.path, self._filename(corpus_id, version, mimetype)
+        )
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            os.utime(path)  # for the least-recently-used order
+        except OSError:
+            pass
+        return self._iter_file(f)
+
+    def _iter_file(self, f):
+        with f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def fill(self, corpus_id, version, mimetype, body):
+        """
+        Yield the strings from *body* while storing them as the given
+        version of a corpus; nothing is stored if *body* is not
+        consumed to the end.
+        """
+        if mimetype not in self.extensions:
+            yield from body
+            return
+        filename = self._filename(corpus_id, version, mimetype)
+        fd, tmp = mkstemp(dir=self.path, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for s in body:
+                    f.write(s.encode('utf-8'))
+                    yield s
+            os.replace(tmp, os.path.join(self.path, filename))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        # other representations of this version are still current
+        current = filename.rpartition('.')[0] + '.'
+        self._remove_entries(
+            lambda fn: fn.startswith(corpus_id + '.')
+            and not fn.startswith(current)
+        )
+        self._evict()
+
+    def discard(self, corpus_id):
+        """Remove every cached version of a corpus."""
+        self._remove_entries(lambda fn: fn.startswith(corpus_id + '.'))
+
+    def clear(self):
+        self._remove_entries(lambda fn: True)
+
+    def _entries(self):
+        # (filename, stat) of each complete entry
+        entries = []
+        for fn in os.listdir(self.path):
+            if fn.startswith('.'):
+                continue
+            try:
+                entries.append((fn, os.stat(os.path.join(self.path, fn))))
+            except FileNotFoundError:
+                pass  # removed by another process
+        return entries
+
+    def _remove_entries(self, predicate):
+        for fn, _ in self._entries():
+            if predicate(fn):
+                try:
+                    os.remove(os.path.join(self.path, fn))
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self):
+        if self.maxbytes is None:
+            return
+        entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+        nbytes = sum(st.st_size for _, st in entries)
+        for fn, st in entries:
+            if nbytes <= self.maxbytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, fn))
+            except FileNotFoundError:
+                pass
+            nbytes -= st.st_size
+
+    def info(self):
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            'size': len(entries),
+            'bytes': sum(st.st_size for _, st in entries),
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / lookups) if lookups else 0.0
+        }
@@ -4,3 +4,57 @@ DATABASE = 'filesystem'
 
 # default config data
 DATABASE_PATH = 'db/'
+
+# number of parsed corpus indexes kept in memory
+INDEX_CACHE_SIZE = 32
+
+# approximate memory limit (in bytes) for decoded IGTs kept in memory
+IGT_CACHE_BYTES = 64 * 1024 * 1024
+
+# number of worker processes for path queries (0 disables parallel
+# queries), and the number of IGTs given to a worker at a time
+QUERY_WORKERS = 0
+QUERY_CHUNK_SIZE = 1000
+
+# number of path query results (the matching IGT IDs and their query
+# results for a version of a corpus) kept in memory (0 disables the
+# cache), and their approximate memory limit in bytes
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_BYTES = 32 * 1024 * 1024
+
+# number of corpora queried at once by a search across corpora
+SEARCH_WORKERS = 4
+
+# number of threads reading IGTs for a request for IGTs of several
+# corpora
+BATCH_WORKERS = 4
+
+# size in bytes at which an index journal is compacted into a snapshot
+INDEX_JOURNAL_LIMIT = 1024 * 1024
+
+# compression of the IGT records of new corpora: "none", "gzip", "zlib",
+# "bz2", or "lzma", optionally with a level (e.g., "gzip:1")
+RECORD_CODEC = 'gzip'
+
+# directory for rendered corpora (None disables the cache), and the
+# approximate limit in bytes for the files kept there; the cache is
+# opt-in, as it is only useful to a server and takes disk space
+RENDER_CACHE_PATH = None
+RENDER_CACHE_BYTES = 1024 * 1024 * 1024
+
+# collect per-route and per-stage request metrics for /v1/metrics, and
+# add each request's stage times to its response as a Server-Timing
+# header (either records the stages of every request)
+METRICS = False
+SERVER_TIMING = False
+
+# address, port, number of request threads, and listen queue length of
+# the server started by run_sleipnir.py
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 5000
+SERVER_THREADS = 16
+SERVER_BACKLOG = 128
+
+# origin allowed to make cross-origin requests (None sends no CORS
+# headers)
+CORS_ORIGIN = '*'
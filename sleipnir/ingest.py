@@ -0,0 +1,186 @@
+# Incremental parsing of uploaded corpora.
+#
+# load_corpus() reads a XigtXML or XigtJSON corpus from a binary
+# stream and returns a transient XigtCorpus: the corpus-level data is
+# read up front, but IGTs are parsed one at a time as the corpus is
+# iterated, so only the IGT being decoded (and a bounded read buffer)
+# is held in memory however large the upload is.
+
+import json
+from codecs import getincrementaldecoder
+from xml.etree.ElementTree import ParseError
+
+from xigt import XigtCorpus
+from xigt.codecs import xigtxml, xigtjson
+
+from sleipnir.errors import SleipnirError
+
+
+def load_corpus(stream, mimetype):
+    if mimetype == 'application/xml':
+        return _load_xml_corpus(stream)
+    elif mimetype == 'application/json':
+        return _load_json_corpus(stream)
+    else:
+        raise SleipnirError(
+            'Unsupported mimetype: %s' % mimetype, status_code=400
+        )
+
+
+def _unparseable(ex):
+    return SleipnirError(
+        'Unparseable Xigt corpus: {}'.format(ex), status_code=400
+    )
+
+
+def _load_xml_corpus(stream):
+    try:
+        # xigtxml's transient mode already parses incrementally
+        xc = xigtxml.load(stream, mode='transient')
+    except (ParseError, StopIteration, AssertionError) as ex:
+        raise _unparseable(ex)
+    return XigtCorpus(
+        attributes=xc.attributes, metadata=xc.metadata,
+        namespace=xc.namespace, nsmap=xc.nsmap,
+        igts=_reraise_errors(xc), mode='transient'
+    )
+
+
+def _reraise_errors(igts):
+    # errors in the rest of the upload only show up as it is iterated
+    try:
+        for igt in igts:
+            yield igt
+    except (ParseError, AssertionError, ValueError) as ex:
+        raise _unparseable(ex)
+
+
+def _load_json_corpus(stream):
+    reader = _JsonReader(stream)
+    header = {}
+    try:
+        reader.expect('{')
+        while reader.peek() != '}':
+            if header:
+                reader.expect(',')
+            key = reader.value()
+            reader.expect(':')
+            if key == 'igts':
+                break
+            header[key] = reader.value()
+        else:
+            reader.expect('}')
+            reader.end()
+            return xigtjson.decode(header, mode='transient')
+    except ValueError as ex:
+        raise _unparseable(ex)
+    # the IGTs are decoded in the context of the corpus, so the
+    # corpus-level data must come before them (as xigtjson writes it)
+    xc = xigtjson.decode(header)
+    nsmap = xigtjson.active_namespaces(header, None)
+    return XigtCorpus(
+        attributes=xc.attributes, metadata=xc.metadata,
+        namespace=xc.namespace, nsmap=xc.nsmap,
+        igts=_iter_json_igts(reader, nsmap), mode='transient'
+    )
+
+
+def _iter_json_igts(reader, nsmap):
+    try:
+        reader.expect('[')
+        if reader.peek() == ']':
+            reader.expect(']')
+        else:
+            while True:
+                yield xigtjson.decode_igt(reader.value(), nsmap)
+                if reader.peek() == ']':
+                    reader.expect(']')
+                    break
+                reader.expect(',')
+        if reader.peek() != '}':
+            raise ValueError(
+                'corpus data after "igts" cannot be streamed; '
+                'put "igts" last'
+            )
+        reader.expect('}')
+        reader.end()
+    except (ValueError, AttributeError, TypeError) as ex:
+        raise _unparseable(ex)
+
+
+class _JsonReader(object):
+    """
+    Reads the tokens and values of a JSON document from a binary
+    stream, a chunk at a time. Only the structure the caller steps
+    through (with peek() and expect()) is parsed by hand; each value()
+    is decoded by the json module from the buffered text.
+    """
+
+    def __init__(self, stream, chunk_size=64 * 1024,
+                 max_value_size=64 * 1024 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        # a malformed value would otherwise be buffered until the end
+        # of the stream
+        self.max_value_size = max_value_size
+        self._decoder = json.JSONDecoder()
+        self._utf8 = getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        # read more text, at least as much as is buffered so that a
+        # large value is re-scanned only a few times
+        if self._eof:
+            return False
+        size = max(self.chunk_size, len(self._buf) - self._pos)
+        data = self.stream.read(size)
+        self._eof = not data
+        self._buf = self._buf[self._pos:] + self._utf8.decode(
+            data, final=self._eof
+        )
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-space character, or '' at the end."""
+        while True:
+            buf = self._buf
+            pos = self._pos
+            while pos < len(buf) and buf[pos] in ' \t\n\r':
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(
+                'expected {!r} but found {!r}'.format(char, found or 'EOF')
+            )
+        self._pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if len(self._buf) - self._pos > self.max_value_size:
+                    raise ValueError('malformed or oversized JSON value')
+                if not self._fill():
+                    raise
+                continue
+            # a number may continue in the next chunk
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return obj
+
+    def end(self):
+        if self.peek() != '':
+            raise ValueError('extra data after the corpus')
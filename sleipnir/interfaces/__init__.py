@@ -1,3 +1,4 @@
 
 from sleipnir.interfaces.base import SleipnirDatabaseInterface
 from sleipnir.interfaces.filesystem import FileSystemDbi
+from sleipnir.interfaces.sqlite import SqliteDbi
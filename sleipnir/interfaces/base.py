@@ -1,18 +1,31 @@
+from sleipnir import search
 
 class SleipnirDatabaseInterface(object):
     raw_formats = []
     def __init__(self, path):
         self.path = path
     def list_corpora(self): raise NotImplementedError()
-    def corpus_summary(self, cid): raise NotImplementedError()
-    def fetch_raw_corpus(self, cid): raise NotImplementedError()
+    def corpus_summary(self, cid, **kwargs): raise NotImplementedError()
+    def get_stats(self): raise NotImplementedError()
+    def get_version(self, cid=None, iid=None): raise NotImplementedError()
+    def get_languages(self, cid): raise NotImplementedError()
+    def fetch_raw_corpus(self, cid, mimetype): raise NotImplementedError()
+    def iter_raw_corpus(self, cid, mimetype):
+        return iter([self.fetch_raw_corpus(cid, mimetype)])
     def get_corpus(self, cid, **kwargs): raise NotImplementedError()
     def get_igts(self, cid, **kwargs): raise NotImplementedError()
+    def iter_igts(self, cid, **kwargs):
+        return iter(self.get_igts(cid, **kwargs))
     def get_igt(self, cid, iid, **kwargs):
-        return self.get_igts(cid, ids=[iid])[0]
+        return self.get_igts(cid, ids=[iid], **kwargs)[0]
+    def search(self, paths, **kwargs):
+        return search.search(self, paths, **kwargs)
+    def get_igt_batch(self, pairs, **kwargs): raise NotImplementedError()
     def add_corpora(self, xcs, **kwargs): raise NotImplementedError()
     def add_igts(self, cid, igts, **kwargs): raise NotImplementedError()
     def set_corpus(self, cid, xc, **kwargs): raise NotImplementedError()
     def set_igt(self, cid, iid, igt, **kwargs): raise NotImplementedError()
+    def patch_corpus(self, cid, operations): raise NotImplementedError()
+    def patch_igt(self, cid, iid, operations): raise NotImplementedError()
     def delete_corpus(self, cid): raise NotImplementedError()
     def delete_igt(self, cid, iid): raise NotImplementedError()
@@ -12,45 +12,280 @@
 # to the corpus, and PATH is the corpus's path relative to
 # DATABASE_PATH.
 #
+# Each corpus directory contains its own `index.json.gz` (the corpus
+# with its IGTs replaced by index entries) and a single packed data
+# file (named by the index's "data_file" key) holding every IGT as an
+# independently compressed XigtJSON record. The index entry for an IGT
+# gives the "offset" and "length" of its record in the data file, so
+# any IGT can be read without touching the others. Older corpora
+# stored one `<id>.json.gz` file per IGT (the entry had a "path" key
+# instead); these are still readable, and pack_corpus() converts them.
+#
+# The index's "codec" key names how the records are compressed: a
+# method ("none", "gzip", "zlib", "bz2", or "lzma") optionally followed
+# by a level, e.g., "gzip:1". Indexes without the key are from before
+# codecs were recorded and use "gzip". New corpora get the database's
+# codec; pack_corpus() can re-encode a corpus with another one.
+#
+# Both kinds of index keep statistics under "stats": a corpus index
+# has its IGT, tier, and item counts, the number of IGTs per language
+# code and name, and the number of tiers of each type, and the primary
+# index has the same totalled over every corpus (each corpus's own are
+# in its entry). IGT index entries record what they add to these, so
+# the statistics are updated as entries are added, replaced, or
+# removed, and never need a scan of the IGTs.
+#
+# Both kinds of index are stored as a snapshot (`index.json.gz`) plus
+# an append-only journal (`index.N.journal`, where N is the snapshot's
+# "journal" value) of JSON records, one per line, describing the
+# changes made since the snapshot. Loading an index replays its
+# journal (and any later one) over the snapshot. Once a journal grows
+# past a size limit, it is folded into a new snapshot in a background
+# thread while new changes go to the next journal.
+#
+# Several processes (e.g., WSGI workers) may share a database. Each
+# index directory has an `index.lock` file: writers hold an exclusive
+# lock on it while they bring their copy of the index up to date and
+# append to the journal, and readers hold a shared lock while reading
+# the index files. Before an index is used, its files are stat'ed to
+# see if another process changed it, and only new journal records are
+# read unless the snapshot was replaced. Threads of one process (e.g.,
+# a threaded server) also take a lock per index directory, so reading
+# or writing one corpus's files doesn't block requests for others, and
+# IGT records are read without any lock.
+#
 
 import os
+import re
+import time
 import shutil
-from tempfile import mkdtemp
+import mmap
+from tempfile import mkdtemp, mkstemp
 from uuid import uuid4
 from base64 import urlsafe_b64encode
 import gzip
+import zlib
+import bz2
 import json
-from collections import defaultdict
+from itertools import islice
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock, RLock, Thread
+try:
+    import fcntl
+except ImportError:  # file locking is not available (e.g., on Windows)
+    fcntl = None
+
+try:
+    import lzma
+except ImportError:  # Python may be built without it
+    lzma = None
 
-from xigt import xigtpath as xp, Item, Metadata, Meta
+from xigt import xigtpath as xp, XigtCorpus
 from xigt.codecs import xigtjson
 
+from sleipnir import metrics, patch, batch
 from sleipnir.interfaces import SleipnirDatabaseInterface
 from sleipnir.errors import SleipnirDbError, SleipnirError
+from sleipnir.cache import LRUCache
+from sleipnir.query import (
+    igt_features, path_features, query_hits, iter_hits, fill_matches,
+    normalize_paths, add_results, matches_size
+)
+from sleipnir.projection import make_projection, project_record
 
 
 class FileSystemDbi(SleipnirDatabaseInterface):
     raw_formats = ['application/json']
 
-    def __init__(self, path):
+    def __init__(self, path, index_cache_size=32, igt_cache_bytes=None,
+                 query_workers=0, query_chunk_size=1000,
+                 query_cache_size=256, query_cache_bytes=None,
+                 journal_limit=1024*1024, codec='gzip'):
         SleipnirDatabaseInterface.__init__(self, path)
+        # records of new corpora are compressed with codec
+        _parse_codec(codec)
+        self.codec = codec
         # if DB doesn't exist; create a bare one
         if not os.path.isdir(path):
-            os.mkdir(path)
-            _dump_index({'corpora': {}}, path)
-            os.mkdir(os.path.join(path, 'data'))
-        self.index = _load_index(self.path)  # primary index
-
-    def _update_index_entry(self, corpus_id,
-                            name=None, path=None, igt_count=None):
-        entry = self.index['corpora'].get(
-            corpus_id, {'name': None, 'path': None, 'igt_count': None}
+            _make_database(path)
+        # state of the primary index; see the index property
+        self._main = None
+        # parsed corpus indexes (as states), keyed by corpus directory
+        self._indexes = LRUCache(maxsize=index_cache_size)
+        # decoded IGTs, keyed by (corpus_id, igt_id, version)
+        self._igts = LRUCache(maxsize=None, maxbytes=igt_cache_bytes)
+        # feature-to-IGT-ID maps for cached corpus indexes
+        self._feature_maps = LRUCache(maxsize=index_cache_size)
+        # path queries over more than query_chunk_size IGTs are split
+        # into chunks for a pool of query_workers processes (if > 0)
+        self.query_workers = query_workers
+        self.query_chunk_size = query_chunk_size
+        self._query_pool = None
+        # the results of whole-corpus path queries (see
+        # _cached_matches()), unless query_cache_size is 0
+        self._queries = None
+        if query_cache_size:
+            self._queries = LRUCache(
+                maxsize=query_cache_size, maxbytes=query_cache_bytes
+            )
+        # journals larger than journal_limit bytes are compacted
+        self.journal_limit = journal_limit
+        self._compacting = set()
+        # a lock for each index directory, held while reading or
+        # changing the index's state and file lock; an index being
+        # loaded or written doesn't hold up requests for other corpora
+        self._locks = {}
+        self._locks_lock = Lock()
+        self._flocks = set()
+
+    @property
+    def index(self):
+        """The primary index, brought up to date on each access."""
+        return self._fresh_state(self.path)[2]
+
+    def _load_index(self, cdir):
+        return self._fresh_state(cdir)[2]
+
+    def _get_state(self, d):
+        if d == self.path:
+            return self._main
+        return self._indexes.get(d)
+
+    def _set_state(self, d, state):
+        if d == self.path:
+            self._main = state
+        elif state is None:
+            self._indexes.discard(d)
+        else:
+            self._indexes.put(d, state)
+
+    def _lock(self, d):
+        lock = self._locks.get(d)
+        if lock is None:
+            with self._locks_lock:
+                lock = self._locks.setdefault(d, RLock())
+        return lock
+
+    def _fresh_state(self, d):
+        # Return the state of the index in directory *d*, first
+        # applying any changes made by other processes. Checking for
+        # changes only stats the index files; when the snapshot is the
+        # same, only the new journal records are read.
+        with metrics.stage('load_index'):
+            state = self._get_state(d)
+            if state is not None and not _stale(d, state):
+                return state
+            with self._lock(d):
+                state = self._get_state(d)
+                if state is None or _stale(d, state):
+                    with self._flock(d):
+                        state = _refresh_state(d, state)
+                    self._set_state(d, state)
+                return state
+
+    @contextmanager
+    def _flock(self, d, exclusive=False):
+        # Hold a shared (or exclusive) file lock on the index in
+        # directory *d*, so other processes don't write it while it is
+        # read or read it while it is written. The caller must hold
+        # self._lock(d); nested locks on the same index are no-ops.
+        if fcntl is None or d in self._flocks:
+            yield
+            return
+        try:
+            fd = os.open(
+                os.path.join(d, 'index.lock'), os.O_RDWR | os.O_CREAT, 0o644
+            )
+        except OSError:
+            yield  # e.g., a read-only database can't be written anyway
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._flocks.add(d)
+            yield
+        finally:
+            self._flocks.discard(d)
+            os.close(fd)
+
+    @contextmanager
+    def _edit_index(self, d):
+        # yield the up-to-date index in directory *d* and a list to fill
+        # with journal records for the changes, which are logged and
+        # applied afterwards; other writers wait until then
+        with self._lock(d), self._flock(d, exclusive=True):
+            state = self._fresh_state(d)
+            records = []
+            yield state[2], records
+            self._log(d, state, records)
+
+    def _log(self, d, state, records):
+        # append *records* to the journal of the index in directory *d*
+        # and apply them to the index
+        sig, _, index = state
+        try:
+            size = _append_journal(d, index, records)
+        except Exception:
+            # the index may be partially modified, so drop it
+            self._set_state(d, None)
+            raise
+        self._set_state(d, (sig, size, index))
+        if size > self.journal_limit and d not in self._compacting:
+            self._compacting.add(d)
+            Thread(target=self._compact, args=(d,), daemon=True).start()
+
+    def _compact(self, d):
+        # Write a snapshot of the index with the current journal folded
+        # in. The journal is rotated first, so changes made while the
+        # snapshot is written (here or in other processes) go to the
+        # next journal.
+        try:
+            with self._lock(d), self._flock(d, exclusive=True):
+                sig, _, index = self._fresh_state(d)
+                index['journal'] += 1
+                n = index['journal']
+                open(_journal_path(d, n), 'ab').close()
+                self._set_state(d, (sig, 0, index))
+                text = _snapshot_text(index)
+            tmp = _write_snapshot(d, text)
+            with self._lock(d), self._flock(d, exclusive=True):
+                # don't replace a snapshot written in the meantime (or
+                # a deleted corpus)
+                if _file_signature(_index_path(d)) != sig:
+                    _remove_file(tmp)
+                    return
+                os.replace(tmp, _index_path(d))
+                # the index may have moved on to a journal rotated by
+                # another process, but the snapshot only covers the
+                # journals before n
+                _remove_journals(d, n)
+                state = self._get_state(d)
+                if state is not None and state[2] is index:
+                    self._set_state(
+                        d, (_file_signature(_index_path(d)),) + state[1:]
+                    )
+        except (SleipnirError, OSError):
+            pass  # the journal is still valid; try again on a later write
+        finally:
+            self._compacting.discard(d)
+
+    def _update_index_entry(self, corpus_id, name=None, path=None,
+                            igt_count=None, stats=None):
+        with self._edit_index(self.path) as (index, records):
+            records.append(_corpus_entry_record(
+                index, corpus_id, name=name, path=path, igt_count=igt_count,
+                stats=stats
+            ))
+            records.append(_version_record(_next_version(index)))
+
+    def _update_corpus_stats(self, corpus_id, cindex):
+        # copy a changed corpus's statistics to the primary index
+        self._update_index_entry(
+            corpus_id,
+            igt_count=len(cindex['igts']),
+            stats=_copy_stats(cindex['stats'])
         )
-        if name is not None: entry['name'] = name
-        if path is not None: entry['path'] = path
-        if igt_count is not None: entry['igt_count'] = igt_count
-        self.index['corpora'][corpus_id] = entry
-        _dump_index(self.index, self.path)
 
     def _get_index_entry(self, corpus_id):
         entry = self.index['corpora'].get(corpus_id)
@@ -65,131 +300,449 @@ class FileSystemDbi(SleipnirDatabaseInterface):
     def _get_name(self, corpus_id):
         return self._get_index_entry(corpus_id).get('name', '(untitled)')
 
-    def _read_igts(self, corpus_id, ids=None):
+    def _read_igts(self, corpus_id, ids=None, cindex=None):
+        # Return an iterator of IGT records (XigtJSON objects), read
+        # lazily from the data file. Missing IDs are reported before
+        # iteration begins.
         cpath = self._corpus_path(corpus_id)
-        cindex = _load_index(cpath)
-        igts = cindex['igts']
-        if ids is not None:
-            igtidx = cindex['igt_index']
-            missing = [_id for _id in ids if _id not in igtidx]
-            if missing:
-                raise SleipnirDbError(
-                    'Requested IGTs not found: {}'.format(', '.join(missing)),
-                    status_code=404
-                )
-            idxs = map(igtidx.__getitem__, ids)
-            igts = [igts[idx] for idx in idxs]
-        return [_jsonload(os.path.join(cpath, igt['path'])) for igt in igts]
-
-    def _build_corpus_dict(self, corpus_id, ids=None):
-        cindex = _load_index(self._corpus_path(corpus_id))
-        xcd = {}
-        if 'namespaces' in cindex: xcd['namespaces'] = cindex['namespaces']
-        if 'namespace' in cindex: xcd['namespace'] = cindex['namespace']
-        if 'attributes' in cindex: xcd['attributes'] = cindex['attributes']
-        if 'metadata' in cindex: xcd['metadata'] = cindex['metadata']
-        xcd['igts'] = self._read_igts(corpus_id, ids=ids)
-        return xcd
+        if cindex is None:
+            cindex = self._load_index(cpath)
+        entries = _select_entries(cindex, ids)
+        return _iter_records(cpath, cindex, entries)
+
+    def _decode_igts(self, corpus_id, projection=None, **kwargs):
+        # Like _read_igts(), but the IGTs are decoded. They are shared
+        # with the IGT cache, so don't modify them.
+        cpath, cindex, entries = self._select(corpus_id, **kwargs)
+        return self._iter_decoded(
+            corpus_id, cpath, cindex, entries, projection=projection
+        )
+
+    def _select(self, corpus_id, ids=None, cursor=None, limit=None,
+                features=None):
+        # Return the corpus path, corpus index, and the selected index
+        # entries. If *features* is given, IGTs known to lack any of
+        # them are skipped.
+        cpath = self._corpus_path(corpus_id)
+        cindex = self._load_index(cpath)
+        entries = _select_entries(cindex, ids, cursor=cursor, limit=limit)
+        if features:
+            candidates = self._candidate_ids(cpath, cindex, features)
+            entries = [e for e in entries if e['id'] in candidates]
+        return cpath, cindex, entries
+
+    def _candidate_ids(self, cpath, cindex, features):
+        # Return the IDs of IGTs having all *features*, including those
+        # whose features were never recorded (legacy entries). The
+        # feature map is rebuilt from the index entries when the index
+        # changes.
+        version = cindex.get('version', 0)
+        fmap = self._feature_maps.get(
+            cpath, check=lambda c: c[0] is cindex and c[1] == version
+        )
+        if fmap is None:
+            fmap = (cindex, version) + _make_feature_map(cindex)
+            self._feature_maps.put(cpath, fmap)
+        _, _, feature_ids, unknown = fmap
+        ids = set.intersection(*[feature_ids.get(f, set()) for f in features])
+        return ids | unknown
+
+    def _iter_decoded(self, corpus_id, cpath, cindex, entries,
+                      projection=None):
+        # projected IGTs are cached apart from whole ones
+        with _RecordReader(cpath, cindex) as reader:
+            for entry in entries:
+                key = (corpus_id, entry['id'], entry.get('version', 0))
+                if projection is not None:
+                    key += (projection,)
+                igt = self._igts.get(key)
+                if igt is None:
+                    record = project_record(reader.read(entry), projection)
+                    igt = _decode_igt(record)
+                    self._igts.put(key, igt, size=_igt_size(entry))
+                yield igt
 
     def list_corpora(self):
         corpora = []
         for corpus_id, entry in self.index['corpora'].items():
             corpus_entry = {
                 'id': corpus_id,
-                'name': self._get_name(corpus_id),
+                'name': entry.get('name', '(untitled)'),
                 'igt_count': entry.get('igt_count', -1)
             }
             corpora.append(corpus_entry)
         return corpora
 
-    def corpus_summary(self, corpus_id):
-        cindex = _load_index(self._corpus_path(corpus_id))
-        languages = defaultdict(lambda: defaultdict(int))
-        for igt in cindex['igts']:
-            lgcode = igt.get('language_code','und')
-            lgname = igt.get('language_name', '???')
-            languages[lgcode][lgname] += 1
-        return {
+    def corpus_summary(self, corpus_id, cursor=None, limit=None):
+        cindex = self._load_index(self._corpus_path(corpus_id))
+        # a copy, as the index's statistics change with later writes
+        stats = _copy_stats(cindex['stats'])
+        # get one more than the limit to find the next page's cursor
+        entries = _select_entries(
+            cindex, None, cursor=cursor,
+            limit=None if limit is None else limit + 1
+        )
+        summary = {
             'id': corpus_id,
             'name': self._get_name(corpus_id),
             'igt_count': len(cindex['igts']),
-            'languages': languages,
+            'tier_count': stats['tier_count'],
+            'item_count': stats['item_count'],
+            'languages': stats['languages'],
+            'tier_types': stats['tier_types'],
             'igts': [
                 {'id': igt['id'], 'tier_count': igt.get('tier_count', -1)}
-                for igt in cindex['igts']
+                for igt in entries[:limit]
             ]
         }
+        if limit is not None and len(entries) > limit:
+            summary['next_cursor'] = entries[limit]['id']
+        return summary
+
+    def get_stats(self):
+        """
+        Return the IGT, tier, and item counts, the IGT count of each
+        language (by code and name), and the tier count of each tier
+        type, totalled over the database and for each corpus. Only the
+        primary index is read, except for corpora added before
+        statistics were kept.
+        """
+        index = self.index
+        stats = _copy_stats(index['stats'])
+        corpora = []
+        for corpus_id, entry in index['corpora'].items():
+            corpus_stats = entry.get('stats')
+            if corpus_stats is None:
+                # not yet recorded in the primary index
+                cdir = os.path.join(self.path, entry['path'])
+                corpus_stats = self._load_index(cdir)['stats']
+                _merge_stats(stats, corpus_stats)
+            corpora.append(dict(
+                _copy_stats(corpus_stats),
+                id=corpus_id,
+                name=entry.get('name', '(untitled)')
+            ))
+        stats['corpus_count'] = len(corpora)
+        stats['corpora'] = corpora
+        return stats
+
+    def get_languages(self, corpus_id):
+        """
+        Return a dict mapping the ID of each IGT in the corpus to the
+        (code, name) pair of its language, as kept for the statistics.
+        Only the corpus index is read.
+        """
+        cindex = self._load_index(self._corpus_path(corpus_id))
+        return dict(
+            (entry['id'], (entry.get('language_code', 'und'),
+                           entry.get('language_name', '')))
+            for entry in cindex['igts']
+        )
+
+    def get_version(self, corpus_id=None, igt_id=None):
+        """
+        Return the version and modification time (in seconds since the
+        epoch, or `None` if unknown) of the database (if *corpus_id* is
+        `None`), a corpus, or an IGT. Only indexes are read.
+        """
+        if corpus_id is None:
+            index = self.index
+            return index.get('version', 0), index.get('modified')
+        cindex = self._load_index(self._corpus_path(corpus_id))
+        version = cindex.get('version', 0)
+        if igt_id is not None:
+            version = _select_entries(cindex, [igt_id])[0].get('version', 0)
+        # IGTs don't record when they were changed, so the corpus's
+        # time is used (which is no earlier)
+        return version, cindex.get('modified')
 
     def fetch_raw_corpus(self, corpus_id, mimetype):
-        if mimetype == 'application/json':
-            return json.dumps(self._build_corpus_dict(corpus_id), indent=2)
-        else:
+        return ''.join(self.iter_raw_corpus(corpus_id, mimetype))
+
+    def iter_raw_corpus(self, corpus_id, mimetype):
+        if mimetype != 'application/json':
             raise SleipnirDbError(
                 'Unsupported mimetype for raw corpus: %s' % mimetype
             )
+        cpath = self._corpus_path(corpus_id)
+        cindex = self._load_index(cpath)
+        records = _iter_raw_records(cpath, cindex, list(cindex['igts']))
+        return _iter_json_corpus(_corpus_header(cindex), records)
 
-    def get_corpus(self, corpus_id, ids=None):
-        xc = xigtjson.decode(self._build_corpus_dict(corpus_id, ids=ids))
-        return xc
-
-    def get_igts(self, corpus_id, ids=None, paths=None):
-        igts = list(
-            map(xigtjson.decode_igt, self._read_igts(corpus_id, ids=ids))
+    def get_corpus(self, corpus_id, ids=None, mode='full', tiers=None,
+                   fields=None):
+        projection = make_projection(tiers, fields)
+        cindex = self._load_index(self._corpus_path(corpus_id))
+        records = self._read_igts(corpus_id, ids=ids, cindex=cindex)
+        if projection is not None:
+            records = (project_record(r, projection) for r in records)
+        xcd = _corpus_header(cindex)
+        nsmap = xigtjson.active_namespaces(xcd, None)
+        # like xigtjson.decode(), but in a non-full mode the IGTs are
+        # decoded as the corpus is iterated
+        return XigtCorpus(
+            attributes=xcd.get('attributes', {}),
+            metadata=[xigtjson.decode_metadata(md, nsmap)
+                      for md in xcd.get('metadata', [])],
+            igts=(_decode_igt(record, nsmap) for record in records),
+            mode=mode,
+            namespace=xcd.get('namespace'),
+            nsmap=xcd.get('namespaces')
         )
-        if paths is not None:
-            # queries are a conjunction (all have to match)
-            matched_igts = []
-            for igt in igts:
-                matched = True
-                for p in paths:
-                    objs = xp.findall(igt, p)
-                    if objs:
-                        md = Metadata(
-                            type='QueryResult',
-                            attributes={'queryType': 'path', 'query': p}
-                        )
-                        for obj in objs:
-                            if isinstance(obj, Item):
-                                md.append(Meta(attributes={
-                                    'tier': obj.tier.id,
-                                    'item': obj.id
-                                }))
-                        igt.metadata.append(md)
-                    else:
-                        matched = False
-                if matched:
-                    matched_igts.append(igt)
-            igts = matched_igts
+
+    def get_igts(self, corpus_id, ids=None, paths=None,
+                 cursor=None, limit=None, tiers=None, fields=None):
+        return list(self.iter_igts(
+            corpus_id, ids=ids, paths=paths, cursor=cursor, limit=limit,
+            tiers=tiers, fields=fields
+        ))
+
+    def iter_igts(self, corpus_id, ids=None, paths=None,
+                  cursor=None, limit=None, tiers=None, fields=None):
+        """
+        Iterate over the IGTs of a corpus: those with *ids* (default:
+        all), starting from the one with ID *cursor*, that match all
+        *paths*, up to *limit*. If *tiers* or *fields* are given, the
+        IGTs only have those tiers (by ID or type) and top-level fields
+        (see sleipnir.projection).
+
+        Matches of *paths* are yielded as they are found. The query
+        cache only gets a query's results when it is iterated to the
+        end of the corpus without *ids* or *cursor*, so a page (with
+        *limit*) reads only as far as its last match; once cached,
+        repeating the query or getting any of its pages reads only the
+        matching IGTs.
+
+        Unless *paths* are given, the IGTs are shared with the IGT cache
+        and so with every later reader: don't modify them, but modify a
+        copy from sleipnir.projection.project_igt() instead. The same
+        goes for get_igts(), get_igt(), and get_igt_batch().
+        """
+        projection = make_projection(tiers, fields)
+        if paths is None:
+            # only the page's IGTs need to be read
+            igts = self._decode_igts(
+                corpus_id, ids=ids, cursor=cursor, limit=limit,
+                projection=projection
+            )
+        else:
+            # read until enough IGTs match, skipping those that can't
+            features = set()
+            for path in paths:
+                features.update(path_features(path))
+            cpath, cindex, entries = self._select(
+                corpus_id, ids=ids, cursor=cursor, features=features
+            )
+            key, matches = self._cached_matches(corpus_id, cindex, paths)
+            if matches is not None:
+                # only the matching IGTs are read
+                matched = (e for e in entries if e['id'] in matches)
+                igts = (
+                    add_results(igt, matches[igt.id], projection)
+                    for igt in self._iter_decoded(
+                        corpus_id, cpath, cindex, matched
+                    )
+                )
+            else:
+                if self.query_workers and len(entries) > self.query_chunk_size:
+                    pairs = self._parallel_hits(
+                        corpus_id, cpath, cindex, entries, paths
+                    )
+                else:
+                    pairs = iter_hits(
+                        self._iter_decoded(corpus_id, cpath, cindex, entries),
+                        paths
+                    )
+                if key is not None and ids is None and cursor is None:
+                    # matches are yielded as they are found, and cached
+                    # if the query gets to the end of the corpus
+                    igts = fill_matches(
+                        pairs, projection, self._cache_matches(key)
+                    )
+                else:
+                    igts = (add_results(igt, hits, projection)
+                            for igt, hits in pairs)
+            igts = islice(igts, limit)
         return igts
 
+    def _cached_matches(self, corpus_id, cindex, paths):
+        # Return the query cache key for *paths* on the corpus and the
+        # cached query hits of every IGT in it matching all *paths*
+        # (see find_matches()), or `None` if they aren't cached (and
+        # `None` for both without a query cache). The key has the
+        # corpus's version, so results from before a change are never
+        # used.
+        if self._queries is None:
+            return None, None
+        key = (corpus_id, cindex.get('version', 0), cindex.get('modified'),
+               normalize_paths(paths))
+        return key, self._queries.get(key)
+
+    def _cache_matches(self, key):
+        # a function that caches the query hits it's given under *key*
+        def put(matches):
+            self._queries.put(key, matches, size=matches_size(matches))
+        return put
+
+    def _forget_queries(self, corpus_id):
+        # cached results for old versions are never used, but they take
+        # space until evicted
+        if self._queries is not None:
+            self._queries.discard_if(lambda key: key[0] == corpus_id)
+
+    def _parallel_hits(self, corpus_id, cpath, cindex, entries, paths):
+        # (IGT, hits) for each matching IGT, as for iter_hits()
+        for matched in self._parallel_results(cpath, cindex, entries, paths):
+            igts = self._iter_decoded(
+                corpus_id, cpath, cindex, [entry for entry, _ in matched]
+            )
+            for igt, (_, hits) in zip(igts, matched):
+                yield igt, hits
+
+    def _parallel_results(self, cpath, cindex, entries, paths):
+        # Evaluate the query on chunks of entries in worker processes,
+        # which return the positions of matching IGTs and their query
+        # hits, and yield a list of (entry, hits) pairs for each chunk.
+        # Only a few chunks are queued ahead of the consumer, so
+        # stopping early (e.g., at a limit) doesn't waste much work.
+        if self._query_pool is None:
+            self._query_pool = ProcessPoolExecutor(self.query_workers)
+        size = self.query_chunk_size
+        chunks = (entries[i:i+size] for i in range(0, len(entries), size))
+        pending = deque()
+        def submit(chunk):
+            future = self._query_pool.submit(
+                _query_chunk, cpath, cindex['data_file'],
+                _index_codec(cindex), chunk, paths
+            )
+            pending.append((chunk, future))
+        try:
+            for chunk in islice(chunks, 2 * self.query_workers):
+                submit(chunk)
+            while pending:
+                chunk, future = pending.popleft()
+                with metrics.stage('query'):
+                    matches = future.result()
+                for next_chunk in islice(chunks, 1):
+                    submit(next_chunk)
+                yield [(chunk[i], hits) for i, hits in matches]
+        finally:
+            for _, future in pending:
+                future.cancel()
+
     # get_igt() just uses the default from SleipnirDatabaseInterface
 
+    def get_igt_batch(self, pairs, tiers=None, fields=None, workers=4):
+        """
+        Get the IGTs for (corpus ID, IGT ID) *pairs* from any corpora,
+        with a result for each pair that has the IGT or an error (see
+        sleipnir.batch). Each corpus's index is loaded once and its
+        records are read by up to *workers* threads.
+        """
+        return batch.get_igt_batch(
+            self, pairs, self._fetch_igts,
+            projection=make_projection(tiers, fields), workers=workers
+        )
+
+    def _fetch_igts(self, corpus_id, ids, projection=None):
+        # the decoded IGTs among *ids* that exist, by ID
+        cpath = self._corpus_path(corpus_id)
+        cindex = self._load_index(cpath)
+        igtidx = cindex['igt_index']
+        entries = [cindex['igts'][igtidx[_id]] for _id in ids
+                   if _id in igtidx]
+        igts = self._iter_decoded(
+            corpus_id, cpath, cindex, entries, projection=projection
+        )
+        return dict((entry['id'], igt) for entry, igt in zip(entries, igts))
+
     def add_corpus(self, xc, name=None):
-        _validate_corpus(xc)
-        tmp_cdir, igt_count = _make_corpus_directory(xc)
+        return self.add_corpora([xc], names=[name])[0]
+
+    def add_corpora(self, xcs, names=None, ids=None, languages=None):
+        """
+        Add each corpus in *xcs* (named by the corresponding item in
+        *names*, if given) and update the main index once. Corpus IDs
+        are generated unless *ids* gives them, and the languages of
+        IGTs are found in their metadata unless *languages* gives a
+        dict for each corpus like get_languages() returns (both, e.g.,
+        when copying a database).
+        """
+        xcs = list(xcs)
+        names = _batch_argument(names, xcs, 'names')
+        ids = _batch_argument(ids, xcs, 'ids')
+        languages = _batch_argument(languages, xcs, 'languages')
+        _validate_corpus_ids(ids)
+        tmp_cdirs = []
+        try:
+            # the corpora may be transient (e.g., parsed from an upload
+            # as they are read), so their IGTs are only iterated once
+            for xc, langs in zip(xcs, languages):
+                tmp_cdirs.append(
+                    _make_corpus_directory(xc, self.codec, langs)
+                )
+        except Exception:
+            for tmp_cdir, _ in tmp_cdirs:
+                shutil.rmtree(tmp_cdir, ignore_errors=True)
+            raise
 
         # update main index
-        while True:
-            corpus_id = _make_new_id(6)
-            if corpus_id not in self.index['corpora']:
-                break
-        cdir = os.path.join('data', corpus_id)
-        shutil.move(tmp_cdir, os.path.join(self.path, cdir))
-        if name is None:
-            name = corpus_id
-        self._update_index_entry(corpus_id, name, cdir, igt_count)
-
-        return {'id': corpus_id, 'igt_count': igt_count}
+        results = []
+        with self._edit_index(self.path) as (index, records):
+            taken = [_id for _id in ids if _id in index['corpora']]
+            if taken:
+                for tmp_cdir, _ in tmp_cdirs:
+                    shutil.rmtree(tmp_cdir, ignore_errors=True)
+                raise SleipnirDbError(
+                    'Corpus ID already exists: {}'.format(', '.join(taken)),
+                    status_code=409
+                )
+            for (tmp_cdir, stats), name, corpus_id in zip(
+                    tmp_cdirs, names, ids):
+                while corpus_id is None:
+                    corpus_id = _make_new_id(6)
+                    if (corpus_id in index['corpora']
+                            or corpus_id in ids
+                            or any(r['id'] == corpus_id for r in records)):
+                        corpus_id = None
+                cdir = os.path.join('data', corpus_id)
+                shutil.move(tmp_cdir, os.path.join(self.path, cdir))
+                if name is None:
+                    name = corpus_id
+                records.append(_corpus_entry_record(
+                    index, corpus_id, name, cdir, stats['igt_count'], stats
+                ))
+                results.append(
+                    {'id': corpus_id, 'igt_count': stats['igt_count']}
+                )
+            records.append(_version_record(_next_version(index)))
+
+        return results
 
     def add_igt(self, corpus_id, igt):
-        if igt.id is None:
+        return self.add_igts(corpus_id, [igt])['igts'][0]
+
+    def add_igts(self, corpus_id, igts):
+        """
+        Add every IGT in *igts* to the corpus with one write each to
+        the data file, the corpus index, and the main index. If any IGT
+        lacks an ID or has one already in use, none are added.
+        """
+        igts = list(igts)
+        if any(igt.id is None for igt in igts):
             raise SleipnirDbError(
                 'IGTs must have an ID', status_code=400
             )
-        cindex = _add_igt(igt, self._corpus_path(corpus_id))
-        self._update_index_entry(corpus_id, igt_count=len(cindex['igts']))
+        cdir = self._corpus_path(corpus_id)
+        with self._edit_index(cdir) as (cindex, records):
+            records.extend(_add_igts(igts, cdir, cindex))
+        self._forget_queries(corpus_id)
+        self._update_corpus_stats(corpus_id, cindex)
 
-        return {'id': igt.id, 'tier_count': len(igt)}
+        return {
+            'igt_count': len(igts),
+            'igts': [{'id': igt.id, 'tier_count': len(igt)} for igt in igts]
+        }
 
     # disable this one
     # def set_corpus(self, corpus_id, xc):
@@ -216,126 +769,934 @@ class FileSystemDbi(SleipnirDatabaseInterface):
                 status_code=400
             )
         cdir = self._corpus_path(corpus_id)
-        cindex = _load_index(cdir)
-        igt_entry_idx = cindex['igt_index'].get(igt.id)
-        if igt_entry_idx is None:  # target doesn't exist; just add
-            _add_igt(igt, cdir, cindex=cindex)
-            created = True
-        else:  # target exists; replace
-            igt_entry = cindex['igts'][igt_entry_idx]
-            igt_path = os.path.join(cdir, igt_entry['path'])
-            _jsondump(xigtjson.encode_igt(igt), igt_path)
-            igt_entry['tier_count'] = len(igt)
-            created = False
-        _dump_index(cindex, cdir)
-        self._update_index_entry(corpus_id, igt_count=len(cindex['igts']))
+        old_path = None
+        with self._edit_index(cdir) as (cindex, records):
+            igt_entry_idx = cindex['igt_index'].get(igt.id)
+            if igt_entry_idx is None:  # target doesn't exist; just add
+                records.extend(_add_igts([igt], cdir, cindex))
+                created = True
+            else:  # target exists; replace
+                igt_entry = dict(cindex['igts'][igt_entry_idx])
+                self._igts.discard(
+                    (corpus_id, igt.id, igt_entry.get('version', 0))
+                )
+                # the old record is left in the data file until repacked
+                offset, length, size = _append_records(
+                    cdir, cindex, [xigtjson.encode_igt(igt)]
+                )[0]
+                old_path = igt_entry.pop('path', None)
+                version = _next_version(cindex)
+                igt_entry.update(_igt_entry_values(igt, igt_entry))
+                igt_entry['offset'] = offset
+                igt_entry['length'] = length
+                igt_entry['size'] = size
+                igt_entry['version'] = version
+                records.append(_version_record(
+                    version, data_file=cindex['data_file']
+                ))
+                records.append({'op': 'put', 'igts': [igt_entry]})
+                created = False
+        if old_path is not None:
+            _remove_file(os.path.join(cdir, old_path))
+        self._forget_queries(corpus_id)
+        self._update_corpus_stats(corpus_id, cindex)
 
         return {'id': igt_id, 'created': created}
 
+    def patch_igt(self, corpus_id, igt_id, operations):
+        """
+        Apply the patch *operations* (see sleipnir.patch) to an IGT.
+        Only the IGT's record is rewritten (appended to the data file)
+        and its index entry replaced; the primary index is only
+        updated if the corpus statistics change.
+        """
+        cdir = self._corpus_path(corpus_id)
+        old_path = None
+        with self._edit_index(cdir) as (cindex, records):
+            old = _select_entries(cindex, [igt_id])[0]
+            with _RecordReader(cdir, cindex) as reader:
+                record = reader.read(old)
+            record, igt, fields = patch.patch_igt(record, operations)
+            entry = dict(old)
+            values = _igt_entry_values(igt, old)
+            if 'metadata' not in fields:
+                # only the metadata can change the language
+                del values['language_code'], values['language_name']
+            entry.update(values)
+            offset, length, size = _append_records(cdir, cindex, [record])[0]
+            old_path = entry.pop('path', None)
+            version = _next_version(cindex)
+            entry.update(offset=offset, length=length, size=size,
+                         version=version)
+            records.append(_version_record(
+                version, data_file=cindex['data_file']
+            ))
+            records.append({'op': 'put', 'igts': [entry]})
+        self._igts.discard((corpus_id, igt_id, old.get('version', 0)))
+        if old_path is not None:
+            _remove_file(os.path.join(cdir, old_path))
+        self._forget_queries(corpus_id)
+        if any(old.get(key) != entry.get(key) for key in _stats_keys):
+            self._update_corpus_stats(corpus_id, cindex)
+        return {'id': igt_id, 'version': version}
+
+    def patch_corpus(self, corpus_id, operations):
+        """
+        Apply the patch *operations* (see sleipnir.patch) to the
+        corpus-level data (metadata and attributes) and name of a
+        corpus. Only the changed index values are rewritten.
+        """
+        cdir = self._corpus_path(corpus_id)
+        name = self._get_name(corpus_id)
+        with self._edit_index(cdir) as (cindex, records):
+            header, name, fields = patch.patch_corpus(
+                _corpus_header(cindex), name, operations
+            )
+            values = dict((key, header[key]) for key in fields
+                          if key in header)
+            version = _next_version(cindex)
+            records.append(_version_record(version, **values))
+        if 'name' in fields:
+            self._update_index_entry(corpus_id, name=name or corpus_id)
+        self._forget_queries(corpus_id)
+        return {'id': corpus_id, 'version': version}
+
+    def pack_corpus(self, corpus_id, codec=None):
+        """
+        Rewrite the corpus's IGTs into a fresh packed data file, with
+        their records compressed by *codec* if given.
+
+        This converts corpora stored with one file per IGT and drops
+        records left unreachable by set_igt() and del_igt().
+        """
+        if codec is not None:
+            _parse_codec(codec)
+        cdir = self._corpus_path(corpus_id)
+        with self._lock(cdir), self._flock(cdir, exclusive=True):
+            self._indexes.discard(cdir)
+            self._feature_maps.discard(cdir)
+            result = _pack_corpus_directory(cdir, codec=codec)
+        # corpora from before statistics were kept get them in the
+        # primary index too
+        self._update_index_entry(
+            corpus_id, igt_count=result['igt_count'],
+            stats=_copy_stats(result.pop('stats'))
+        )
+        return result
+
+    def cache_info(self):
+        info = {'index': self._indexes.info(), 'igt': self._igts.info()}
+        if self._queries is not None:
+            info['query'] = self._queries.info()
+        return info
+
     def del_corpus(self, corpus_id):
-        path = self._corpus_path(corpus_id)
-        try:
-            shutil.rmtree(path)
-        except OSError:
-            raise SleipnirDbError('Could not delete corpus: %s' % corpus_id)
-        del self.index['corpora'][corpus_id]
-        _dump_index(self.index, self.path)
+        with self._edit_index(self.path) as (index, records):
+            path = self._corpus_path(corpus_id)
+            try:
+                shutil.rmtree(path)
+            except OSError:
+                raise SleipnirDbError(
+                    'Could not delete corpus: %s' % corpus_id
+                )
+            self._indexes.discard(path)
+            self._feature_maps.discard(path)
+            self._igts.discard_if(lambda key: key[0] == corpus_id)
+            self._forget_queries(corpus_id)
+            records.append({'op': 'corpus', 'id': corpus_id, 'entry': None})
+            records.append(_version_record(_next_version(index)))
 
     def del_igt(self, corpus_id, igt_id):
         cdir = self._corpus_path(corpus_id)
-        cindex = _load_index(cdir)
-        try:
-            igt_entry_idx = cindex['igt_index'][igt_id]
-            igt_entry = cindex['igts'][igt_entry_idx]
-            path = os.path.join(cdir, igt_entry['path'])
-            os.remove(path)
-            del cindex['igts'][igt_entry_idx]
-            del cindex['igt_index'][igt_id]
-        except (KeyError, IndexError, OSError):
-            raise SleipnirDbError(
-                'Error removing IGT "{}" in corpus "{}"'
-                .format(igt_id, corpus_id)
-            )
-        _refresh_igt_index(cindex)
-        _dump_index(cindex, cdir)
-        self._update_index_entry(corpus_id, igt_count=len(cindex['igts']))
+        with self._edit_index(cdir) as (cindex, records):
+            try:
+                igt_entry_idx = cindex['igt_index'][igt_id]
+                igt_entry = cindex['igts'][igt_entry_idx]
+                if 'path' in igt_entry:
+                    os.remove(os.path.join(cdir, igt_entry['path']))
+                self._igts.discard(
+                    (corpus_id, igt_id, igt_entry.get('version', 0))
+                )
+            except (KeyError, IndexError, OSError):
+                raise SleipnirDbError(
+                    'Error removing IGT "{}" in corpus "{}"'
+                    .format(igt_id, corpus_id)
+                )
+            records.append(_version_record(_next_version(cindex)))
+            records.append({'op': 'del', 'ids': [igt_id]})
+        self._forget_queries(corpus_id)
+        self._update_corpus_stats(corpus_id, cindex)
 
-def _validate_corpus(xc):
-    for igt in xc:
+def _validate_igts(igts):
+    for igt in igts:
         if igt.id is None:
             raise SleipnirError('Each IGT must have an ID.', status_code=400)
 
+def _encode_corpus_header(xc):
+    # encode everything but the IGTs, without iterating over them
+    # (note: this re-parents the corpus metadata)
+    obj = xigtjson.encode(XigtCorpus(
+        id=xc.id, attributes=xc.attributes, metadata=xc.metadata,
+        namespace=xc.namespace, nsmap=xc.nsmap
+    ))
+    del obj['igts']
+    return obj
+
+def _iter_batches(items, size=1000):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            break
+        yield batch
+
+_corpus_id_re = re.compile(r'^[-\w]+$')
+
+def _validate_corpus_ids(ids):
+    # corpus IDs given by users must be safe for paths and URLs
+    given = [_id for _id in ids if _id is not None]
+    if len(set(given)) != len(given):
+        raise SleipnirError('Corpus IDs must be unique.', status_code=400)
+    for _id in given:
+        if not _corpus_id_re.match(_id):
+            raise SleipnirError(
+                'Invalid corpus ID: {}'.format(_id), status_code=400
+            )
+
+def _batch_argument(values, items, name):
+    # a list with a value (default None) for each item in a batch
+    if values is None:
+        return [None] * len(items)
+    values = list(values)
+    if len(values) != len(items):
+        raise SleipnirError(
+            'The number of {} must match the number of corpora.'.format(name),
+            status_code=400
+        )
+    return values
+
 def _jsonload(path, **kwargs):
     try:
-        return json.load(gzip.open(path, 'rt'), **kwargs)
+        with gzip.open(path, 'rt') as f:
+            return json.load(f, **kwargs)
     except OSError:
         raise SleipnirDbError('JSON file not found.')
     except json.JSONDecodeError:
         raise SleipnirDbError('File is not valid JSON data.')
 
-def _jsondump(obj, path, **kwargs):
-    if 'indent' not in kwargs: kwargs['indent'] = 2
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# Record codecs: for each method, the functions that compress (given a
+# level) and decompress a record, the method's default level, and the
+# levels it accepts.
+_codecs = {
+    'none': (lambda data, level: data, lambda data: data, None, range(0)),
+    'gzip': (gzip.compress, gzip.decompress, 9, range(10)),
+    'zlib': (zlib.compress, zlib.decompress, 6, range(10)),
+    'bz2': (bz2.compress, bz2.decompress, 9, range(1, 10)),
+}
+if lzma is not None:
+    _codecs['lzma'] = (
+        lambda data, level: lzma.compress(data, preset=level),
+        lzma.decompress,
+        6,
+        range(10)
+    )
+
+_codec_errors = (OSError, EOFError, ValueError, zlib.error)
+if lzma is not None:
+    _codec_errors += (lzma.LZMAError,)
+
+_codec_re = re.compile(r'^(\w+)(?::(\d+))?$')
+
+def _parse_codec(codec):
+    # return the (method, level) of a codec name like "gzip:6"
+    match = _codec_re.match(codec or '')
+    if match is None or match.group(1) not in _codecs:
+        raise SleipnirDbError('Invalid record codec: {}'.format(codec))
+    method, level = match.groups()
+    if level is not None:
+        level = int(level)
+        levels = _codecs[method][3]
+        if not levels:
+            raise SleipnirDbError(
+                'Invalid record codec: {} ({} has no levels)'
+                .format(codec, method)
+            )
+        if level not in levels:
+            raise SleipnirDbError(
+                'Invalid record codec: {} ({} levels are {} to {})'
+                .format(codec, method, levels[0], levels[-1])
+            )
+    return method, level
+
+def _index_codec(cindex):
+    return cindex.get('codec', 'gzip')
+
+def _compressor(codec):
+    method, level = _parse_codec(codec)
+    compress, _, default, _ = _codecs[method]
+    if level is None:
+        level = default
+    return lambda data: compress(data, level)
+
+def _decompressor(codec):
+    return _codecs[_parse_codec(codec)[0]][1]
+
+def _append_records(cdir, cindex, objs):
+    """
+    Append each object in *objs* to the corpus data file and return
+    a list of their (offset, length, size) triples, where *length* is
+    the stored length and *size* the uncompressed length.
+    """
+    if 'data_file' not in cindex:
+        cindex['data_file'] = _new_data_file(cdir)
+    compress = _compressor(_index_codec(cindex))
+    spans = []
+    try:
+        with open(os.path.join(cdir, cindex['data_file']), 'ab') as f:
+            offset = f.tell()
+            for obj in objs:
+                text = json.dumps(obj).encode('utf-8')
+                data = compress(text)
+                f.write(data)
+                spans.append((offset, len(data), len(text)))
+                offset += len(data)
+    except OSError:
+        raise SleipnirDbError('Could not write corpus data file.')
+    return spans
+
+class _RecordReader(object):
+    """
+    Reads IGT records from a corpus directory. The data file is opened
+    and memory-mapped on the first read of a packed record, so only
+    the requested records are read from disk.
+    """
+
+    def __init__(self, cdir, cindex):
+        self.cdir = cdir
+        self.cindex = cindex
+        self._decompress = _decompressor(_index_codec(cindex))
+        self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def raw(self, entry):
+        """Return the uncompressed JSON text of *entry*'s record."""
+        if 'path' in entry:  # unpacked legacy file
+            try:
+                with open(os.path.join(self.cdir, entry['path']), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                raise SleipnirDbError('JSON file not found.')
+            decompress = gzip.decompress
+        else:
+            start = entry['offset']
+            end = start + entry['length']
+            if self._mm is None or end > len(self._mm):
+                # the record was appended after the file was mapped
+                self._open()
+            data = self._mm[start:end]
+            decompress = self._decompress
+        metrics.count('bytes_read', len(data))
+        try:
+            with metrics.stage('decompress'):
+                return decompress(data)
+        except _codec_errors:
+            raise SleipnirDbError('Corrupt IGT record in data file.')
+
+    def read(self, entry):
+        """Return the decoded JSON object of *entry*'s record."""
+        text = self.raw(entry)
+        try:
+            with metrics.stage('parse_json'):
+                return json.loads(text.decode('utf-8'))
+        except ValueError:
+            raise SleipnirDbError('File is not valid JSON data.')
+
+    def _open(self):
+        self.close()
+        try:
+            path = os.path.join(self.cdir, self.cindex['data_file'])
+            with open(path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (KeyError, OSError, ValueError):
+            raise SleipnirDbError('Could not read corpus data file.')
+
+def _read_records(cdir, cindex, entries):
+    with _RecordReader(cdir, cindex) as reader:
+        return [reader.read(entry) for entry in entries]
+
+def _iter_records(cdir, cindex, entries):
+    with _RecordReader(cdir, cindex) as reader:
+        for entry in entries:
+            yield reader.read(entry)
+
+def _iter_raw_records(cdir, cindex, entries):
+    with _RecordReader(cdir, cindex) as reader:
+        for entry in entries:
+            yield reader.raw(entry).decode('utf-8')
+
+def _decode_igt(record, nsmap=None):
+    # decode an IGT's JSON object, as a stage of a request's metrics
+    metrics.count('igts_decoded')
+    with metrics.stage('decode_igt'):
+        return xigtjson.decode_igt(record, nsmap)
+
+def _iter_json_corpus(header, texts, indent=2):
+    # stream a XigtJSON corpus from its header (see _corpus_header())
+    # and IGT JSON texts, copying the texts directly into the output
+    # without decoding them
+    yield '{'
+    ind = '\n' + (' ' * indent)
+    ind2 = ind + (' ' * indent)
+    for key, val in header.items():
+        val = json.dumps(val, indent=indent).replace('\n', ind)
+        yield '{}{}: {},'.format(ind, json.dumps(key), val)
+    yield ind + '"igts": ['
+    sep = ind2
+    for text in texts:
+        yield sep + text
+        sep = ',' + ind2
+    yield ind + ']\n}\n'
+
+def _new_data_file(cdir):
+    while True:
+        fn = 'igts-%s.dat' % _make_new_id(4)
+        if not os.path.exists(os.path.join(cdir, fn)):
+            return fn
+
+def _pack_corpus_directory(cdir, codec=None):
+    cindex = _load_index(cdir)
+    entries = cindex['igts']
+    old_data_file = cindex.get('data_file')
+    old_paths = [entry['path'] for entry in entries if 'path' in entry]
+    # write a new data file so the old one stays valid until the new
+    # index is in place
+    packed = dict(cindex)
+    packed.pop('data_file', None)
+    packed['codec'] = codec or _index_codec(cindex)
+    packed['igts'] = [dict(entry) for entry in entries]
+    spans = []
+    for i in range(0, len(entries), 1000):
+        batch = packed['igts'][i:i+1000]
+        records = _read_records(cdir, cindex, batch)
+        for entry, record in zip(batch, records):
+            # entries from before features and statistics were
+            # recorded get them now
+            if 'features' not in entry or 'tier_types' not in entry:
+                igt = xigtjson.decode_igt(record)
+                entry['features'] = igt_features(igt)
+                entry['item_count'], entry['tier_types'] = _igt_stats(igt)
+        spans.extend(_append_records(cdir, packed, records))
+    if 'data_file' not in packed:  # empty corpus; still make the file
+        packed['data_file'] = _new_data_file(cdir)
+        open(os.path.join(cdir, packed['data_file']), 'wb').close()
+    for entry, (offset, length, size) in zip(packed['igts'], spans):
+        entry.pop('path', None)
+        entry['offset'] = offset
+        entry['length'] = length
+        entry['size'] = size
+    packed['stats'] = _new_stats()
+    for entry in packed['igts']:
+        _add_entry_stats(packed['stats'], entry)
+    _dump_index(packed, cdir)
+    if old_data_file is not None:
+        _remove_file(os.path.join(cdir, old_data_file))
+    for path in old_paths:
+        _remove_file(os.path.join(cdir, path))
+    return {
+        'igt_count': len(entries),
+        'data_file': packed['data_file'],
+        'codec': packed['codec'],
+        'stats': packed['stats']
+    }
+
+def _index_path(d): return os.path.join(d, 'index.json.gz')
+def _journal_path(d, n): return os.path.join(d, 'index.%d.journal' % n)
+
+def _load_index(d): return _refresh_state(d, None)[2]
+
+# An index state is a (snapshot signature, journal offset, index)
+# triple, where the offset is how much of the index's current journal
+# has been applied.
+
+def _refresh_state(d, state):
+    """
+    Return the state of the index in directory *d* with any new
+    journal records applied; if *state* is `None` or its snapshot was
+    replaced, the index is loaded anew. The index is modified in place.
+    """
+    sig = _file_signature(_index_path(d))
+    if state is None or state[0] != sig:
+        index = _jsonload(_index_path(d))
+        metrics.count('bytes_read', sig[1])  # the snapshot's size
+        index.setdefault('journal', 0)
+        _init_stats(index)
+        offset = 0
+    else:
+        _, offset, index = state
+    n = index['journal']
+    offset = _replay_journal(_journal_path(d, n), index, offset)
+    # a journal rotated by a compaction follows this one
+    while os.path.exists(_journal_path(d, n + 1)):
+        n += 1
+        offset = _replay_journal(_journal_path(d, n), index, 0)
+    index['journal'] = n
+    return (sig, offset, index)
+
+def _stale(d, state):
+    # True if the index files changed since *state* was current
+    sig, offset, index = state
+    n = index['journal']
+    return (
+        _file_signature(_index_path(d)) != sig
+        or _file_size(_journal_path(d, n)) != offset
+        or os.path.exists(_journal_path(d, n + 1))
+    )
+
+def _dump_index(index, d):
+    # write a snapshot that includes all journaled changes; the next
+    # changes go to a new journal
+    index['journal'] = index.get('journal', 0) + 1
+    os.replace(_write_snapshot(d, _snapshot_text(index)), _index_path(d))
+    _remove_journals(d, index['journal'])
+
+def _snapshot_text(index):
+    return json.dumps(index, separators=(',', ':'))
+
+def _write_snapshot(d, text):
+    # write the snapshot to a temporary file and return its path, to be
+    # moved into place with os.replace()
+    fd, tmp = mkstemp(dir=d, prefix='index.', suffix='.tmp')
+    try:
+        os.fchmod(fd, 0o644)  # mkstemp makes it private
+        with os.fdopen(fd, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as gz:
+                gz.write(text.encode('utf-8'))
+    except OSError:
+        _remove_file(tmp)
+        raise SleipnirDbError('Could not write index snapshot.')
+    return tmp
+
+_journal_re = re.compile(r'^index\.(\d+)\.journal$')
+
+def _remove_journals(d, n):
+    # remove the journals before journal *n*
+    for fn in os.listdir(d):
+        match = _journal_re.match(fn)
+        if match and int(match.group(1)) < n:
+            _remove_file(os.path.join(d, fn))
+
+def _append_journal(d, index, records):
+    """
+    Append *records* to the current journal of the index in directory
+    *d*, apply them to *index*, and return the journal's size.
+    """
+    data = ''.join(
+        json.dumps(record, separators=(',', ':')) + '\n'
+        for record in records
+    ).encode('utf-8')
+    try:
+        with open(_journal_path(d, index.get('journal', 0)), 'a+b') as f:
+            # after an interrupted write, start on a fresh line
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    data = b'\n' + data
+            f.write(data)
+            size = f.tell()
+    except OSError:
+        raise SleipnirDbError('Could not write index journal.')
+    _apply_records(index, records)
+    return size
+
+def _replay_journal(path, index, offset):
+    # apply the records from *offset* on and return the new offset
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return 0
+    with f:
+        f.seek(offset)
+        start = offset
+        for line in f:
+            if not line.endswith(b'\n'):
+                break  # the next write starts a new line after this
+            offset += len(line)
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue  # a record cut short by an interrupted write
+            _apply_records(index, [record])
+    metrics.count('bytes_read', offset - start)
+    return offset
+
+def _apply_records(index, records):
+    """
+    Apply journal records to *index*. The records are:
+
+      {"op": "set", "values": {KEY: VALUE, ...}}  set top-level values
+      {"op": "put", "igts": [ENTRY, ...]}  add or replace IGT entries
+      {"op": "del", "ids": [ID, ...]}  remove IGT entries
+      {"op": "corpus", "id": ID, "entry": ENTRY}  set (or remove, if
+                                                  ENTRY is null) a
+                                                  main-index entry
+    """
+    for record in records:
+        op = record['op']
+        if op == 'set':
+            index.update(record['values'])
+        elif op == 'put':
+            entries = index['igts']
+            igtidx = index['igt_index']
+            for entry in record['igts']:
+                i = igtidx.get(entry['id'])
+                if i is None:
+                    igtidx[entry['id']] = len(entries)
+                    entries.append(entry)
+                else:
+                    _add_entry_stats(index['stats'], entries[i], -1)
+                    entries[i] = entry
+                _add_entry_stats(index['stats'], entry)
+        elif op == 'del':
+            # a new list, so iterators over the old one are unaffected
+            ids = set(record['ids'])
+            entries = []
+            for entry in index['igts']:
+                if entry['id'] in ids:
+                    _add_entry_stats(index['stats'], entry, -1)
+                else:
+                    entries.append(entry)
+            index['igts'] = entries
+            _refresh_igt_index(index)
+        elif op == 'corpus':
+            old = index['corpora'].pop(record['id'], None)
+            if old is not None and 'stats' in old:
+                _merge_stats(index['stats'], old['stats'], -1)
+            entry = record['entry']
+            if entry is not None:
+                index['corpora'][record['id']] = entry
+                if 'stats' in entry:
+                    _merge_stats(index['stats'], entry['stats'])
+        else:
+            raise SleipnirDbError('Invalid journal record: %s' % op)
+
+def _corpus_entry_record(index, corpus_id, name=None, path=None,
+                         igt_count=None, stats=None):
+    # a journal record updating the main index entry for a corpus
+    entry = dict(index['corpora'].get(
+        corpus_id, {'name': None, 'path': None, 'igt_count': None}
+    ))
+    if name is not None: entry['name'] = name
+    if path is not None: entry['path'] = path
+    if igt_count is not None: entry['igt_count'] = igt_count
+    if stats is not None: entry['stats'] = stats
+    return {'op': 'corpus', 'id': corpus_id, 'entry': entry}
+
+def _file_signature(path):
     try:
-        return json.dump(obj, gzip.open(path, 'wt'), **kwargs)
+        st = os.stat(path)
     except OSError:
-        raise SleipnirDbError('Could not write JSON file.')
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
 
-def _load_index(d): return _jsonload(os.path.join(d, 'index.json.gz'))
-def _dump_index(i, d): return _jsondump(i, os.path.join(d, 'index.json.gz'))
+def _file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+def _make_database(path):
+    # build the database in a temporary directory and move it into
+    # place, so processes starting at once don't see it half made
+    parent = os.path.dirname(os.path.abspath(path))
+    tmp = mkdtemp(dir=parent)
+    os.chmod(tmp, 0o755)
+    _dump_index({'corpora': {}}, tmp)
+    os.mkdir(os.path.join(tmp, 'data'))
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp)  # another process made it first
 
 def _make_new_id(size):
     return urlsafe_b64encode(uuid4().bytes)[:size].decode('ascii')
 
-def _make_corpus_directory(xc):
+def _make_corpus_directory(xc, codec, languages=None):
     cdir = mkdtemp()
-    # add IGT files
-    igts = list(xc)
-    # corpus index is corpus info w/ mapping to IGT files instead of IGTs
-    xc.clear()
-    cindex = xigtjson.encode(xc)
-    cindex['igt_index'] = {}
-    cindex['igts'] = []
+    try:
+        # corpus index is corpus info w/ mapping to IGT records instead
+        # of IGTs; the records are written a batch at a time as the
+        # corpus is iterated, so only a batch of IGTs is in memory
+        cindex = _encode_corpus_header(xc)
+        cindex['igt_index'] = {}
+        cindex['igts'] = []
+        cindex['stats'] = _new_stats()
+        cindex['data_file'] = _new_data_file(cdir)
+        cindex['codec'] = codec
+        open(os.path.join(cdir, cindex['data_file']), 'wb').close()
+        for igts in _iter_batches(xc):
+            _validate_igts(igts)
+            _apply_records(
+                cindex, _add_igts(igts, cdir, cindex, languages)
+            )
+        _dump_index(cindex, cdir)
+    except Exception:
+        shutil.rmtree(cdir, ignore_errors=True)
+        raise
+    return cdir, cindex['stats']
+
+def _add_igts(igts, cdir, cindex, languages=None):
+    # append the IGTs to the data file and return the journal records
+    # that add them to the index; see add_corpora() for *languages*
+    ids = set()
     for igt in igts:
-        _add_igt(igt, cdir, cindex, False)
-    # refresh igt ID to path mapping once at the end
-    _refresh_igt_index(cindex)
-    _dump_index(cindex, cdir)
-    return cdir, len(igts)
-
-def _add_igt(igt, cdir, cindex=None, refresh=True):
-    if cindex is None:
-        cindex = _load_index(cdir)
-
-    if igt.id in cindex['igt_index']:
-        raise SleipnirDbError(
-            'Igt ID "{}" already exists in corpus.'.format(igt.id),
+        if igt.id in ids or igt.id in cindex['igt_index']:
+            raise SleipnirDbError(
+                'Igt ID "{}" already exists in corpus.'.format(igt.id),
+                status_code=409
+            )
+        ids.add(igt.id)
+
+    spans = _append_records(cdir, cindex, map(xigtjson.encode_igt, igts))
+    version = _next_version(cindex)
+    entries = []
+    for igt, (offset, length, size) in zip(igts, spans):
+        entry = _igt_entry_values(igt)
+        if languages is not None and igt.id in languages:
+            entry['language_code'], entry['language_name'] = \
+                languages[igt.id]
+        entry.update(
+            id=igt.id, offset=offset, length=length, size=size,
+            version=version
         )
+        entries.append(entry)
+    return [
+        _version_record(version, data_file=cindex['data_file']),
+        {'op': 'put', 'igts': entries}
+    ]
 
-    while True:
-        fn = '%s.json.gz' % _make_new_id(4)
-        igtpath = os.path.join(cdir, fn)
-        if not os.path.exists(igtpath):
-            break
-    _jsondump(xigtjson.encode_igt(igt), igtpath)
+def _igt_entry_values(igt, old=None):
+    # the index entry values that describe an IGT's content; if *old*
+    # is the entry of the IGT it replaces, see _keep_language()
     lgcode, lgname = _igt_lang_info(igt)
-    cindex['igts'].append({
-        'id': igt.id,
+    if old is not None:
+        lgcode, lgname = _keep_language((lgcode, lgname), old)
+    item_count, tier_types = _igt_stats(igt)
+    return {
         'tier_count': len(igt),
+        'item_count': item_count,
+        'tier_types': tier_types,
         'language_code': lgcode,
         'language_name': lgname,
-        'path': fn
-    })
-    if refresh:
-        _refresh_igt_index(cindex)
-        _dump_index(cindex, cdir)
-    # return the updated cindex so the caller can see the effect (in case
-    # it didn't pass in a cindex)
-    return cindex
+        'features': igt_features(igt)
+    }
+
+# the values of IGT index entries that the statistics are made from
+_stats_keys = ('tier_count', 'item_count', 'tier_types',
+               'language_code', 'language_name')
+
+def _igt_stats(igt):
+    # the number of items, and the number of tiers of each type
+    item_count = 0
+    tier_types = defaultdict(int)
+    for tier in igt.tiers:
+        item_count += len(tier)
+        if tier.type is not None:
+            tier_types[tier.type] += 1
+    return item_count, dict(tier_types)
+
+def _new_stats():
+    return {
+        'igt_count': 0,
+        'tier_count': 0,
+        'item_count': 0,
+        'languages': {},
+        'tier_types': {}
+    }
+
+def _add_count(counts, key, n):
+    n += counts.get(key, 0)
+    if n:
+        counts[key] = n
+    else:
+        counts.pop(key, None)
+
+def _add_entry_stats(stats, entry, sign=1):
+    # add (or, if *sign* is -1, remove) what an IGT index entry
+    # contributes to *stats*; entries from before item counts and tier
+    # types were recorded contribute none
+    stats['igt_count'] += sign
+    stats['tier_count'] += sign * entry.get('tier_count', 0)
+    stats['item_count'] += sign * entry.get('item_count', 0)
+    code = entry.get('language_code', 'und')
+    names = stats['languages'].setdefault(code, {})
+    _add_count(names, entry.get('language_name', '???'), sign)
+    if not names:
+        del stats['languages'][code]
+    for tier_type, n in entry.get('tier_types', {}).items():
+        _add_count(stats['tier_types'], tier_type, sign * n)
+
+def _merge_stats(stats, other, sign=1):
+    # add (or remove) statistics *other*, e.g., a corpus's, to *stats*
+    for key in ('igt_count', 'tier_count', 'item_count'):
+        stats[key] += sign * other[key]
+    for code, names in other['languages'].items():
+        totals = stats['languages'].setdefault(code, {})
+        for name, n in names.items():
+            _add_count(totals, name, sign * n)
+        if not totals:
+            del stats['languages'][code]
+    for tier_type, n in other['tier_types'].items():
+        _add_count(stats['tier_types'], tier_type, sign * n)
+
+def _copy_stats(stats):
+    copy = _new_stats()
+    _merge_stats(copy, stats)
+    return copy
+
+def _init_stats(index):
+    # indexes from before statistics were kept get them when loaded
+    if 'stats' in index:
+        return
+    stats = _new_stats()
+    if 'corpora' in index:
+        for entry in index['corpora'].values():
+            if 'stats' in entry:
+                _merge_stats(stats, entry['stats'])
+    else:
+        for entry in index['igts']:
+            _add_entry_stats(stats, entry)
+    index['stats'] = stats
+
+_OLAC = 'http://www.language-archives.org/OLAC/1.1/'
 
 def _igt_lang_info(igt):
-    code = xp.find(igt, 'metadata//dc:subject/@olac:code').replace(':', '-')
+    code = None
+    for subject in xp.findall(igt, 'metadata//dc:subject'):
+        code = _olac_code(subject)
+        if code is not None:
+            break
+    code = code or 'und'
     name = xp.find(igt, 'metadata//dc:subject/text()')
-    return (code.lower(), name or '')
+    return (code.replace(':', '-').lower(), name or '')
+
+def _olac_code(subject):
+    # IGTs decoded from XigtJSON keep prefixed attribute names (e.g.,
+    # "olac:code"), which xigtpath can't find, so resolve them here
+    code = subject.attributes.get('{%s}code' % _OLAC)
+    if code is None:
+        for key, val in subject.attributes.items():
+            prefix, _, name = key.partition(':')
+            if name == 'code' and subject.nsmap.get(prefix) == _OLAC:
+                return val
+    return code
+
+def _keep_language(lang, entry):
+    # an IGT replacing the one of *entry* keeps its language unless a
+    # new one is found (e.g., a record without the OLAC namespace has
+    # none)
+    if lang[0] == 'und' and entry.get('language_code') is not None:
+        return entry['language_code'], entry.get('language_name') or ''
+    return lang
+
+def _corpus_header(cindex):
+    # the corpus-level data in the corpus index, without the IGTs
+    xcd = {}
+    if 'namespaces' in cindex: xcd['namespaces'] = cindex['namespaces']
+    if 'namespace' in cindex: xcd['namespace'] = cindex['namespace']
+    if 'attributes' in cindex: xcd['attributes'] = cindex['attributes']
+    if 'metadata' in cindex: xcd['metadata'] = cindex['metadata']
+    return xcd
+
+def _query_chunk(cdir, data_file, codec, entries, paths):
+    # Run in a query worker process: return a (position, hits) pair
+    # for each entry whose IGT matches all *paths* (see query_hits()).
+    matches = []
+    cindex = {'data_file': data_file, 'codec': codec}
+    with _RecordReader(cdir, cindex) as reader:
+        for i, entry in enumerate(entries):
+            igt = xigtjson.decode_igt(reader.read(entry))
+            hits = query_hits(igt, paths)
+            if hits is not None:
+                matches.append((i, hits))
+    return matches
+
+def _select_entries(cindex, ids, cursor=None, limit=None):
+    # Return the index entries for the IGT *ids* (or all IGTs, in corpus
+    # order). If *cursor* is given, the entries start from the one with
+    # that ID, and *limit* caps the number of entries. The entries are
+    # a copy, as IGTs may be added to the index while they are read.
+    entries = cindex['igts']
+    igtidx = cindex['igt_index']
+    if ids is not None:
+        missing = [_id for _id in ids if _id not in igtidx]
+        if missing:
+            raise SleipnirDbError(
+                'Requested IGTs not found: {}'.format(', '.join(missing)),
+                status_code=404
+            )
+        if cursor is not None:
+            if cursor not in ids:
+                raise SleipnirDbError(
+                    'Invalid cursor: {}'.format(cursor), status_code=400
+                )
+            ids = ids[ids.index(cursor):]
+            cursor = None
+        entries = [entries[igtidx[_id]] for _id in ids]
+    start = 0
+    if cursor is not None:
+        if cursor not in igtidx:
+            raise SleipnirDbError(
+                'Invalid cursor: {}'.format(cursor), status_code=400
+            )
+        start = igtidx[cursor]
+    end = None if limit is None else start + limit
+    return entries[start:end]
+
+def _make_feature_map(cindex):
+    feature_ids = defaultdict(set)
+    unknown = set()
+    for entry in cindex['igts']:
+        if 'features' in entry:
+            for feature in entry['features']:
+                feature_ids[feature].add(entry['id'])
+        else:
+            unknown.add(entry['id'])
+    return feature_ids, unknown
+
+def _next_version(index):
+    # an index's version increases with every change; IGT entries take
+    # the version of the change that last wrote them
+    return index.get('version', 0) + 1
+
+def _version_record(version, **values):
+    # a journal record setting the version and modification time (and
+    # any other *values*) of an index
+    values.update(version=version, modified=time.time())
+    return {'op': 'set', 'values': values}
+
+# decoded IGTs take roughly this many times the size of their JSON
+_IGT_SIZE_FACTOR = 24
+
+def _igt_size(entry):
+    # entries written before sizes were recorded get a rough guess
+    size = entry.get('size', 4 * entry.get('length', 1024))
+    return _IGT_SIZE_FACTOR * size
 
 def _refresh_igt_index(cindex):
     igt_index = {}
@@ -0,0 +1,916 @@
+# SQLite backend for Sleipnir
+#
+# config['DATABASE_PATH'] should be the path of an SQLite database
+# file; it is created if it doesn't exist. The database has a table of
+# corpora (their names, IGT counts, versions, modification times, and
+# corpus-level data as XigtJSON without the IGTs), a table of IGTs
+# (the XigtJSON of each IGT along with its position in the corpus and
+# the summary data that the filesystem backend keeps in its corpus
+# indexes), and a table of the structural features of each IGT (see
+# sleipnir.query) for narrowing path queries. A single-row table holds
+# the version and modification time of the database as a whole.
+# Corpus statistics (tier and item counts in the corpora table, and
+# tables of the IGT count of each language and the tier count of each
+# tier type) are updated with each change to the IGTs, so summaries
+# don't scan them. Listings, summaries, and ID lookups are done with
+# SQL queries, and IGTs are only decoded when they are returned.
+#
+# The database uses write-ahead logging, so readers don't wait for
+# writers (or each other), and each thread and process gets its own
+# connection.
+#
+
+import os
+import time
+import sqlite3
+import json
+from itertools import islice
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import local
+
+from xigt import XigtCorpus
+from xigt.codecs import xigtjson
+
+from sleipnir import metrics, patch, batch
+from sleipnir.interfaces import SleipnirDatabaseInterface
+from sleipnir.interfaces.filesystem import (
+    _validate_igts, _validate_corpus_ids, _batch_argument,
+    _igt_lang_info, _keep_language, _corpus_header, _encode_corpus_header,
+    _iter_batches, _make_new_id, _iter_json_corpus, _decode_igt,
+    _IGT_SIZE_FACTOR, _igt_stats, _new_stats, _add_entry_stats,
+    _merge_stats, _stats_keys
+)
+from sleipnir.errors import SleipnirDbError
+from sleipnir.cache import LRUCache
+from sleipnir.query import (
+    igt_features, path_features, iter_hits, fill_matches, normalize_paths,
+    add_results, matches_size
+)
+from sleipnir.projection import make_projection, project_record
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS corpora (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    header TEXT NOT NULL,
+    igt_count INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0,
+    modified REAL,
+    tier_count INTEGER NOT NULL DEFAULT 0,
+    item_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS igts (
+    corpus_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    tier_count INTEGER NOT NULL,
+    language_code TEXT NOT NULL,
+    language_name TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    item_count INTEGER NOT NULL,
+    tier_types TEXT NOT NULL,
+    PRIMARY KEY (corpus_id, id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS igts_position
+    ON igts (corpus_id, position);
+CREATE INDEX IF NOT EXISTS igts_language
+    ON igts (corpus_id, language_code, language_name);
+CREATE TABLE IF NOT EXISTS igt_features (
+    corpus_id TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    igt_id TEXT NOT NULL,
+    PRIMARY KEY (corpus_id, feature, igt_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS igt_features_igt
+    ON igt_features (corpus_id, igt_id);
+CREATE TABLE IF NOT EXISTS corpus_languages (
+    corpus_id TEXT NOT NULL,
+    code TEXT NOT NULL,
+    name TEXT NOT NULL,
+    igt_count INTEGER NOT NULL,
+    PRIMARY KEY (corpus_id, code, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS corpus_tier_types (
+    corpus_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    tier_count INTEGER NOT NULL,
+    PRIMARY KEY (corpus_id, type)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS database (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    version INTEGER NOT NULL,
+    modified REAL
+);
+INSERT OR IGNORE INTO database (id, version) VALUES (0, 0);
+'''
+
+# SQLite limits the number of parameters in a statement
+_MAX_PARAMS = 500
+
+
+class SqliteDbi(SleipnirDatabaseInterface):
+    raw_formats = ['application/json']
+
+    def __init__(self, path, igt_cache_bytes=None, query_cache_size=256,
+                 query_cache_bytes=None, timeout=30):
+        SleipnirDatabaseInterface.__init__(self, path)
+        # seconds a writer waits for another writer to finish
+        self.timeout = timeout
+        # decoded IGTs, keyed by (corpus_id, igt_id, version)
+        self._igts = LRUCache(maxsize=None, maxbytes=igt_cache_bytes)
+        # the results of whole-corpus path queries, as for the
+        # filesystem backend
+        self._queries = None
+        if query_cache_size:
+            self._queries = LRUCache(
+                maxsize=query_cache_size, maxbytes=query_cache_bytes
+            )
+        self._local = local()
+        conn = self._conn()
+        conn.executescript(_schema)
+
+    def _conn(self):
+        # one connection per thread (and per process, as connections
+        # must not be used across a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        # writers take the write lock up front, so what they read
+        # (e.g., to check for duplicate IDs) is still true when they
+        # write
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _get_corpus_row(self, corpus_id, conn=None):
+        conn = conn or self._conn()
+        row = conn.execute(
+            'SELECT name, header, igt_count, version, modified FROM corpora'
+            ' WHERE id = ?',
+            (corpus_id,)
+        ).fetchone()
+        if row is None:
+            raise SleipnirDbError('Index entry missing: %s' % corpus_id)
+        return row
+
+    def _select(self, corpus_id, columns, ids=None, cursor=None,
+                limit=None, features=None):
+        # Return an iterable of rows with *columns* for the IGT *ids*
+        # (or all IGTs, in corpus order), as _select_entries() does for
+        # the filesystem backend. IGTs lacking any of *features* are
+        # skipped. Errors are raised before iteration begins.
+        conn = self._conn()
+        self._get_corpus_row(corpus_id, conn)
+        cols = ', '.join(columns)
+        where = ['corpus_id = ?']
+        params = [corpus_id]
+        for feature in sorted(features or ()):
+            where.append(
+                'id IN (SELECT igt_id FROM igt_features'
+                ' WHERE corpus_id = ? AND feature = ?)'
+            )
+            params.extend([corpus_id, feature])
+        if ids is None:
+            start = 0
+            if cursor is not None:
+                row = conn.execute(
+                    'SELECT position FROM igts WHERE corpus_id = ? AND id = ?',
+                    (corpus_id, cursor)
+                ).fetchone()
+                if row is None:
+                    raise SleipnirDbError(
+                        'Invalid cursor: {}'.format(cursor), status_code=400
+                    )
+                start = row[0]
+            return conn.execute(
+                'SELECT {} FROM igts WHERE {} AND position >= ?'
+                ' ORDER BY position LIMIT ?'
+                .format(cols, ' AND '.join(where)),
+                params + [start, -1 if limit is None else limit]
+            )
+        ids = list(ids)
+        found = set()
+        for chunk in _chunks(ids):
+            found.update(r[0] for r in conn.execute(
+                'SELECT id FROM igts WHERE corpus_id = ? AND id IN ({})'
+                .format(_placeholders(chunk)),
+                [corpus_id] + chunk
+            ))
+        missing = [_id for _id in ids if _id not in found]
+        if missing:
+            raise SleipnirDbError(
+                'Requested IGTs not found: {}'.format(', '.join(missing)),
+                status_code=404
+            )
+        if cursor is not None:
+            if cursor not in ids:
+                raise SleipnirDbError(
+                    'Invalid cursor: {}'.format(cursor), status_code=400
+                )
+            ids = ids[ids.index(cursor):]
+        if limit is not None:
+            ids = ids[:limit]
+        rows = {}
+        for chunk in _chunks(ids):
+            for row in conn.execute(
+                    'SELECT id, {} FROM igts WHERE {} AND id IN ({})'
+                    .format(cols, ' AND '.join(where), _placeholders(chunk)),
+                    params + chunk):
+                rows[row[0]] = row[1:]
+        return [rows[_id] for _id in ids if _id in rows]
+
+    def _decode(self, corpus_id, rows, projection=None):
+        # rows are (id, version, data) triples; the decoded IGTs are
+        # shared with the IGT cache, so don't modify them (projected
+        # IGTs are cached apart from whole ones)
+        for igt_id, version, data in rows:
+            key = (corpus_id, igt_id, version)
+            if projection is not None:
+                key += (projection,)
+            igt = self._igts.get(key)
+            if igt is None:
+                igt = _decode_data(data, projection=projection)
+                self._igts.put(key, igt, size=_IGT_SIZE_FACTOR * len(data))
+            yield igt
+
+    def list_corpora(self):
+        return [
+            {'id': corpus_id, 'name': name, 'igt_count': igt_count}
+            for corpus_id, name, igt_count in self._conn().execute(
+                'SELECT id, name, igt_count FROM corpora ORDER BY rowid'
+            )
+        ]
+
+    def corpus_summary(self, corpus_id, cursor=None, limit=None):
+        conn = self._conn()
+        name, _, igt_count, _, _ = self._get_corpus_row(corpus_id, conn)
+        stats = _corpus_stats(conn, corpus_id)
+        # get one more than the limit to find the next page's cursor
+        rows = list(self._select(
+            corpus_id, ('id', 'tier_count'), cursor=cursor,
+            limit=None if limit is None else limit + 1
+        ))
+        summary = {
+            'id': corpus_id,
+            'name': name,
+            'igt_count': igt_count,
+            'tier_count': stats['tier_count'],
+            'item_count': stats['item_count'],
+            'languages': stats['languages'],
+            'tier_types': stats['tier_types'],
+            'igts': [
+                {'id': igt_id, 'tier_count': tier_count}
+                for igt_id, tier_count in rows[:limit]
+            ]
+        }
+        if limit is not None and len(rows) > limit:
+            summary['next_cursor'] = rows[limit][0]
+        return summary
+
+    def get_stats(self):
+        """
+        Return the IGT, tier, and item counts, the IGT count of each
+        language (by code and name), and the tier count of each tier
+        type, totalled over the database and for each corpus. Only the
+        statistics tables are read.
+        """
+        conn = self._conn()
+        stats = _new_stats()
+        corpora = []
+        for corpus_id, name in conn.execute(
+                'SELECT id, name FROM corpora ORDER BY rowid').fetchall():
+            corpus_stats = _corpus_stats(conn, corpus_id)
+            _merge_stats(stats, corpus_stats)
+            corpora.append(dict(corpus_stats, id=corpus_id, name=name))
+        stats['corpus_count'] = len(corpora)
+        stats['corpora'] = corpora
+        return stats
+
+    def get_languages(self, corpus_id):
+        """
+        Return a dict mapping the ID of each IGT in the corpus to the
+        (code, name) pair of its language, as kept for the statistics.
+        No IGT data is read.
+        """
+        return dict(
+            (igt_id, (lgcode, lgname))
+            for igt_id, lgcode, lgname in self._select(
+                corpus_id, ('id', 'language_code', 'language_name')
+            )
+        )
+
+    def get_version(self, corpus_id=None, igt_id=None):
+        """
+        Return the version and modification time (in seconds since the
+        epoch, or `None` if unknown) of the database (if *corpus_id* is
+        `None`), a corpus, or an IGT. No IGT data is read.
+        """
+        conn = self._conn()
+        if corpus_id is None:
+            return conn.execute(
+                'SELECT version, modified FROM database'
+            ).fetchone()
+        _, _, _, version, modified = self._get_corpus_row(corpus_id, conn)
+        if igt_id is not None:
+            version = next(iter(self._select(
+                corpus_id, ('version',), ids=[igt_id]
+            )))[0]
+        # IGTs don't record when they were changed, so the corpus's
+        # time is used (which is no earlier)
+        return version, modified
+
+    def fetch_raw_corpus(self, corpus_id, mimetype):
+        return ''.join(self.iter_raw_corpus(corpus_id, mimetype))
+
+    def iter_raw_corpus(self, corpus_id, mimetype):
+        if mimetype != 'application/json':
+            raise SleipnirDbError(
+                'Unsupported mimetype for raw corpus: %s' % mimetype
+            )
+        header = json.loads(self._get_corpus_row(corpus_id)[1])
+        rows = self._select(corpus_id, ('data',))
+        return _iter_json_corpus(header, (row[0] for row in rows))
+
+    def get_corpus(self, corpus_id, ids=None, mode='full', tiers=None,
+                   fields=None):
+        projection = make_projection(tiers, fields)
+        xcd = json.loads(self._get_corpus_row(corpus_id)[1])
+        rows = self._select(corpus_id, ('data',), ids=ids)
+        nsmap = xigtjson.active_namespaces(xcd, None)
+        # in a non-full mode the IGTs are decoded as the corpus is
+        # iterated
+        return XigtCorpus(
+            attributes=xcd.get('attributes', {}),
+            metadata=[xigtjson.decode_metadata(md, nsmap)
+                      for md in xcd.get('metadata', [])],
+            igts=(_decode_data(row[0], nsmap, projection) for row in rows),
+            mode=mode,
+            namespace=xcd.get('namespace'),
+            nsmap=xcd.get('namespaces')
+        )
+
+    def get_igts(self, corpus_id, ids=None, paths=None,
+                 cursor=None, limit=None, tiers=None, fields=None):
+        return list(self.iter_igts(
+            corpus_id, ids=ids, paths=paths, cursor=cursor, limit=limit,
+            tiers=tiers, fields=fields
+        ))
+
+    def iter_igts(self, corpus_id, ids=None, paths=None,
+                  cursor=None, limit=None, tiers=None, fields=None):
+        """
+        Iterate over the IGTs of a corpus, as for the filesystem
+        backend (path queries are cached the same way). Unless *paths* are given, the IGTs are shared with the
+        IGT cache, so don't modify them (nor those from get_igts(),
+        get_igt(), or get_igt_batch()); modify a copy from
+        sleipnir.projection.project_igt() instead.
+        """
+        projection = make_projection(tiers, fields)
+        columns = ('id', 'version', 'data')
+        if paths is None:
+            rows = self._select(
+                corpus_id, columns, ids=ids, cursor=cursor, limit=limit
+            )
+            return self._decode(corpus_id, rows, projection=projection)
+        features = set()
+        for path in paths:
+            features.update(path_features(path))
+        key, matches = self._cached_matches(corpus_id, paths)
+        if matches is not None:
+            # only the matching IGTs are read
+            selected = self._select(
+                corpus_id, ('id',), ids=ids, cursor=cursor, features=features
+            )
+            matched = islice(
+                (igt_id for igt_id, in selected if igt_id in matches), limit
+            )
+            return self._iter_matched(
+                corpus_id, list(matched), matches, projection
+            )
+        rows = self._select(
+            corpus_id, columns, ids=ids, cursor=cursor, features=features
+        )
+        pairs = iter_hits(self._decode(corpus_id, rows), paths)
+        if key is not None and ids is None and cursor is None:
+            # cached if the query gets to the end of the corpus
+            igts = fill_matches(pairs, projection, self._cache_matches(key))
+        else:
+            igts = (add_results(igt, hits, projection)
+                    for igt, hits in pairs)
+        return islice(igts, limit)
+
+    def _cached_matches(self, corpus_id, paths):
+        # Return the query cache key for *paths* on the corpus and the
+        # cached query hits of every IGT in it matching all *paths*, or
+        # `None` if they aren't cached (see FileSystemDbi).
+        if self._queries is None:
+            return None, None
+        version, modified = self._get_corpus_row(corpus_id)[3:]
+        key = (corpus_id, version, modified, normalize_paths(paths))
+        return key, self._queries.get(key)
+
+    def _cache_matches(self, key):
+        # a function that caches the query hits it's given under *key*
+        def put(matches):
+            self._queries.put(key, matches, size=matches_size(matches))
+        return put
+
+    def _iter_matched(self, corpus_id, ids, matches, projection=None):
+        # the IGTs with *ids*, read a chunk at a time, with the query
+        # results for their hits in *matches*
+        for chunk in _chunks(ids):
+            rows = self._select(
+                corpus_id, ('id', 'version', 'data'), ids=chunk
+            )
+            for igt in self._decode(corpus_id, rows):
+                yield add_results(igt, matches[igt.id], projection)
+
+    def _forget_queries(self, corpus_id):
+        if self._queries is not None:
+            self._queries.discard_if(lambda key: key[0] == corpus_id)
+
+    # get_igt() just uses the default from SleipnirDatabaseInterface
+
+    def get_igt_batch(self, pairs, tiers=None, fields=None, workers=4):
+        """
+        Get the IGTs for (corpus ID, IGT ID) *pairs* from any corpora,
+        with a result for each pair that has the IGT or an error (see
+        sleipnir.batch). Each corpus's IGTs are selected together, by
+        up to *workers* threads.
+        """
+        return batch.get_igt_batch(
+            self, pairs, self._fetch_igts,
+            projection=make_projection(tiers, fields), workers=workers
+        )
+
+    def _fetch_igts(self, corpus_id, ids, projection=None):
+        # the decoded IGTs among *ids* that exist, by ID
+        conn = self._conn()
+        self._get_corpus_row(corpus_id, conn)
+        rows = []
+        for chunk in _chunks(ids):
+            rows.extend(conn.execute(
+                'SELECT id, version, data FROM igts'
+                ' WHERE corpus_id = ? AND id IN ({})'
+                .format(_placeholders(chunk)),
+                [corpus_id] + chunk
+            ))
+        igts = self._decode(corpus_id, rows, projection=projection)
+        return dict((igt.id, igt) for igt in igts)
+
+    def add_corpus(self, xc, name=None):
+        return self.add_corpora([xc], names=[name])[0]
+
+    def add_corpora(self, xcs, names=None, ids=None, languages=None):
+        """
+        Add each corpus in *xcs* (named by the corresponding item in
+        *names*, if given) in one transaction. Corpus IDs are generated
+        unless *ids* gives them, and the languages of IGTs are found in
+        their metadata unless *languages* gives a dict for each corpus
+        like get_languages() returns.
+        """
+        xcs = list(xcs)
+        names = _batch_argument(names, xcs, 'names')
+        ids = _batch_argument(ids, xcs, 'ids')
+        languages = _batch_argument(languages, xcs, 'languages')
+        _validate_corpus_ids(ids)
+        results = []
+        with self._transaction() as conn:
+            taken = [_id for _id in ids if _id is not None
+                     and _corpus_exists(conn, _id)]
+            if taken:
+                raise SleipnirDbError(
+                    'Corpus ID already exists: {}'.format(', '.join(taken)),
+                    status_code=409
+                )
+            for xc, name, corpus_id, langs in zip(
+                    xcs, names, ids, languages):
+                while corpus_id is None:
+                    corpus_id = _make_new_id(6)
+                    if corpus_id in ids or _corpus_exists(conn, corpus_id):
+                        corpus_id = None
+                # the corpus without its IGTs, as in a corpus index
+                header = _corpus_header(_encode_corpus_header(xc))
+                conn.execute(
+                    'INSERT INTO corpora (id, name, header) VALUES (?, ?, ?)',
+                    (corpus_id, corpus_id if name is None else name,
+                     json.dumps(header))
+                )
+                # the corpus may be transient, so insert its IGTs as
+                # they are read
+                igt_count = 0
+                for igts in _iter_batches(xc):
+                    _validate_igts(igts)
+                    _insert_igts(conn, corpus_id, igts, langs)
+                    igt_count += len(igts)
+                results.append({'id': corpus_id, 'igt_count': igt_count})
+            _touch_database(conn)
+        return results
+
+    def add_igt(self, corpus_id, igt):
+        return self.add_igts(corpus_id, [igt])['igts'][0]
+
+    def add_igts(self, corpus_id, igts):
+        """
+        Add every IGT in *igts* to the corpus in one transaction. If
+        any IGT lacks an ID or has one already in use, none are added.
+        """
+        igts = list(igts)
+        if any(igt.id is None for igt in igts):
+            raise SleipnirDbError(
+                'IGTs must have an ID', status_code=400
+            )
+        with self._transaction() as conn:
+            self._get_corpus_row(corpus_id, conn)
+            _insert_igts(conn, corpus_id, igts)
+        self._forget_queries(corpus_id)
+        return {
+            'igt_count': len(igts),
+            'igts': [{'id': igt.id, 'tier_count': len(igt)} for igt in igts]
+        }
+
+    def set_igt(self, corpus_id, igt_id, igt):
+        if igt is None:
+            raise SleipnirDbError(
+                'Cannot assign empty IGT; delete the IGT instead.'
+            )
+        # ensure new igt's ID maps the target
+        if igt.id is None:
+            try:
+                igt.id = igt_id
+            except ValueError:
+                raise SleipnirDbError(
+                    'Invalid ID: {}'.format(igt_id),
+                    status_code=400
+                )
+        elif igt.id != igt_id:
+            raise SleipnirDbError(
+                'Igt ID must match requested ID: {} != {}'
+                .format(str(igt.id), igt_id),
+                status_code=400
+            )
+        with self._transaction() as conn:
+            self._get_corpus_row(corpus_id, conn)
+            row = conn.execute(
+                'SELECT version FROM igts WHERE corpus_id = ? AND id = ?',
+                (corpus_id, igt_id)
+            ).fetchone()
+            if row is None:  # target doesn't exist; just add
+                _insert_igts(conn, corpus_id, [igt])
+                created = True
+            else:  # target exists; replace
+                self._igts.discard((corpus_id, igt_id, row[0]))
+                version = _next_version(conn, corpus_id)
+                old = _igt_entry(conn, corpus_id, igt_id)
+                lgcode, lgname = _keep_language(_igt_lang_info(igt), old)
+                item_count, tier_types = _igt_stats(igt)
+                conn.execute(
+                    'UPDATE igts SET tier_count = ?, language_code = ?,'
+                    ' language_name = ?, version = ?, data = ?,'
+                    ' item_count = ?, tier_types = ?'
+                    ' WHERE corpus_id = ? AND id = ?',
+                    (len(igt), lgcode, lgname, version,
+                     json.dumps(xigtjson.encode_igt(igt)),
+                     item_count, json.dumps(tier_types),
+                     corpus_id, igt_id)
+                )
+                _update_stats(conn, corpus_id, [old], sign=-1)
+                _update_stats(
+                    conn, corpus_id, [_igt_entry(conn, corpus_id, igt_id)]
+                )
+                conn.execute(
+                    'DELETE FROM igt_features'
+                    ' WHERE corpus_id = ? AND igt_id = ?',
+                    (corpus_id, igt_id)
+                )
+                _insert_features(conn, corpus_id, [igt])
+                created = False
+        self._forget_queries(corpus_id)
+        return {'id': igt_id, 'created': created}
+
+    def patch_igt(self, corpus_id, igt_id, operations):
+        """
+        Apply the patch *operations* (see sleipnir.patch) to an IGT,
+        updating only its row, the features it gained or lost, and the
+        corpus statistics.
+        """
+        with self._transaction() as conn:
+            self._get_corpus_row(corpus_id, conn)
+            row = conn.execute(
+                'SELECT version, data FROM igts'
+                ' WHERE corpus_id = ? AND id = ?',
+                (corpus_id, igt_id)
+            ).fetchone()
+            if row is None:
+                raise SleipnirDbError(
+                    'Requested IGTs not found: {}'.format(igt_id),
+                    status_code=404
+                )
+            record, igt, fields = patch.patch_igt(
+                json.loads(row[1]), operations
+            )
+            old = _igt_entry(conn, corpus_id, igt_id)
+            entry = dict(old)
+            item_count, tier_types = _igt_stats(igt)
+            entry.update(tier_count=len(igt), item_count=item_count,
+                         tier_types=tier_types)
+            if 'metadata' in fields:
+                # only the metadata can change the language
+                lgcode, lgname = _keep_language(_igt_lang_info(igt), old)
+                entry.update(language_code=lgcode, language_name=lgname)
+            version = _next_version(conn, corpus_id)
+            conn.execute(
+                'UPDATE igts SET tier_count = ?, language_code = ?,'
+                ' language_name = ?, version = ?, data = ?,'
+                ' item_count = ?, tier_types = ?'
+                ' WHERE corpus_id = ? AND id = ?',
+                (entry['tier_count'], entry['language_code'],
+                 entry['language_name'], version, json.dumps(record),
+                 item_count, json.dumps(tier_types), corpus_id, igt_id)
+            )
+            if any(old[key] != entry[key] for key in _stats_keys):
+                _update_stats(conn, corpus_id, [old], sign=-1)
+                _update_stats(conn, corpus_id, [entry])
+            features = set(igt_features(igt))
+            old_features = set(f for f, in conn.execute(
+                'SELECT feature FROM igt_features'
+                ' WHERE corpus_id = ? AND igt_id = ?',
+                (corpus_id, igt_id)
+            ))
+            conn.executemany(
+                'DELETE FROM igt_features'
+                ' WHERE corpus_id = ? AND feature = ? AND igt_id = ?',
+                ((corpus_id, f, igt_id) for f in old_features - features)
+            )
+            conn.executemany(
+                'INSERT INTO igt_features (corpus_id, feature, igt_id)'
+                ' VALUES (?, ?, ?)',
+                ((corpus_id, f, igt_id) for f in features - old_features)
+            )
+        self._igts.discard((corpus_id, igt_id, row[0]))
+        self._forget_queries(corpus_id)
+        return {'id': igt_id, 'version': version}
+
+    def patch_corpus(self, corpus_id, operations):
+        """
+        Apply the patch *operations* (see sleipnir.patch) to the
+        corpus-level data (metadata and attributes) and name of a
+        corpus.
+        """
+        with self._transaction() as conn:
+            name, header = self._get_corpus_row(corpus_id, conn)[:2]
+            header, name, fields = patch.patch_corpus(
+                json.loads(header), name, operations
+            )
+            conn.execute(
+                'UPDATE corpora SET name = ?, header = ? WHERE id = ?',
+                (name or corpus_id, json.dumps(header), corpus_id)
+            )
+            version = _next_version(conn, corpus_id)
+        self._forget_queries(corpus_id)
+        return {'id': corpus_id, 'version': version}
+
+    def cache_info(self):
+        info = {'igt': self._igts.info()}
+        if self._queries is not None:
+            info['query'] = self._queries.info()
+        return info
+
+    def del_corpus(self, corpus_id):
+        with self._transaction() as conn:
+            self._get_corpus_row(corpus_id, conn)
+            for table, column in (('igt_features', 'corpus_id'),
+                                  ('igts', 'corpus_id'),
+                                  ('corpus_languages', 'corpus_id'),
+                                  ('corpus_tier_types', 'corpus_id'),
+                                  ('corpora', 'id')):
+                conn.execute(
+                    'DELETE FROM {} WHERE {} = ?'.format(table, column),
+                    (corpus_id,)
+                )
+            _touch_database(conn)
+        self._igts.discard_if(lambda key: key[0] == corpus_id)
+        self._forget_queries(corpus_id)
+
+    def del_igt(self, corpus_id, igt_id):
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT version FROM igts WHERE corpus_id = ? AND id = ?',
+                (corpus_id, igt_id)
+            ).fetchone()
+            if row is None:
+                raise SleipnirDbError(
+                    'Error removing IGT "{}" in corpus "{}"'
+                    .format(igt_id, corpus_id)
+                )
+            self._igts.discard((corpus_id, igt_id, row[0]))
+            _update_stats(
+                conn, corpus_id, [_igt_entry(conn, corpus_id, igt_id)],
+                sign=-1
+            )
+            conn.execute(
+                'DELETE FROM igts WHERE corpus_id = ? AND id = ?',
+                (corpus_id, igt_id)
+            )
+            conn.execute(
+                'DELETE FROM igt_features WHERE corpus_id = ? AND igt_id = ?',
+                (corpus_id, igt_id)
+            )
+            _next_version(conn, corpus_id, added=-1)
+        self._forget_queries(corpus_id)
+
+
+def _decode_data(data, nsmap=None, projection=None):
+    # decode the stored XigtJSON text of an IGT (only what *projection*
+    # keeps)
+    metrics.count('bytes_read', len(data))
+    with metrics.stage('parse_json'):
+        record = json.loads(data)
+    return _decode_igt(project_record(record, projection), nsmap)
+
+def _chunks(values):
+    for i in range(0, len(values), _MAX_PARAMS):
+        yield values[i:i+_MAX_PARAMS]
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+def _corpus_exists(conn, corpus_id):
+    return conn.execute(
+        'SELECT 1 FROM corpora WHERE id = ?', (corpus_id,)
+    ).fetchone() is not None
+
+def _next_version(conn, corpus_id, added=0):
+    # bump the corpus version (and add *added* to its IGT count) and
+    # return the new version; IGTs take the version of the change that
+    # last wrote them
+    conn.execute(
+        'UPDATE corpora SET version = version + 1, modified = ?,'
+        ' igt_count = igt_count + ? WHERE id = ?',
+        (time.time(), added, corpus_id)
+    )
+    # IGT counts are in the corpus listing, so it changes too
+    _touch_database(conn)
+    return conn.execute(
+        'SELECT version FROM corpora WHERE id = ?', (corpus_id,)
+    ).fetchone()[0]
+
+def _touch_database(conn):
+    conn.execute(
+        'UPDATE database SET version = version + 1, modified = ?',
+        (time.time(),)
+    )
+
+def _insert_igts(conn, corpus_id, igts, languages=None):
+    # see add_corpora() for *languages*
+    ids = set()
+    for igt in igts:
+        if igt.id in ids:
+            raise SleipnirDbError(
+                'Igt ID "{}" already exists in corpus.'.format(igt.id),
+                status_code=409
+            )
+        ids.add(igt.id)
+    ids = sorted(ids)
+    for chunk in _chunks(ids):
+        row = conn.execute(
+            'SELECT id FROM igts WHERE corpus_id = ? AND id IN ({}) LIMIT 1'
+            .format(_placeholders(chunk)),
+            [corpus_id] + chunk
+        ).fetchone()
+        if row is not None:
+            raise SleipnirDbError(
+                'Igt ID "{}" already exists in corpus.'.format(row[0]),
+                status_code=409
+            )
+    start = conn.execute(
+        'SELECT COALESCE(MAX(position) + 1, 0) FROM igts WHERE corpus_id = ?',
+        (corpus_id,)
+    ).fetchone()[0]
+    version = _next_version(conn, corpus_id, added=len(igts))
+    rows = []
+    entries = []
+    for position, igt in enumerate(igts, start):
+        if languages is not None and igt.id in languages:
+            lgcode, lgname = languages[igt.id]
+        else:
+            lgcode, lgname = _igt_lang_info(igt)
+        item_count, tier_types = _igt_stats(igt)
+        rows.append((
+            corpus_id, igt.id, position, len(igt), lgcode, lgname, version,
+            json.dumps(xigtjson.encode_igt(igt)),
+            item_count, json.dumps(tier_types)
+        ))
+        entries.append({
+            'tier_count': len(igt), 'item_count': item_count,
+            'tier_types': tier_types,
+            'language_code': lgcode, 'language_name': lgname
+        })
+    conn.executemany(
+        'INSERT INTO igts (corpus_id, id, position, tier_count,'
+        ' language_code, language_name, version, data,'
+        ' item_count, tier_types)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        rows
+    )
+    _insert_features(conn, corpus_id, igts)
+    _update_stats(conn, corpus_id, entries)
+
+def _insert_features(conn, corpus_id, igts):
+    conn.executemany(
+        'INSERT INTO igt_features (corpus_id, feature, igt_id)'
+        ' VALUES (?, ?, ?)',
+        ((corpus_id, feature, igt.id)
+         for igt in igts for feature in igt_features(igt))
+    )
+
+def _igt_entry(conn, corpus_id, igt_id):
+    # the statistics of a stored IGT, as in a filesystem index entry
+    tier_count, item_count, tier_types, lgcode, lgname = conn.execute(
+        'SELECT tier_count, item_count, tier_types, language_code,'
+        ' language_name FROM igts WHERE corpus_id = ? AND id = ?',
+        (corpus_id, igt_id)
+    ).fetchone()
+    return {
+        'tier_count': tier_count,
+        'item_count': item_count,
+        'tier_types': json.loads(tier_types),
+        'language_code': lgcode,
+        'language_name': lgname
+    }
+
+def _update_stats(conn, corpus_id, entries, sign=1):
+    # add (or, if *sign* is -1, remove) the statistics of IGTs
+    # described by *entries* to those of the corpus; IGT counts are
+    # kept by _next_version()
+    delta = _new_stats()
+    for entry in entries:
+        _add_entry_stats(delta, entry, sign)
+    conn.execute(
+        'UPDATE corpora SET tier_count = tier_count + ?,'
+        ' item_count = item_count + ? WHERE id = ?',
+        (delta['tier_count'], delta['item_count'], corpus_id)
+    )
+    conn.executemany(
+        'INSERT INTO corpus_languages (corpus_id, code, name, igt_count)'
+        ' VALUES (?, ?, ?, ?) ON CONFLICT (corpus_id, code, name)'
+        ' DO UPDATE SET igt_count = igt_count + excluded.igt_count',
+        ((corpus_id, code, name, n)
+         for code, names in delta['languages'].items()
+         for name, n in names.items())
+    )
+    conn.executemany(
+        'INSERT INTO corpus_tier_types (corpus_id, type, tier_count)'
+        ' VALUES (?, ?, ?) ON CONFLICT (corpus_id, type)'
+        ' DO UPDATE SET tier_count = tier_count + excluded.tier_count',
+        ((corpus_id, tier_type, n)
+         for tier_type, n in delta['tier_types'].items())
+    )
+    if sign < 0:
+        conn.execute(
+            'DELETE FROM corpus_languages'
+            ' WHERE corpus_id = ? AND igt_count <= 0', (corpus_id,)
+        )
+        conn.execute(
+            'DELETE FROM corpus_tier_types'
+            ' WHERE corpus_id = ? AND tier_count <= 0', (corpus_id,)
+        )
+
+def _corpus_stats(conn, corpus_id):
+    igt_count, tier_count, item_count = conn.execute(
+        'SELECT igt_count, tier_count, item_count FROM corpora WHERE id = ?',
+        (corpus_id,)
+    ).fetchone()
+    languages = defaultdict(dict)
+    for code, name, n in conn.execute(
+            'SELECT code, name, igt_count FROM corpus_languages'
+            ' WHERE corpus_id = ?', (corpus_id,)):
+        languages[code][name] = n
+    tier_types = dict(conn.execute(
+        'SELECT type, tier_count FROM corpus_tier_types WHERE corpus_id = ?',
+        (corpus_id,)
+    ))
+    return {
+        'igt_count': igt_count,
+        'tier_count': tier_count,
+        'item_count': item_count,
+        'languages': dict(languages),
+        'tier_types': tier_types
+    }
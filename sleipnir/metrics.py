@@ -0,0 +1,268 @@
+# Request metrics: how long the stages of handling a request take
+# (loading indexes, decompressing, parsing, and decoding IGT records,
+# evaluating queries, and serializing responses), how much is read and
+# decoded, and how long each route takes, aggregated for a Prometheus
+# scraper.
+#
+# Code doing a stage wraps it in `with metrics.stage(NAME):` and
+# reports amounts with `metrics.count(NAME, N)`. These record into the
+# current thread's request record, if start_request() began one, and
+# otherwise only look up that there is none, so they cost next to
+# nothing when metrics are off. Stages are not nested, so their times
+# add up to (at most) the time of the request.
+#
+# Stages in worker processes (see QUERY_WORKERS) are not recorded
+# individually; the time spent waiting for them counts as "query".
+
+import threading
+from time import perf_counter
+from collections import defaultdict
+
+
+class _Local(threading.local):
+    # a class default, as a missing thread-local attribute is slow
+    record = None
+
+_local = _Local()
+
+
+class RequestRecord(object):
+    """The stage times and counts of one request."""
+
+    __slots__ = ('start', 'stages', 'counts', 'status')
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.stages = {}  # name: [calls, seconds]
+        self.counts = {}  # name: total
+        self.status = None
+
+    def elapsed(self):
+        return perf_counter() - self.start
+
+    def server_timing(self):
+        """Return the record as the value of a Server-Timing header."""
+        parts = [
+            '{};dur={:.3f}'.format(name, seconds * 1000)
+            for name, (_, seconds) in sorted(self.stages.items())
+        ]
+        parts.extend(
+            '{};desc="{}"'.format(name, n)
+            for name, n in sorted(self.counts.items())
+        )
+        parts.append('total;dur={:.3f}'.format(self.elapsed() * 1000))
+        return ', '.join(parts)
+
+
+class _Stage(object):
+    __slots__ = ('record', 'name', 'start')
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        seconds = perf_counter() - self.start
+        stages = self.record.stages
+        if self.name in stages:
+            entry = stages[self.name]
+            entry[0] += 1
+            entry[1] += seconds
+        else:
+            stages[self.name] = [1, seconds]
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_null_stage = _NullStage()
+
+
+def stage(name):
+    """Return a context manager that times stage *name*."""
+    record = _local.record
+    if record is None:
+        return _null_stage
+    return _Stage(record, name)
+
+
+def count(name, n=1):
+    """Add *n* to the current request's count of *name*."""
+    record = _local.record
+    if record is not None:
+        record.counts[name] = record.counts.get(name, 0) + n
+
+
+def start_request():
+    """Begin recording for a request in the current thread."""
+    record = _local.record = RequestRecord()
+    return record
+
+
+def current_request():
+    return _local.record
+
+
+def end_request():
+    """Stop recording and return the request's record (or `None`)."""
+    record = _local.record
+    _local.record = None
+    return record
+
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+
+class Metrics(object):
+    """
+    Aggregates request records by route: counts of requests by method
+    and status, a histogram of latencies (with upper bounds *buckets*,
+    in seconds), and the totals of each stage and count.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)  # (route, method, status): n
+        # route: [count per bucket (not cumulative), sum, count]
+        self._latency = {}
+        self._stages = defaultdict(lambda: [0, 0.0])  # (route, stage)
+        self._counts = defaultdict(int)  # (route, name)
+
+    def observe(self, route, method, record):
+        seconds = record.elapsed()
+        with self._lock:
+            self._requests[(route, method, record.status or 500)] += 1
+            latency = self._latency.get(route)
+            if latency is None:
+                latency = self._latency[route] = [
+                    [0] * len(self.buckets), 0.0, 0
+                ]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    latency[0][i] += 1
+                    break
+            latency[1] += seconds
+            latency[2] += 1
+            for name, (calls, secs) in record.stages.items():
+                entry = self._stages[(route, name)]
+                entry[0] += calls
+                entry[1] += secs
+            for name, n in record.counts.items():
+                self._counts[(route, name)] += n
+
+    def render(self, caches=None):
+        """
+        Return the metrics in the Prometheus text format, including
+        the hits, misses, and sizes of *caches* (a dict of cache names
+        to their info(), e.g., from a database's cache_info()).
+        """
+        with self._lock:
+            lines = []
+            _header(lines, 'sleipnir_requests_total', 'counter',
+                    'Requests handled, by route, method, and status.')
+            for (route, method, status), n in sorted(self._requests.items()):
+                lines.append(_sample('sleipnir_requests_total', n,
+                                     route=route, method=method,
+                                     status=status))
+            _header(lines, 'sleipnir_request_duration_seconds', 'histogram',
+                    'Time to handle a request, including streaming the '
+                    'response.')
+            for route, (counts, total, n) in sorted(self._latency.items()):
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    lines.append(_sample(
+                        'sleipnir_request_duration_seconds_bucket',
+                        cumulative, route=route, le=_number(bound)
+                    ))
+                lines.append(_sample(
+                    'sleipnir_request_duration_seconds_bucket', n,
+                    route=route, le='+Inf'
+                ))
+                lines.append(_sample(
+                    'sleipnir_request_duration_seconds_sum', total,
+                    route=route
+                ))
+                lines.append(_sample(
+                    'sleipnir_request_duration_seconds_count', n, route=route
+                ))
+            _header(lines, 'sleipnir_stage_seconds', 'summary',
+                    'Time spent in each stage of handling requests.')
+            for (route, name), (calls, secs) in sorted(self._stages.items()):
+                lines.append(_sample('sleipnir_stage_seconds_sum', secs,
+                                     route=route, stage=name))
+                lines.append(_sample('sleipnir_stage_seconds_count', calls,
+                                     route=route, stage=name))
+            names = sorted(set(name for _, name in self._counts))
+            for name in names:
+                metric = 'sleipnir_{}_total'.format(name)
+                _header(lines, metric, 'counter',
+                        _count_help.get(name, name.replace('_', ' ')) + '.')
+                for (route, n_name), n in sorted(self._counts.items()):
+                    if n_name == name:
+                        lines.append(_sample(metric, n, route=route))
+        if caches:
+            _render_caches(lines, caches)
+        return '\n'.join(lines) + '\n'
+
+
+_count_help = {
+    'bytes_read': 'Bytes of IGT records and indexes read from storage',
+    'igts_decoded': 'IGTs decoded from stored records',
+}
+
+
+_cache_metrics = (
+    ('hits', 'counter', 'Cache lookups that found an entry.'),
+    ('misses', 'counter', 'Cache lookups that found no entry.'),
+    ('size', 'gauge', 'Entries in the cache.'),
+    ('bytes', 'gauge', 'Approximate size of the cache in bytes.'),
+)
+
+
+def _render_caches(lines, caches):
+    for key, kind, help_text in _cache_metrics:
+        metric = 'sleipnir_cache_{}'.format(key)
+        if kind == 'counter':
+            metric += '_total'
+        _header(lines, metric, kind, help_text)
+        for name, info in sorted(caches.items()):
+            if info.get(key) is not None:
+                lines.append(_sample(metric, info[key], cache=name))
+
+
+def _header(lines, name, kind, help_text):
+    lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} {}'.format(name, kind))
+
+
+def _sample(name, value, **labels):
+    labels = ','.join(
+        '{}="{}"'.format(key, _escape(str(val)))
+        for key, val in sorted(labels.items())
+    )
+    return '{}{{{}}} {}'.format(name, labels, _number(value))
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\')
+                 .replace('"', '\\"')
+                 .replace('\n', '\\n'))
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
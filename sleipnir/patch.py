@@ -0,0 +1,242 @@
+# Partial updates (PATCH requests) of IGTs and corpora.
+#
+# A patch is a list of operations applied in order to the XigtJSON
+# object of an IGT (or the corpus-level data of a corpus). Each
+# operation is an object with an "op" ("add", "replace", or "remove"),
+# a "path" naming its target, and, unless it removes something, the
+# new "value". Paths find objects by their IDs (or, for objects
+# without IDs like most metadata, by a 0-based position):
+#
+#     /tiers                          add a tier
+#     /tiers/T                        replace or remove tier T
+#     /tiers/T/items                  add an item to tier T
+#     /tiers/T/items/I                replace or remove item I
+#     /tiers/T/items/I/text           add, replace, or remove a value
+#     /tiers/T/attributes/NAME        add, replace, or remove an
+#                                     attribute
+#     /metadata                       add a metadata block
+#     /metadata/M/metas/MT            replace or remove a meta
+#
+# and so on down the tree (see _fields). Additions go at the end of
+# their list unless the operation has an "index". A replacement
+# without an "id" keeps the ID of what it replaces. Corpus patches
+# take the /metadata, /attributes, and /name (the corpus's name in
+# the database) paths. If any operation fails, none are applied.
+
+import copy
+
+from xigt.codecs import xigtjson
+
+from sleipnir.errors import SleipnirError
+
+_MAP = 'map'  # attributes: NAME -> value
+_VALUE = 'value'  # a string
+
+# the fields of each kind of object that a path can name; a list of
+# objects is given by the kind of object it holds
+_fields = {
+    'corpus': {'metadata': 'metadata', 'attributes': _MAP, 'name': _VALUE},
+    'igt': {
+        'tiers': 'tier', 'metadata': 'metadata', 'attributes': _MAP,
+        'type': _VALUE
+    },
+    'tier': {'items': 'item', 'attributes': _MAP, 'type': _VALUE},
+    'item': {'attributes': _MAP, 'type': _VALUE, 'text': _VALUE},
+    'metadata': {
+        'metas': 'meta', 'attributes': _MAP, 'type': _VALUE, 'text': _VALUE
+    },
+    'meta': {'attributes': _MAP, 'type': _VALUE, 'text': _VALUE},
+}
+
+_ops = ('add', 'replace', 'remove')
+
+
+def patch_igt(record, operations):
+    """
+    Apply *operations* to *record*, the XigtJSON object of an IGT,
+    and return the patched record (*record* is changed in place), the
+    decoded IGT, and the set of top-level fields (e.g., "tiers" or
+    "metadata") that were changed.
+    """
+    fields = apply_patch(record, operations, 'igt')
+    try:
+        igt = xigtjson.decode_igt(record)
+    except Exception as ex:  # Xigt's errors vary
+        raise SleipnirError(
+            'The patched IGT is not valid: {}'.format(ex), status_code=400
+        )
+    return record, igt, fields
+
+
+def patch_corpus(header, name, operations):
+    """
+    Apply *operations* to a copy of a corpus's *header* (its
+    corpus-level data) and *name*, and return the patched header and
+    name and the set of top-level fields that were changed.
+    """
+    obj = copy.deepcopy(header)
+    obj['name'] = name
+    fields = apply_patch(obj, operations, 'corpus')
+    name = obj.pop('name', None)
+    nsmap = xigtjson.active_namespaces(obj, None)
+    try:
+        for md in obj.get('metadata', []):
+            xigtjson.decode_metadata(md, nsmap)
+    except Exception as ex:
+        raise SleipnirError(
+            'The patched metadata is not valid: {}'.format(ex),
+            status_code=400
+        )
+    return obj, name, fields
+
+
+def apply_patch(obj, operations, kind='igt'):
+    """
+    Apply *operations* to *obj*, an object of *kind* (see _fields),
+    in place, and return the set of top-level fields changed.
+    """
+    if not isinstance(operations, list):
+        raise SleipnirError(
+            'A patch must be a list of operations.', status_code=400
+        )
+    fields = set()
+    for i, operation in enumerate(operations):
+        try:
+            fields.add(_apply(obj, kind, operation))
+        except SleipnirError as ex:
+            ex.message = 'Patch operation {}: {}'.format(i, ex.message)
+            ex.args = (ex.message,)
+            raise
+    return fields
+
+
+def _apply(obj, kind, operation):
+    if not isinstance(operation, dict):
+        raise SleipnirError('Not an operation object.', status_code=400)
+    op = operation.get('op')
+    path = operation.get('path')
+    if op not in _ops:
+        raise SleipnirError(
+            'Invalid op: {}'.format(op), status_code=400
+        )
+    if not isinstance(path, str) or not path.startswith('/'):
+        raise SleipnirError(
+            'Invalid path: {}'.format(path), status_code=400
+        )
+    if op != 'remove' and 'value' not in operation:
+        raise SleipnirError(
+            'Missing value for "{}"'.format(op), status_code=400
+        )
+    segments = [_unescape(s) for s in path[1:].split('/')]
+    target = obj
+    i = 0
+    while True:
+        field = segments[i]
+        spec = _fields[kind].get(field)
+        rest = segments[i+1:]
+        if spec is None:
+            break  # invalid path
+        elif spec == _VALUE:
+            if not rest:
+                _apply_value(target, field, op, operation)
+                return segments[0]
+        elif spec == _MAP:
+            if len(rest) == 1:
+                _apply_value(target.setdefault(field, {}), rest[0], op,
+                             operation)
+                return segments[0]
+        else:
+            objs = target.setdefault(field, [])
+            if not rest:
+                if op != 'add':
+                    break
+                _add(objs, operation)
+                return segments[0]
+            j = _find(objs, rest[0], path)
+            if len(rest) == 1:
+                if op == 'add':
+                    break
+                elif op == 'replace':
+                    _replace(objs, j, operation)
+                else:
+                    del objs[j]
+                return segments[0]
+            target = objs[j]
+            kind = spec
+            i += 2
+            continue
+        break
+    raise SleipnirError(
+        'Invalid path for "{}": {}'.format(op, path), status_code=400
+    )
+
+
+def _unescape(segment):
+    # as in JSON Pointer (RFC 6901)
+    return segment.replace('~1', '/').replace('~0', '~')
+
+
+def _find(objs, key, path):
+    # the index of the object with ID *key*, or at position *key*
+    if key.isdigit():
+        j = int(key)
+        if j < len(objs):
+            return j
+    else:
+        for j, obj in enumerate(objs):
+            if obj.get('id') == key:
+                return j
+    raise SleipnirError('Not found: {}'.format(path), status_code=404)
+
+
+def _object_value(operation):
+    value = operation['value']
+    if not isinstance(value, dict):
+        raise SleipnirError('The value must be an object.', status_code=400)
+    return value
+
+
+def _check_id(objs, value, skip=None):
+    _id = value.get('id')
+    if _id is not None and any(
+            obj.get('id') == _id for j, obj in enumerate(objs) if j != skip):
+        raise SleipnirError(
+            'ID already exists: {}'.format(_id), status_code=409
+        )
+
+
+def _add(objs, operation):
+    value = _object_value(operation)
+    _check_id(objs, value)
+    index = operation.get('index', len(objs))
+    if (not isinstance(index, int) or isinstance(index, bool)
+            or not 0 <= index <= len(objs)):
+        raise SleipnirError(
+            'Invalid index: {}'.format(index), status_code=400
+        )
+    objs.insert(index, value)
+
+
+def _replace(objs, j, operation):
+    value = _object_value(operation)
+    if 'id' not in value and 'id' in objs[j]:
+        value = dict(value, id=objs[j]['id'])
+    _check_id(objs, value, skip=j)
+    objs[j] = value
+
+
+def _apply_value(target, key, op, operation):
+    # a string value, or an attribute
+    if op == 'remove' or op == 'replace':
+        if key not in target:
+            raise SleipnirError('Not found: {}'.format(operation['path']),
+                                status_code=404)
+    if op == 'remove':
+        del target[key]
+    else:
+        value = operation['value']
+        if not isinstance(value, str):
+            raise SleipnirError(
+                'The value must be a string.', status_code=400
+            )
+        target[key] = value
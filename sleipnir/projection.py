@@ -0,0 +1,66 @@
+# Projections of IGTs: only some of their tiers and top-level fields.
+#
+# A projection keeps the tiers whose IDs or types are listed (or every
+# tier) and the listed top-level fields of an IGT ("attributes",
+# "metadata", and "tiers"; an IGT's ID, type, and namespaces are always
+# kept). Projections are applied to the XigtJSON records of IGTs before
+# they are decoded, so the dropped parts are never decoded or encoded.
+
+from xigt.codecs import xigtjson
+
+from sleipnir.errors import SleipnirError
+
+FIELDS = ('attributes', 'metadata', 'tiers')
+
+_kept = ('id', 'type', 'namespace', 'namespaces')
+
+
+def make_projection(tiers=None, fields=None):
+    """
+    Return the projection keeping *tiers* (IDs or types) and *fields*
+    (by default, all of them), or `None` if neither is given. The
+    projection is hashable, so it can be part of a cache key.
+    """
+    if tiers is None and fields is None:
+        return None
+    if fields is None:
+        fields = FIELDS
+    unknown = sorted(set(fields).difference(FIELDS))
+    if unknown:
+        raise SleipnirError(
+            'Invalid fields: {} (expected some of: {})'
+            .format(', '.join(unknown), ', '.join(FIELDS)),
+            status_code=400
+        )
+    return (None if tiers is None else frozenset(tiers), frozenset(fields))
+
+
+def project_record(record, projection):
+    """
+    Return the XigtJSON object *record* of an IGT with only what
+    *projection* keeps. The record is not modified, but the result
+    shares its parts.
+    """
+    if projection is None:
+        return record
+    tiers, fields = projection
+    obj = dict((key, record[key]) for key in _kept if key in record)
+    for field in fields:
+        if field in record:
+            obj[field] = record[field]
+    if tiers is not None and 'tiers' in obj:
+        obj['tiers'] = [
+            tier for tier in obj['tiers']
+            if tier.get('id') in tiers or tier.get('type') in tiers
+        ]
+    return obj
+
+
+def project_igt(igt, projection=None):
+    """
+    Return a copy of the decoded *igt* with only what *projection*
+    keeps (a full copy if it is `None`).
+    """
+    # Igt objects can't be deep-copied, so round-trip them instead
+    obj = project_record(xigtjson.encode_igt(igt), projection)
+    return xigtjson.decode_igt(obj)
@@ -0,0 +1,295 @@
+# XigtPath query evaluation, and structural features of IGTs used to
+# narrow the IGTs that need to be checked by a query.
+#
+# A feature is a string describing something an IGT contains:
+#
+#     tier:type=TYPE          a tier with the given type
+#     item:type=TYPE          an item with the given type
+#     item:@NAME              an item with the given attribute
+#     item:@NAME=VALUE        an item with the given attribute value
+#     subject=TEXT            a dc:subject metadata element with TEXT
+#     subject:code=CODE       a dc:subject with the given olac:code
+#
+# igt_features() lists the features of an IGT, and path_features()
+# lists the features an IGT must have for a path to match anything in
+# it. path_features() is conservative: any construct it does not fully
+# understand contributes no features, so an IGT is never excluded
+# unless the path could not match it.
+
+import json
+
+from xigt import xigtpath as xp, XigtCorpus, Igt, Tier, Item, Metadata, Meta
+from xigt.consts import ALIGNMENT, CONTENT, SEGMENTATION
+
+from sleipnir import metrics
+from sleipnir.errors import SleipnirError
+from sleipnir.projection import project_igt
+
+# attribute values that are IDs are too varied to be worth indexing
+_unindexed_values = set(['id', ALIGNMENT, CONTENT, SEGMENTATION])
+
+_functions = ('text', 'value', 'referent', 'referrer')
+
+# cached query hits take roughly this many times the size of their
+# JSON
+_HITS_SIZE_FACTOR = 8
+
+# an IGT (in a corpus, for absolute paths) with something for each
+# step of a path to find, so that predicates are evaluated too
+_probe = XigtCorpus(igts=[Igt(
+    id='i1',
+    metadata=[Metadata(id='md1', metas=[Meta(id='m1', text='m')])],
+    tiers=[Tier(id='t', type='words', items=[
+        Item(id='t1', type='word', text='a', attributes={'a': 'a'})
+    ])]
+)])[0]
+
+
+def check_paths(paths):
+    """
+    Raise a SleipnirError (400) for the first of *paths* that can't be
+    evaluated. Xigt has no separate parser for paths, so each is
+    evaluated on a small IGT; this catches the malformed paths that
+    would fail on any IGT, but not everything a path can go wrong on.
+    """
+    for p in paths:
+        try:
+            xp.findall(_probe, p)
+        except Exception:  # xigtpath's errors vary
+            raise SleipnirError(
+                'Invalid path: {}'.format(p), status_code=400
+            )
+
+
+def query_results(igt, paths):
+    """
+    Return a QueryResult metadata object for each path in *paths*, or
+    `None` if any of them doesn't match *igt* (queries are a
+    conjunction). The results list the items each path selected.
+    """
+    hits = query_hits(igt, paths)
+    if hits is None:
+        return None
+    return results_metadata(hits)
+
+
+def query_hits(igt, paths):
+    """
+    Like query_results(), but return the results as plain data: a
+    (path, items) pair for each path, where items are the (tier ID,
+    item ID) pairs of the items it selected. This is cheaper to keep
+    (e.g., cached) or to send to another process.
+    """
+    hits = []
+    for p in paths:
+        objs = xp.findall(igt, p)
+        if not objs:
+            return None
+        hits.append(
+            (p, [(obj.tier.id, obj.id) for obj in objs
+                 if isinstance(obj, Item)])
+        )
+    return hits
+
+
+def results_metadata(hits):
+    """Return the QueryResult metadata objects for *hits*."""
+    results = []
+    for p, items in hits:
+        md = Metadata(
+            type='QueryResult',
+            attributes={'queryType': 'path', 'query': p}
+        )
+        for tier_id, item_id in items:
+            md.append(Meta(attributes={'tier': tier_id, 'item': item_id}))
+        results.append(md)
+    return results
+
+
+def match_igts(igts, paths, projection=None):
+    """
+    Yield a copy of each IGT in *igts* that matches all *paths*, with
+    the query results appended to its metadata. The IGTs themselves
+    may be shared (e.g., cached), so they are not modified. The copies
+    only have what *projection* keeps (see sleipnir.projection), but
+    the query results are always included.
+    """
+    for igt in igts:
+        with metrics.stage('query'):
+            results = query_results(igt, paths)
+            if results is not None:
+                igt = project_igt(igt, projection)
+                igt.metadata.extend(results)
+        if results is not None:
+            yield igt
+
+
+def normalize_paths(paths):
+    """
+    Return *paths* sorted and without duplicates; as queries are
+    conjunctions, this is the same query.
+    """
+    return tuple(sorted(set(paths)))
+
+
+def iter_hits(igts, paths):
+    """
+    Yield an (IGT, hits) pair for each IGT in *igts* that matches all
+    *paths*, where hits are its query hits (see query_hits()).
+    """
+    for igt in igts:
+        with metrics.stage('query'):
+            hits = query_hits(igt, paths)
+        if hits is not None:
+            yield igt, hits
+
+
+def find_matches(igts, paths):
+    """
+    Return a dict mapping the ID of each IGT in *igts* that matches
+    all *paths* to its query hits (see query_hits()), in the order of
+    *igts*. Unlike match_igts(), this is meant for caching: the result
+    is plain data and doesn't hold on to the IGTs.
+    """
+    return dict((igt.id, hits) for igt, hits in iter_hits(igts, paths))
+
+
+def fill_matches(pairs, projection, put):
+    """
+    Yield a copy of each IGT in the (IGT, hits) *pairs* (see
+    iter_hits()) with only what *projection* keeps and its query
+    results, as for match_igts(). If all of the pairs are used, call
+    *put* with their find_matches() dict, e.g., to cache it; a query
+    stopped early (e.g., at a limit) doesn't have all of its matches.
+    """
+    matches = {}
+    for igt, hits in pairs:
+        matches[igt.id] = hits
+        with metrics.stage('query'):
+            igt = add_results(igt, hits, projection)
+        yield igt
+    put(matches)
+
+
+def add_results(igt, hits, projection=None):
+    """
+    Return a copy of *igt* with only what *projection* keeps and the
+    query results for *hits* (see query_hits()) appended.
+    """
+    igt = project_igt(igt, projection)
+    igt.metadata.extend(results_metadata(hits))
+    return igt
+
+
+def matches_size(matches):
+    """Return the approximate size in memory of find_matches() output."""
+    return _HITS_SIZE_FACTOR * len(json.dumps(matches))
+
+
+def igt_features(igt):
+    features = set()
+    for tier in igt.tiers:
+        if tier.type is not None:
+            features.add('tier:type=' + tier.type)
+        for item in tier.items:
+            if item.type is not None:
+                features.add('item:type=' + item.type)
+            for key, val in item.attributes.items():
+                if ':' in key or key.startswith('{'):
+                    continue  # namespaced attributes are not indexed
+                features.add('item:@' + key)
+                if key not in _unindexed_values and val is not None:
+                    features.add('item:@{}={}'.format(key, val))
+    for obj in [igt] + igt.tiers:
+        for text in xp.findall(obj, 'metadata//dc:subject/text()'):
+            if text is not None:
+                features.add('subject=' + text)
+        for code in xp.findall(obj, 'metadata//dc:subject/@olac:code'):
+            if code is not None:
+                features.add('subject:code=' + code)
+    return sorted(features)
+
+
+def path_features(path):
+    """
+    Return the set of features an IGT must have for *path* to match.
+    """
+    try:
+        tokens = xp.tokenize(path)
+    except Exception:
+        return set()
+    # absolute paths, parent steps, and unions can reach outside the
+    # IGT or make a step optional, so don't try to narrow those
+    if (not tokens or tokens[0] in ('/', '//')
+            or '..' in tokens or '|' in tokens):
+        return set()
+    features = set()
+    step = None
+    i = 0
+    try:
+        while i < len(tokens):
+            tok = tokens[i]
+            if tok in ('/', '//'):
+                i += 1
+            elif tok == '[':
+                i, feats = _predicate_features(step, tokens, i)
+                features.update(feats)
+            elif tok == '@':
+                step = '@' + tokens[i + 1]
+                i += 2
+            elif tok in _functions:
+                if tokens[i + 1] != '(':
+                    return set()
+                i = tokens.index(')', i) + 1
+                step = tok
+            elif tok in ('(', ')', ']', '=', '!='):
+                return set()  # groups or something unexpected
+            else:
+                step = tok
+                i += 1
+    except (IndexError, ValueError):
+        return set()  # malformed; let the query itself report it
+    return features
+
+
+def _predicate_features(step, tokens, i):
+    # tokens[i] is '['; return the index after the predicate and the
+    # features it requires of *step*
+    i += 1
+    subpath = []
+    while tokens[i] not in (']', '=', '!='):
+        if tokens[i] == '[':
+            raise ValueError('nested predicate')
+        subpath.append(tokens[i])
+        i += 1
+    subpath = ''.join(subpath)
+    if tokens[i] != '=':
+        # existence tests and != don't imply anything we index
+        if tokens[i] == '!=':
+            i += 2
+        if tokens[i] != ']':
+            raise ValueError('unterminated predicate')
+        return i + 1, set()
+    val = tokens[i + 1]
+    if tokens[i + 2] != ']':
+        raise ValueError('unterminated predicate')
+    i += 3
+    if '\\' in val:
+        return i, set()  # escapes are compared literally; don't guess
+    val = val.strip('"')
+    features = set()
+    if step == 'tier' and subpath == '@type':
+        features.add('tier:type=' + val)
+    elif step == 'item' and subpath == '@type':
+        features.add('item:type=' + val)
+    elif (step == 'item' and subpath.startswith('@')
+          and ':' not in subpath and subpath not in ('@id', '@*')):
+        key = subpath[1:]
+        features.add('item:@' + key)
+        if key not in _unindexed_values:
+            features.add('item:@{}={}'.format(key, val))
+    elif step == 'dc:subject' and subpath == 'text()':
+        features.add('subject=' + val)
+    elif step == 'dc:subject' and subpath == '@olac:code':
+        features.add('subject:code=' + val)
+    return i, features
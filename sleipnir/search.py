@@ -0,0 +1,112 @@
+# Path queries across corpora (dbi.search() and GET /v1/search).
+#
+# Each corpus is queried with the database's iter_igts() by one of a
+# few worker threads, and the matches are handed back through a bounded
+# queue as they are found, so the first matches arrive while other
+# corpora are still being checked. The matches of different corpora
+# are interleaved in the order they are found. Once the limit is
+# reached (or the caller stops iterating), the workers stop at their
+# next match and corpora not yet started are skipped. A corpus's query
+# yields its matches as it finds them (or from the query cache, if its
+# results are cached there), so no worker waits for a whole corpus to
+# be checked; only a query that gets to the end of its corpus fills the
+# cache.
+
+from threading import Event, Lock, Thread
+from queue import Queue, Full
+
+from sleipnir.errors import SleipnirError
+from sleipnir.query import check_paths
+
+# matches a worker may get ahead of the caller
+_QUEUE_SIZE = 64
+
+# seconds a worker waits on a full queue before checking for a stop
+_PUT_TIMEOUT = 0.1
+
+
+def search(dbi, paths, corpus_ids=None, limit=None, workers=4, **kwargs):
+    """
+    Return an iterator of (corpus ID, IGT) pairs for the IGTs in the
+    corpora *corpus_ids* (default: all) that match all *paths*, up to
+    *limit* in total. Up to *workers* corpora are queried at once.
+    Other keyword arguments (e.g., *tiers* and *fields*) are passed to
+    `dbi.iter_igts()`. Malformed paths and unknown corpora are reported
+    before iteration begins; an error in any corpus's query is raised
+    by the iterator and ends the search.
+    """
+    if not paths:
+        raise SleipnirError(
+            'A search needs at least one path.', status_code=400
+        )
+    check_paths(paths)
+    known = [entry['id'] for entry in dbi.list_corpora()]
+    if corpus_ids is None:
+        corpus_ids = known
+    else:
+        missing = [cid for cid in corpus_ids if cid not in known]
+        if missing:
+            raise SleipnirError(
+                'Requested corpora not found: {}'.format(', '.join(missing)),
+                status_code=404
+            )
+        # each corpus is searched once, in the order given
+        corpus_ids = list(dict.fromkeys(corpus_ids))
+    return _search(dbi, corpus_ids, paths, limit, workers, kwargs)
+
+
+def _search(dbi, corpus_ids, paths, limit, workers, kwargs):
+    if not corpus_ids or limit == 0:
+        return
+    queue = Queue(maxsize=_QUEUE_SIZE)
+    stop = Event()
+    corpora = iter(corpus_ids)
+    corpora_lock = Lock()
+
+    def put(item):
+        # False if the search stopped before there was room
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except Full:
+                pass
+        return False
+
+    def work():
+        # (corpus ID, IGT, None) for each match, then (corpus ID, None,
+        # error) at the end of each corpus
+        while not stop.is_set():
+            with corpora_lock:
+                corpus_id = next(corpora, None)
+            if corpus_id is None:
+                return
+            error = None
+            try:
+                for igt in dbi.iter_igts(corpus_id, paths=paths, **kwargs):
+                    if not put((corpus_id, igt, None)):
+                        return
+            except Exception as ex:
+                error = ex
+            put((corpus_id, None, error))
+
+    # daemon threads, so a search that is never finished doesn't keep
+    # the process from exiting
+    for _ in range(max(1, min(workers, len(corpus_ids)))):
+        Thread(target=work, name='sleipnir-search', daemon=True).start()
+    try:
+        remaining = len(corpus_ids)
+        count = 0
+        while remaining:
+            corpus_id, igt, error = queue.get()
+            if error is not None:
+                raise error
+            if igt is None:
+                remaining -= 1
+                continue
+            yield corpus_id, igt
+            count += 1
+            if count == limit:
+                break
+    finally:
+        stop.set()
@@ -0,0 +1,87 @@
+# A threaded WSGI server for running Sleipnir without installing a
+# separate one (see run_sleipnir.py).
+#
+# Requests are handled by a fixed pool of threads. A connection is
+# only accepted when a thread is free to take it (the server's loop
+# blocks until one is), so a burst of connections waits in the listen
+# queue instead of starting a thread or holding an open socket for
+# each, and the server's memory stays bounded. Once the listen queue
+# is full, the system refuses or drops further connections until
+# there is room. Each connection carries one request (werkzeug's
+# request handler closes it after the response), and a client that
+# stops sending or reading is dropped after a timeout so it can't
+# hold a thread. Any other WSGI server can run the application from
+# sleipnir.create_app() instead.
+
+import sys
+from threading import BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+
+class _RequestHandler(WSGIRequestHandler):
+    # seconds a connection may block on the client
+    timeout = 60
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    A WSGI server that handles requests with a pool of *threads*,
+    with up to *backlog* connections waiting to be accepted.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=16, backlog=128,
+                 handler=_RequestHandler, **kwargs):
+        # used when the socket starts listening
+        self.request_queue_size = backlog
+        self._pool = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='sleipnir-request'
+        )
+        # held from when a connection is accepted until it is closed
+        self._free = BoundedSemaphore(threads)
+        BaseWSGIServer.__init__(self, host, port, app, handler=handler,
+                                **kwargs)
+        self.threads = threads
+
+    def get_request(self):
+        # wait for a free thread before accepting another connection
+        self._free.acquire()
+        try:
+            return BaseWSGIServer.get_request(self)
+        except BaseException:
+            self._free.release()
+            raise
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        # as in socketserver.ThreadingMixIn
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def shutdown_request(self, request):
+        # every accepted connection ends here, handled or not
+        BaseWSGIServer.shutdown_request(self, request)
+        self._free.release()
+
+    def server_close(self):
+        BaseWSGIServer.server_close(self)
+        # requests already accepted are finished
+        self._pool.shutdown(wait=True)
+
+
+def serve(app, host='127.0.0.1', port=5000, threads=16, backlog=128):
+    """Serve *app* until interrupted."""
+    server = PooledWSGIServer(host, port, app, threads=threads,
+                              backlog=backlog)
+    print(' * Serving on http://{}:{}/ with {} threads (CTRL+C to quit)'
+          .format(host, server.port, threads), file=sys.stderr)
+    server.serve_forever()
@@ -10,6 +10,10 @@ These are the exposed API URIs for Sleipnir
      /corpora/<corpus_id>/summary
      /corpora/<corpus_id>/igts
      /corpora/<corpus_id>/igts/<igt_id>
+     /igts
+     /search
+     /stats
+     /metrics
 
     POST requests
      /corpora
@@ -24,21 +28,44 @@ These are the exposed API URIs for Sleipnir
      /corpora/<corpus_id>/igts/<igt_id>
 
     PATCH requests
-     !/corpora/<corpus_id>
-     !/corpora/<corpus_id>/igts/<igt_id>
+     /corpora/<corpus_id>
+     /corpora/<corpus_id>/igts/<igt_id>
 '''
 
+import time
 from functools import wraps
+from hashlib import sha1
+from datetime import datetime, timezone
+from xml.etree.ElementTree import Element
+
+from flask import (
+    request, Response, json, url_for, stream_with_context, current_app
+)
 
-from flask import request, Response, abort, json, url_for
+from werkzeug.local import LocalProxy
 
+from xigt import XigtCorpus
 from xigt.codecs import xigtxml, xigtjson
 
-from sleipnir import v1, dbi
+import sleipnir
+from sleipnir import v1, config, request_metrics
+from sleipnir import metrics
 from sleipnir.errors import SleipnirError
+from sleipnir.ingest import load_corpus
 
 accept_mimetypes = ['application/json', 'application/xml']
 
+def _app_state(name):
+    # the database interface or render cache of the app (see
+    # sleipnir.create_app()); apps that register the blueprint
+    # themselves use the configured ones
+    state = current_app.extensions.get('sleipnir')
+    if state is None:
+        return getattr(sleipnir, name)
+    return state[name]
+
+dbi = LocalProxy(lambda: _app_state('dbi'))
+
 #
 # GET REQUESTS
 #
@@ -63,7 +90,68 @@ def jsonp(func):
             return func(*args, **kwargs)
     return decorated_function
 
+def conditional(get_version):
+    """
+    Send validators (ETag and Last-Modified) for the version of the
+    requested data, as given by *get_version* (called with the view's
+    arguments), and answer conditional requests for an unchanged
+    version with 304 without calling the view. If-None-Match is used
+    instead of If-Modified-Since when a request has both.
+    """
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            version, modified = get_version(**kwargs)
+            # the same data may be requested in several representations;
+            # the modification time tells apart a corpus deleted and
+            # added again under its ID, whose version starts over
+            etag = sha1('{}:{!r}:{}:{}'.format(
+                version, modified, _json_or_xml(), request.full_path
+            ).encode('utf-8')).hexdigest()
+            # Last-Modified has whole seconds, so a later change in the
+            # same second would look unchanged; it's only sent once
+            # that second is over
+            last_modified = None
+            if modified is not None and int(modified) < int(time.time()):
+                last_modified = datetime.fromtimestamp(
+                    int(modified), timezone.utc
+                )
+            if request.if_none_match:
+                unchanged = request.if_none_match.contains(etag)
+            else:
+                unchanged = (
+                    last_modified is not None
+                    and request.if_modified_since is not None
+                    and last_modified <= request.if_modified_since
+                )
+            if unchanged:
+                response = Response(status=304)
+            else:
+                response = func(*args, **kwargs)
+            if response.status_code in (200, 304):
+                response.set_etag(etag)
+                # (setting it to None would send the current time)
+                if last_modified is not None:
+                    response.last_modified = last_modified
+                # caches may keep responses, but must check that
+                # they're current before using them
+                response.cache_control.no_cache = True
+                response.vary.add('Accept')
+            return response
+        return decorated_function
+    return decorator
+
+def _database_version(**kwargs):
+    return dbi.get_version()
+
+def _corpus_version(corpus_id, **kwargs):
+    return dbi.get_version(corpus_id.partition('.')[0])
+
+def _igt_version(corpus_id, igt_id):
+    return dbi.get_version(corpus_id, igt_id)
+
 @v1.route('/corpora')
+@conditional(_database_version)
 @jsonp
 def list_corpora():
     corpora = dbi.list_corpora()
@@ -76,25 +164,52 @@ def list_corpora():
     )
 
 @v1.route('/corpora/<corpus_id>')
+@conditional(_corpus_version)
 @jsonp
 def get_corpus(corpus_id):
     corpus_id, dot, extension = corpus_id.partition('.')  # e.g., id.xml
     mimetype = _json_or_xml(extension=dot + extension.lower())
 
     igt_ids = _get_arg_list('id', delim=',')
-
-    if mimetype in getattr(dbi, 'raw_formats', []) and not igt_ids:
-        corpus = dbi.fetch_raw_corpus(corpus_id, mimetype)
+    projection = _get_projection()
+    # only whole corpora are cached or sent as stored
+    whole = not igt_ids and not projection
+
+    # whole corpora are cached once rendered; the version is read
+    # first, so a write during rendering only makes the entry outdated
+    render_cache = _app_state('render_cache')
+    version = None
+    if render_cache is not None and whole:
+        version = dbi.get_version(corpus_id)
+        corpus = render_cache.get(corpus_id, version, mimetype)
+        if corpus is not None:
+            return Response(corpus, mimetype=mimetype)
+
+    if mimetype in getattr(dbi, 'raw_formats', []) and whole:
+        corpus = dbi.iter_raw_corpus(corpus_id, mimetype)
     else:
-        xc = dbi.get_corpus(corpus_id, ids=igt_ids)
+        # transient: IGTs are decoded as they are serialized
+        xc = dbi.get_corpus(
+            corpus_id, ids=igt_ids, mode='transient', **projection
+        )
         corpus = _serialize_corpus(xc, mimetype)
 
-    return Response(corpus, mimetype=mimetype)
+    if version is not None:
+        corpus = render_cache.fill(corpus_id, version, mimetype, corpus)
+
+    return Response(stream_with_context(corpus), mimetype=mimetype)
 
 @v1.route('/corpora/<corpus_id>/summary')
+@conditional(_corpus_version)
 @jsonp
 def corpus_summary(corpus_id):
-    summary = dbi.corpus_summary(corpus_id)
+    summary = dbi.corpus_summary(
+        corpus_id,
+        cursor=request.args.get('cursor'),
+        limit=_get_limit()
+    )
+    if 'next_cursor' in summary:
+        summary['next_url'] = _next_page_url(summary['next_cursor'])
     for igt in summary['igts']:
         igt['url'] = url_for(
             '.get_igt',
@@ -105,19 +220,96 @@ def corpus_summary(corpus_id):
     return json.jsonify(summary)
 
 @v1.route('/corpora/<corpus_id>/igts')
+@conditional(_corpus_version)
 @jsonp
 def get_igts(corpus_id):
     igt_ids = _get_arg_list('id', delim=',')
     paths = _get_arg_list('path')
-    igts = list(map(xigtjson.encode_igt,
-                    dbi.get_igts(corpus_id, ids=igt_ids, paths=paths)))
-    return json.jsonify(igts=igts, igt_count=len(igts))
+    limit = _get_limit()
+    # get one more than the limit to find the next page's cursor
+    igts = dbi.iter_igts(
+        corpus_id, ids=igt_ids, paths=paths,
+        cursor=request.args.get('cursor'),
+        limit=None if limit is None else limit + 1,
+        **_get_projection()
+    )
+    return Response(
+        stream_with_context(_iter_json_igts(igts, limit=limit)),
+        mimetype='application/json'
+    )
 
 @v1.route('/corpora/<corpus_id>/igts/<igt_id>')
+@conditional(_igt_version)
 @jsonp
 def get_igt(corpus_id, igt_id):
-    igt = dbi.get_igt(corpus_id, igt_id)
-    return json.jsonify(xigtjson.encode_igt(igt))
+    igt = dbi.get_igt(corpus_id, igt_id, **_get_projection())
+    with metrics.stage('serialize'):
+        return json.jsonify(xigtjson.encode_igt(igt))
+
+@v1.route('/igts')
+@jsonp
+def get_igt_batch():
+    # IGTs from any corpora, as id=CORPUS_ID/IGT_ID,...
+    ids = _get_arg_list('id', delim=',')
+    if not ids:
+        raise SleipnirError(
+            'Give the IGTs as id=CORPUS_ID/IGT_ID.', status_code=400
+        )
+    pairs = []
+    for _id in ids:
+        corpus_id, slash, igt_id = _id.partition('/')
+        if not slash:
+            raise SleipnirError(
+                'Invalid IGT: {} (expected CORPUS_ID/IGT_ID)'.format(_id),
+                status_code=400
+            )
+        pairs.append((corpus_id, igt_id))
+    results = dbi.get_igt_batch(
+        pairs, workers=config.BATCH_WORKERS, **_get_projection()
+    )
+    with metrics.stage('serialize'):
+        for result in results:
+            if 'igt' in result:
+                result['igt'] = xigtjson.encode_igt(result['igt'])
+    return json.jsonify(
+        igts=results,
+        igt_count=sum(1 for result in results if 'igt' in result),
+        error_count=sum(1 for result in results if 'error' in result)
+    )
+
+@v1.route('/search')
+def search():
+    # matches are sent as they are found, one JSON object per line
+    matches = dbi.search(
+        _get_arg_list('path'),
+        corpus_ids=_get_arg_list('corpus', delim=','),
+        limit=_get_limit(),
+        workers=config.SEARCH_WORKERS,
+        **_get_projection()
+    )
+    return Response(
+        stream_with_context(_iter_ndjson_matches(matches)),
+        mimetype='application/x-ndjson'
+    )
+
+@v1.route('/stats')
+@conditional(_database_version)
+@jsonp
+def get_stats():
+    return json.jsonify(dbi.get_stats())
+
+@v1.route('/metrics')
+def get_metrics():
+    if request_metrics is None:
+        raise SleipnirError('Metrics are not enabled.', status_code=404)
+    caches = dbi.cache_info()
+    render_cache = _app_state('render_cache')
+    if render_cache is not None:
+        caches['render'] = render_cache.info()
+    return Response(
+        request_metrics.render(caches=caches),
+        mimetype='text/plain; version=0.0.4'
+    )
 
 #
 # POST REQUESTS
@@ -125,7 +317,6 @@ def get_igt(corpus_id, igt_id):
 
 @v1.route('/corpora', methods=['POST'])
 def post_corpus():
-    print(request.data)
     xc = _get_request_corpus()
     name = request.args.get('name')
     result = dbi.add_corpus(xc, name=name)
@@ -133,8 +324,14 @@ def post_corpus():
 
 @v1.route('/corpora/<corpus_id>/igts', methods=['POST'])
 def post_igt(corpus_id):
-    igt = _get_request_igt()
-    result = dbi.add_igt(corpus_id, igt)
+    data = request.get_json()
+    # a list of IGTs (or {"igts": [...]}) is added as one batch
+    if isinstance(data, dict) and 'igts' in data:
+        data = data['igts']
+    if isinstance(data, list):
+        result = dbi.add_igts(corpus_id, _get_request_igts(data))
+    else:
+        result = dbi.add_igt(corpus_id, _get_request_igt(data))
     return json.jsonify(**result)
 
 #
@@ -166,6 +363,9 @@ def put_igt(corpus_id, igt_id):
 @v1.route('/corpora/<corpus_id>', methods=['DELETE'])
 def delete_corpus(corpus_id):
     dbi.del_corpus(corpus_id)
+    render_cache = _app_state('render_cache')
+    if render_cache is not None:
+        render_cache.discard(corpus_id)
     return '', 204
 
 @v1.route('/corpora/<corpus_id>/igts/<igt_id>', methods=['DELETE'])
@@ -178,12 +378,57 @@ def delete_igt(corpus_id, igt_id):
 #
 
 @v1.route('/corpora/<corpus_id>', methods=['PATCH'])
-def patch_corpus():
-    abort(501)
+def patch_corpus(corpus_id):
+    dbi.patch_corpus(corpus_id, _get_request_patch())
+    return '', 204
 
 @v1.route('/corpora/<corpus_id>/igts/<igt_id>', methods=['PATCH'])
-def patch_igt():
-    abort(501)
+def patch_igt(corpus_id, igt_id):
+    dbi.patch_igt(corpus_id, igt_id, _get_request_patch())
+    return '', 204
+
+#
+# METRICS
+#
+
+# A request's stages are recorded from before its view is called until
+# its response has been sent (a streamed response's IGTs are decoded
+# and serialized as it is sent), so a Server-Timing header only covers
+# the stages done before the body is streamed.
+
+@v1.before_request
+def start_metrics():
+    if request_metrics is not None or config.SERVER_TIMING:
+        metrics.start_request()
+
+@v1.after_request
+def add_server_timing(response):
+    record = metrics.current_request()
+    if record is not None:
+        record.status = response.status_code
+        if config.SERVER_TIMING:
+            response.headers['Server-Timing'] = record.server_timing()
+        # the server closes the response once it has been sent
+        route, method = _route(), request.method
+        response.call_on_close(lambda: _observe(record, route, method))
+    return response
+
+@v1.teardown_request
+def observe_failure(exc=None):
+    # requests that failed with an unhandled error get no response
+    record = metrics.current_request()
+    if record is not None and record.status is None:
+        _observe(record, _route(), request.method)
+
+def _route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else '(unmatched)'
+
+def _observe(record, route, method):
+    if metrics.current_request() is record:
+        metrics.end_request()
+    if request_metrics is not None:
+        request_metrics.observe(route, method, record)
 
 #
 # ERRORS
@@ -217,6 +462,38 @@ def _json_or_xml(extension=None):
 
     return mimetype or 'application/json'
 
+def _get_limit():
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = -1
+        if limit < 1:
+            raise SleipnirError(
+                'The limit must be a positive integer.', status_code=400
+            )
+    return limit
+
+def _get_projection():
+    # the tiers (IDs or types) and top-level fields of IGTs to return;
+    # see sleipnir.projection
+    projection = {}
+    tiers = _get_arg_list('tiers', delim=',')
+    fields = _get_arg_list('fields', delim=',')
+    if tiers is not None:
+        projection['tiers'] = tiers
+    if fields is not None:
+        projection['fields'] = fields
+    return projection
+
+def _next_page_url(cursor):
+    # the current URL with the cursor replaced
+    args = request.args.to_dict(flat=False)
+    args['cursor'] = cursor
+    return url_for(request.endpoint, _external=True,
+                   **dict(request.view_args, **args))
+
 def _get_arg_list(param, delim=None):
     xlist = None
     if param in request.args:
@@ -228,41 +505,47 @@ def _get_arg_list(param, delim=None):
 # request can have 1 file attachment, or alternatively the message body
 # can be a XigtXML- or XigtJSON-encoded corpus.
 def _get_request_corpus():
-    xc = None
+    # the corpus is transient: IGTs are parsed from the request body as
+    # they are added to the database, so the upload is never held in
+    # memory (uploaded files are spooled to disk by werkzeug)
     files = request.files.getlist('file')
     if len(files) == 1:
-        f = files[0]
-        data = f.read()
-        mimetype = f.mimetype
+        stream = files[0].stream
+        mimetype = files[0].mimetype
     elif len(files) > 1:
         raise SleipnirError('Only one file may be uploaded at a time.')
     else:
-        data = request.data
-        if not isinstance(data, str):
-            data = data.decode()
+        stream = request.stream
         mimetype = request.mimetype
     if mimetype not in accept_mimetypes:
         raise SleipnirError(
             'Unsupported mimetype: %s' % mimetype, status_code=400
         )
-    try:
-        if mimetype == 'application/json':
-            xc = xigtjson.loads(data)
-        elif mimetype == 'application/xml':
-            xc = xigtxml.loads(data)
-    except:  # when Xigt has a parsing exception, use it here
-        raise
-        raise SleipnirError('Unparseable Xigt corpus.')
-    return xc
+    return load_corpus(stream, mimetype)
 
-def _get_request_igt():
-    data = request.get_json()
+def _get_request_igt(data=None):
+    if data is None:
+        data = request.get_json()
     try:
         igt = xigtjson.decode_igt(data)
     except:  # when Xigt has a parsing exception, use it here
         raise SleipnirError('Unparseable Xigt IGT instance.')
     return igt
 
+def _get_request_igts(data):
+    return [_get_request_igt(obj) for obj in data]
+
+def _get_request_patch():
+    # a list of operations (or {"operations": [...]}); see sleipnir.patch
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and 'operations' in data:
+        data = data['operations']
+    if not isinstance(data, list):
+        raise SleipnirError(
+            'A patch must be a list of operations.', status_code=400
+        )
+    return data
+
 # def _file_mimetype(f):
 #     mimetype = None
 #     with tempfile.TemporaryDirectory() as tmpdir:
@@ -275,10 +558,114 @@ def _get_request_igt():
 #     # tempdir and tempfile should be destroyed now
 #     return mimetype
 
+# Serialization is done incrementally so that a response never holds
+# more than one encoded IGT at a time; these functions return iterators
+# of strings to use as response bodies.
+
 def _serialize_corpus(xc, mimetype='application/json'):
     if mimetype == 'application/xml':
-        return xigtxml.dumps(xc, indent=2)
+        return _iter_xml_corpus(xc)
     elif mimetype == 'application/json':
-        return xigtjson.dumps(xc, indent=2)
+        return _iter_json_corpus(xc)
     else:
         raise SleipnirError('Unsupported mimetype: %s' % mimetype)
+
+def _iter_json_corpus(xc, indent=2):
+    ind = '\n' + (' ' * indent)
+    ind2 = ind + (' ' * indent)
+    # encode everything but the IGTs (note: this re-parents the corpus
+    # metadata, but the corpus is only being serialized)
+    header = xigtjson.encode(XigtCorpus(
+        id=xc.id, type=xc.type, attributes=xc.attributes,
+        metadata=xc.metadata, namespace=xc.namespace, nsmap=xc.nsmap
+    ))
+    del header['igts']
+    yield '{'
+    for key, val in header.items():
+        val = json.dumps(val, indent=indent).replace('\n', ind)
+        yield '{}{}: {},'.format(ind, json.dumps(key), val)
+    yield ind + '"igts": ['
+    sep = ind2
+    for igt in xc:
+        with metrics.stage('serialize'):
+            obj = xigtjson.encode_igt(igt, xc.nsmap)
+            text = json.dumps(obj, indent=indent).replace('\n', ind2)
+        yield sep + text
+        sep = ',' + ind2
+    yield ind + ']\n}\n'
+
+def _iter_json_igts(igts, limit=None, indent=2):
+    # if there are more than *limit* IGTs, the rest are left for the
+    # next page
+    ind = '\n' + (' ' * indent)
+    ind2 = ind + (' ' * indent)
+    yield '{' + ind + '"igts": ['
+    sep = ind2
+    count = 0
+    next_cursor = None
+    for igt in igts:
+        if count == limit:
+            next_cursor = igt.id
+            break
+        with metrics.stage('serialize'):
+            obj = xigtjson.encode_igt(igt)
+            text = json.dumps(obj, indent=indent).replace('\n', ind2)
+        yield sep + text
+        sep = ',' + ind2
+        count += 1
+    yield '{}],{}"igt_count": {}'.format(ind, ind, count)
+    if next_cursor is not None:
+        yield ',{}"next_cursor": {},{}"next_url": {}'.format(
+            ind, json.dumps(next_cursor),
+            ind, json.dumps(_next_page_url(next_cursor))
+        )
+    yield '\n}\n'
+
+def _iter_ndjson_matches(matches):
+    # (corpus ID, IGT) pairs, one per line
+    try:
+        for corpus_id, igt in matches:
+            with metrics.stage('serialize'):
+                text = json.dumps({
+                    'corpus_id': corpus_id,
+                    'igt': xigtjson.encode_igt(igt)
+                })
+            yield text + '\n'
+    except SleipnirError as ex:
+        # the response has begun, so the error ends the stream instead
+        yield json.dumps({'error': ex.to_dict()}) + '\n'
+    except Exception:
+        # e.g., a path that fails on some IGT; logged as Flask would
+        # an error raised before the response began
+        current_app.logger.exception('Error while streaming search results')
+        yield json.dumps(
+            {'error': {'message': 'Internal server error'}}
+        ) + '\n'
+
+_igts_placeholder = 'sleipnir-igts'
+
+def _iter_xml_corpus(xc, indent=2):
+    # Build the corpus element with a placeholder where the IGTs go,
+    # then serialize the IGTs one at a time in its place. This uses
+    # xigtxml's element builders as its (disabled) incremental encoder
+    # does.
+    nsmap = xc.nsmap
+    root = xigtxml._build_elem('xigt-corpus', xc, {})
+    for md in xc.metadata:
+        root.append(xigtxml._build_metadata(md, nsmap))
+    root.append(Element(_igts_placeholder))
+    xigtxml._indent(root, indent=indent)
+    head, _, tail = xigtxml._tostring(root, encoding='unicode').partition(
+        '<{} />'.format(_igts_placeholder)
+    )
+    yield head
+    sep = ''
+    for igt in xc:
+        with metrics.stage('serialize'):
+            elem = xigtxml._build_igt(igt, nsmap)
+            xigtxml._indent(elem, indent=indent, level=1)
+            elem.tail = None
+            text = xigtxml._tostring(elem, encoding='unicode')
+        yield sep + text
+        sep = '\n' + (' ' * indent)
+    yield tail
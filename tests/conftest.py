@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+import pytest
+
+# importing sleipnir opens the configured database (and makes its
+# directory), so do it somewhere disposable
+os.chdir(tempfile.mkdtemp(prefix='sleipnir-tests-'))
+
+from xigt import XigtCorpus, Igt, Tier, Item, Metadata, Meta, MetaChild
+
+from sleipnir.interfaces import FileSystemDbi, SqliteDbi
+
+DC = 'http://purl.org/dc/elements/1.1/'
+OLAC = 'http://www.language-archives.org/OLAC/1.1/'
+
+
+@pytest.fixture(params=['filesystem', 'sqlite'])
+def dbi(request, tmp_path):
+    if request.param == 'filesystem':
+        return FileSystemDbi(str(tmp_path / 'db'))
+    return SqliteDbi(str(tmp_path / 'db.sqlite'))
+
+
+@pytest.fixture
+def fsdbi(tmp_path):
+    return FileSystemDbi(str(tmp_path / 'db'))
+
+
+def make_corpus(igts):
+    return XigtCorpus(igts=igts, nsmap={'dc': DC, 'olac': OLAC})
+
+
+def make_igt(igt_id, words=('a', 'b'), lang=None):
+    """
+    Return an IGT with a words tier of *words* and, if *lang* is a
+    (code, name) pair, a dc:subject for the language.
+    """
+    metadata = []
+    if lang is not None:
+        code, name = lang
+        subject = MetaChild(
+            'subject', attributes={'{%s}code' % OLAC: code}, text=name,
+            namespace=DC
+        )
+        metadata.append(Metadata(type='xigt-meta', metas=[
+            Meta(id='lang', type='language', children=[subject])
+        ]))
+    return Igt(
+        id=igt_id,
+        metadata=metadata,
+        tiers=[Tier(id='w', type='words', items=[
+            Item(id='w{}'.format(i), text=w) for i, w in enumerate(words, 1)
+        ])]
+    )
@@ -0,0 +1,43 @@
+from xigt.codecs import xigtjson
+
+from sleipnir.interfaces import FileSystemDbi, SqliteDbi
+
+from conftest import make_corpus, make_igt
+from convert_db import convert
+
+
+def _igts():
+    return [
+        make_igt('i1', lang=('deu', 'German')),
+        make_igt('i2', lang=('nld', 'Dutch')),
+    ]
+
+
+def test_convert(tmp_path):
+    source = FileSystemDbi(str(tmp_path / 'db'))
+    target = SqliteDbi(str(tmp_path / 'db.sqlite'))
+    corpus_id = source.add_corpus(make_corpus(_igts()), name='c')['id']
+    # the stored language can't be found in this IGT's record
+    record = xigtjson.encode_igt(source.get_igt(corpus_id, 'i2'))
+    del record['namespaces']
+    source.set_igt(corpus_id, 'i2', xigtjson.decode_igt(record))
+    assert convert(source, target) == 0
+    assert target.corpus_summary(corpus_id) == source.corpus_summary(corpus_id)
+    assert target.get_languages(corpus_id) == {
+        'i1': ('deu', 'German'), 'i2': ('nld', 'Dutch')
+    }
+    # copied corpora are skipped
+    assert convert(source, target) == 0
+    assert target.list_corpora() == source.list_corpora()
+    back = FileSystemDbi(str(tmp_path / 'db2'))
+    assert convert(target, back) == 0
+    assert back.corpus_summary(corpus_id) == source.corpus_summary(corpus_id)
+
+
+def test_convert_incomplete(tmp_path):
+    source = FileSystemDbi(str(tmp_path / 'db'))
+    target = SqliteDbi(str(tmp_path / 'db.sqlite'))
+    corpus_id = source.add_corpus(make_corpus(_igts()))['id']
+    target.add_corpora([make_corpus(_igts()[:1])], ids=[corpus_id])
+    assert convert(source, target) == 1
+    assert convert(source, target, ['missing']) == 1
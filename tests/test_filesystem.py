@@ -0,0 +1,51 @@
+import pytest
+
+from sleipnir.errors import SleipnirDbError
+from sleipnir.interfaces import FileSystemDbi
+
+from conftest import make_corpus, make_igt
+
+
+def test_iter_igts_while_adding(fsdbi):
+    corpus_id = fsdbi.add_corpus(
+        make_corpus([make_igt('i{}'.format(i)) for i in range(20)])
+    )['id']
+    igts = fsdbi.iter_igts(corpus_id)
+    seen = [next(igts).id]
+    # the data file grows past what the reader mapped
+    fsdbi.add_igts(
+        corpus_id, [make_igt('j{}'.format(i)) for i in range(20)]
+    )
+    seen.extend(igt.id for igt in igts)
+    assert seen == ['i{}'.format(i) for i in range(20)]
+    assert len(fsdbi.get_igts(corpus_id)) == 40
+
+
+def test_get_corpus_while_adding(fsdbi):
+    corpus_id = fsdbi.add_corpus(
+        make_corpus([make_igt('i{}'.format(i)) for i in range(20)])
+    )['id']
+    xc = fsdbi.get_corpus(corpus_id, mode='transient')
+    igts = iter(xc)
+    seen = [next(igts).id]
+    fsdbi.add_igts(corpus_id, [make_igt('j0'), make_igt('j1')])
+    seen.extend(igt.id for igt in igts)
+    assert seen == ['i{}'.format(i) for i in range(20)]
+
+
+@pytest.mark.parametrize('codec', [
+    'bz2:0', 'gzip:10', 'lzma:12', 'none:1', 'gzip:', 'brotli',
+])
+def test_invalid_codec(fsdbi, tmp_path, codec):
+    with pytest.raises(SleipnirDbError):
+        FileSystemDbi(str(tmp_path / 'other'), codec=codec)
+    corpus_id = fsdbi.add_corpus(make_corpus([make_igt('i1')]))['id']
+    with pytest.raises(SleipnirDbError):
+        fsdbi.pack_corpus(corpus_id, codec=codec)
+
+
+@pytest.mark.parametrize('codec', ['bz2:1', 'gzip:0', 'zlib:9', 'none'])
+def test_codec_levels(tmp_path, codec):
+    dbi = FileSystemDbi(str(tmp_path / 'db'), codec=codec)
+    corpus_id = dbi.add_corpus(make_corpus([make_igt('i1')]))['id']
+    assert dbi.get_igt(corpus_id, 'i1').id == 'i1'
@@ -0,0 +1,111 @@
+from xigt.codecs import xigtjson
+
+from conftest import make_corpus, make_igt
+
+
+def _add_corpus(dbi):
+    return dbi.add_corpus(make_corpus([
+        make_igt('i1', lang=('deu', 'German')),
+        make_igt('i2', lang=('deu', 'German')),
+        make_igt('i3', lang=('nld', 'Dutch')),
+    ]))['id']
+
+
+def _languages(dbi, corpus_id):
+    return dbi.corpus_summary(corpus_id)['languages']
+
+
+def _roundtrip(igt):
+    # as an IGT sent back to the REST API
+    return xigtjson.decode_igt(xigtjson.encode_igt(igt))
+
+
+def test_languages(dbi):
+    corpus_id = _add_corpus(dbi)
+    assert _languages(dbi, corpus_id) == {
+        'deu': {'German': 2}, 'nld': {'Dutch': 1}
+    }
+
+
+def test_set_igt_keeps_language(dbi):
+    corpus_id = _add_corpus(dbi)
+    before = _languages(dbi, corpus_id)
+    igt = _roundtrip(dbi.get_igt(corpus_id, 'i1'))
+    dbi.set_igt(corpus_id, 'i1', igt)
+    assert _languages(dbi, corpus_id) == before
+    # without the OLAC namespace, the code can't be resolved
+    record = xigtjson.encode_igt(dbi.get_igt(corpus_id, 'i3'))
+    del record['namespaces']
+    dbi.set_igt(corpus_id, 'i3', xigtjson.decode_igt(record))
+    assert _languages(dbi, corpus_id) == before
+    assert dbi.get_stats()['languages'] == before
+
+
+def test_set_igt_changes_language(dbi):
+    corpus_id = _add_corpus(dbi)
+    igt = _roundtrip(make_igt('i1', lang=('nld', 'Dutch')))
+    dbi.set_igt(corpus_id, 'i1', igt)
+    assert _languages(dbi, corpus_id) == {
+        'deu': {'German': 1}, 'nld': {'Dutch': 2}
+    }
+
+
+def test_patch_igt_keeps_language(dbi):
+    corpus_id = _add_corpus(dbi)
+    before = _languages(dbi, corpus_id)
+    dbi.patch_igt(corpus_id, 'i1', [
+        {'op': 'add', 'path': '/metadata',
+         'value': {'type': 'notes', 'metas': [{'text': 'a note'}]}},
+        {'op': 'replace', 'path': '/tiers/w/items/w1/text', 'value': 'c'},
+    ])
+    assert _languages(dbi, corpus_id) == before
+    assert dbi.get_stats()['languages'] == before
+
+
+def test_patch_igt_changes_language(dbi):
+    corpus_id = _add_corpus(dbi)
+    dbi.patch_igt(corpus_id, 'i1', [
+        {'op': 'replace', 'path': '/metadata/0/metas/lang',
+         'value': {'type': 'language', 'children': [
+             {'name': 'dc:subject', 'attributes': {'olac:code': 'nld'},
+              'text': 'Dutch'}
+         ]}},
+    ])
+    assert _languages(dbi, corpus_id) == {
+        'deu': {'German': 1}, 'nld': {'Dutch': 2}
+    }
+
+
+def _query_cache_size(dbi):
+    return dbi.cache_info()['query']['size']
+
+
+def test_path_query_page_is_not_cached(dbi):
+    corpus_id = dbi.add_corpus(make_corpus([
+        make_igt('i{}'.format(i)) for i in range(10)
+    ]))['id']
+    path = 'tier/item[value()="a"]'
+    page = dbi.get_igts(corpus_id, paths=[path], limit=2)
+    assert [igt.id for igt in page] == ['i0', 'i1']
+    assert _query_cache_size(dbi) == 0
+    page = dbi.get_igts(corpus_id, paths=[path], cursor='i2', limit=2)
+    assert [igt.id for igt in page] == ['i2', 'i3']
+    assert _query_cache_size(dbi) == 0
+
+
+def test_path_query_streams_then_caches(dbi):
+    corpus_id = dbi.add_corpus(make_corpus([
+        make_igt('i{}'.format(i)) for i in range(10)
+    ]))['id']
+    path = 'tier/item[value()="a"]'
+    igts = dbi.iter_igts(corpus_id, paths=[path])
+    assert next(igts).id == 'i0'
+    assert _query_cache_size(dbi) == 0
+    assert [igt.id for igt in igts] == ['i{}'.format(i) for i in range(1, 10)]
+    assert _query_cache_size(dbi) == 1
+    hits = dbi.cache_info()['query']['hits']
+    page = dbi.get_igts(corpus_id, paths=[path], cursor='i5', limit=2)
+    assert [igt.id for igt in page] == ['i5', 'i6']
+    assert dbi.cache_info()['query']['hits'] == hits + 1
+    # the cached matches get the query results too
+    assert page[0].metadata[-1].type == 'QueryResult'
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+import sleipnir
+import sleipnir.query
+from sleipnir.errors import SleipnirError
+
+from conftest import make_corpus, make_igt
+
+
+@pytest.fixture
+def client(dbi):
+    return sleipnir.create_app(dbi=dbi).test_client()
+
+
+def _add_corpora(dbi):
+    return [
+        dbi.add_corpus(make_corpus([
+            make_igt('i1', words=('a', 'b')),
+            make_igt('i2', words=('c',)),
+        ]))['id'],
+        dbi.add_corpus(make_corpus([make_igt('i1', words=('a',))]))['id'],
+    ]
+
+
+def _lines(response):
+    return [json.loads(line) for line in response.get_data(as_text=True)
+            .splitlines()]
+
+
+def test_search(dbi, client):
+    corpus_ids = _add_corpora(dbi)
+    expected = sorted([(corpus_ids[0], 'i1'), (corpus_ids[1], 'i1')])
+    matches = dbi.search(['tier/item[value()="a"]'])
+    assert sorted((cid, igt.id) for cid, igt in matches) == expected
+    response = client.get('/v1/search?path=tier/item[value()="a"]')
+    assert response.status_code == 200
+    assert sorted((m['corpus_id'], m['igt']['id'])
+                  for m in _lines(response)) == expected
+
+
+@pytest.mark.parametrize('path', [
+    'tier[', 'tier/item[@x="1"', 'text(', '@', 'tier[item[@id="a"]]',
+])
+def test_search_malformed_path(dbi, client, path):
+    _add_corpora(dbi)
+    with pytest.raises(SleipnirError) as info:
+        dbi.search([path])
+    assert info.value.status_code == 400
+    response = client.get('/v1/search', query_string={'path': path})
+    assert response.status_code == 400
+    assert 'Invalid path' in response.get_json()['message']
+
+
+def test_search_error_mid_stream(dbi, client, monkeypatch):
+    _add_corpora(dbi)
+
+    def iter_igts(*args, **kwargs):
+        raise IndexError('failed in a worker')
+        yield
+
+    monkeypatch.setattr(dbi, 'iter_igts', iter_igts)
+    response = client.get('/v1/search?path=tier')
+    assert response.status_code == 200
+    assert _lines(response) == [
+        {'error': {'message': 'Internal server error'}}
+    ]
+
+
+def test_search_stops_at_limit(dbi, monkeypatch):
+    corpus_id = dbi.add_corpus(make_corpus([
+        make_igt('i{}'.format(i)) for i in range(500)
+    ]))['id']
+    checked = []
+    query_hits = sleipnir.query.query_hits
+
+    def counting_query_hits(igt, paths):
+        checked.append(igt.id)
+        return query_hits(igt, paths)
+
+    monkeypatch.setattr(sleipnir.query, 'query_hits', counting_query_hits)
+    path = 'tier/item[value()="a"]'
+    assert len(list(dbi.search([path], limit=1))) == 1
+    # the worker stops soon after the limit, so the query isn't cached
+    assert len(checked) < 500
+    assert dbi.cache_info()['query']['size'] == 0
+    # a search that gets through the corpus caches its matches
+    assert len(list(dbi.search([path]))) == 500
+    del checked[:]
+    assert [igt.id for _, igt in dbi.search([path], limit=3)] == \
+        ['i0', 'i1', 'i2']
+    assert checked == []
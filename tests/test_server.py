@@ -0,0 +1,75 @@
+import socket
+import threading
+import http.client
+
+from sleipnir.server import PooledWSGIServer
+
+_started = threading.Event()
+_release = threading.Event()
+
+
+def _app(environ, start_response):
+    if environ['PATH_INFO'] == '/wait':
+        _started.set()
+        _release.wait(10)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'ok']
+
+
+class _CountingServer(PooledWSGIServer):
+    # counts the connections it has accepted
+
+    accepted = 0
+
+    def get_request(self):
+        request = PooledWSGIServer.get_request(self)
+        self.accepted += 1
+        return request
+
+
+def _get(port, path='/'):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request('GET', path)
+        return conn.getresponse().read()
+    finally:
+        conn.close()
+
+
+def test_pooled_server():
+    _started.clear()
+    _release.clear()
+    server = _CountingServer('127.0.0.1', 0, _app, threads=1, backlog=8)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        # the thread is freed after each request
+        for _ in range(5):
+            assert _get(server.port) == b'ok'
+        assert server.accepted == 5
+        # while the only thread is busy, another connection waits in
+        # the listen queue without being accepted, and is served once
+        # the thread is free
+        waiting = threading.Thread(target=_get, args=(server.port, '/wait'))
+        waiting.start()
+        assert _started.wait(10)
+        sock = socket.create_connection(('127.0.0.1', server.port))
+        sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        sock.settimeout(0.5)
+        try:
+            sock.recv(1)
+            served = True
+        except socket.timeout:
+            served = False
+        assert not served
+        assert server.accepted == 6
+        _release.set()
+        waiting.join()
+        sock.settimeout(10)
+        assert sock.recv(1024).startswith(b'HTTP/1.1 200')
+        sock.close()
+        assert server.accepted == 7
+    finally:
+        _release.set()
+        server.shutdown()
+        thread.join()
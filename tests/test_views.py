@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+import sleipnir
+
+from conftest import make_corpus, make_igt
+
+
+@pytest.fixture
+def client(dbi):
+    return sleipnir.create_app(dbi=dbi).test_client()
+
+
+def _add_corpus(dbi, corpus_id=None):
+    xc = make_corpus([make_igt('i1')])
+    if corpus_id is None:
+        return dbi.add_corpus(xc)['id']
+    return dbi.add_corpora([xc], ids=[corpus_id])[0]['id']
+
+
+def test_etag_of_recreated_corpus(dbi, client):
+    corpus_id = _add_corpus(dbi)
+    url = '/v1/corpora/' + corpus_id
+    etag = client.get(url).headers['ETag']
+    version = dbi.get_version(corpus_id)[0]
+    dbi.del_corpus(corpus_id)
+    _add_corpus(dbi, corpus_id)
+    assert dbi.get_version(corpus_id)[0] == version
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_if_none_match_over_if_modified_since(dbi, client, monkeypatch):
+    corpus_id = _add_corpus(dbi)
+    url = '/v1/corpora/' + corpus_id
+    monkeypatch.setattr(dbi, 'get_version', lambda *args: (1, 1000.5))
+    response = client.get(url)
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+    assert client.get(url, headers={
+        'If-None-Match': etag
+    }).status_code == 304
+    assert client.get(url, headers={
+        'If-Modified-Since': last_modified
+    }).status_code == 304
+    # the stale ETag decides, though the date is current
+    assert client.get(url, headers={
+        'If-None-Match': '"stale"', 'If-Modified-Since': last_modified
+    }).status_code == 200
+
+
+def test_no_last_modified_within_the_second(dbi, client, monkeypatch):
+    corpus_id = _add_corpus(dbi)
+    url = '/v1/corpora/' + corpus_id
+    now = time.time() + 5  # still in the current second for a while
+    monkeypatch.setattr(dbi, 'get_version', lambda *args: (1, now))
+    response = client.get(url)
+    assert 'Last-Modified' not in response.headers
+    assert 'ETag' in response.headers